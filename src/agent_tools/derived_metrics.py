@@ -0,0 +1,138 @@
+"""
+Derived metrics that are computed once per snapshot when it is ingested. Each metric is a vectorized pandas expression
+over the raw box score columns, so the agents can sort and filter on advanced metrics with data_lookup instead of
+asking for follow up lookups and doing the arithmetic themselves.
+"""
+
+from settings import logging
+import pandas as pd
+import numpy as np
+
+
+def safe_divide(numerator: pd.Series, denominator: pd.Series) -> pd.Series:
+    """
+    Divide two columns. Division by zero gives a missing value instead of inf.
+    :param numerator: The numerator.
+    :param denominator: The denominator.
+    :return: The result.
+    """
+
+    return (numerator / denominator).replace([np.inf, -np.inf], np.nan)
+
+
+def estimated_possessions(data: pd.DataFrame) -> pd.Series:
+    """
+    Estimate possessions from the box score.
+    :param data: The snapshot.
+    :return: The estimated possessions.
+    """
+
+    return data["FGA"] + 0.44 * data["FTA"] - data["OREB"] + data["TOV"]
+
+
+# The catalog of derived metrics. Each entry is (name, required columns, function). A metric is only computed if the
+# snapshot has all of its required columns and doesn't already have a column with the same name, e.g. the Advanced
+# lineups already come with TS_PCT.
+METRIC_CATALOG = [
+    (
+        "POSS_EST",
+        ["FGA", "FTA", "OREB", "TOV"],
+        estimated_possessions
+    ),
+    (
+        "PTS_PER_100",
+        ["PTS", "FGA", "FTA", "OREB", "TOV"],
+        lambda data: 100 * safe_divide(data["PTS"], estimated_possessions(data))
+    ),
+    (
+        "TS_PCT",
+        ["PTS", "FGA", "FTA"],
+        lambda data: safe_divide(data["PTS"], 2 * (data["FGA"] + 0.44 * data["FTA"]))
+    ),
+    (
+        "EFG_PCT",
+        ["FGM", "FG3M", "FGA"],
+        lambda data: safe_divide(data["FGM"] + 0.5 * data["FG3M"], data["FGA"])
+    ),
+    (
+        "FG3A_RATE",
+        ["FG3A", "FGA"],
+        lambda data: safe_divide(data["FG3A"], data["FGA"])
+    ),
+    (
+        "FT_RATE",
+        ["FTA", "FGA"],
+        lambda data: safe_divide(data["FTA"], data["FGA"])
+    ),
+    (
+        "AST_TO",
+        ["AST", "TOV"],
+        lambda data: safe_divide(data["AST"], data["TOV"])
+    ),
+    (
+        "PTS_PER_36",
+        ["PTS", "MIN"],
+        lambda data: 36 * safe_divide(data["PTS"], data["MIN"])
+    ),
+    (
+        # A usage-style ratio: the scoring plays a player or lineup finishes per 36 minutes
+        "PLAYS_PER_36",
+        ["FGA", "FTA", "TOV", "MIN"],
+        lambda data: 36 * safe_divide(data["FGA"] + 0.44 * data["FTA"] + data["TOV"], data["MIN"])
+    ),
+    (
+        "STOCKS",
+        ["STL", "BLK"],
+        lambda data: data["STL"] + data["BLK"]
+    ),
+]
+
+# Columns that get a league percentile (0-100) in a <COLUMN>_PCTILE column when they are in the snapshot
+PERCENTILE_COLUMNS = [
+    "PTS", "PLUS_MINUS", "NET_RATING", "OFF_RATING", "DEF_RATING", "TS_PCT", "EFG_PCT", "PTS_PER_100", "PTS_PER_36",
+    "AST_TO", "STOCKS", "DEFLECTIONS", "CONTESTED_SHOTS", "SCREEN_ASSISTS", "LOOSE_BALLS_RECOVERED", "BOX_OUTS"
+]
+
+# Lower is better for these so their percentile is flipped
+LOWER_IS_BETTER = {"DEF_RATING"}
+
+
+def add_derived_metrics(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the derived metrics and league percentiles to a snapshot. The snapshot isn't modified in place since it may be
+    shared through the response cache.
+    :param data: The snapshot.
+    :return: A new DataFrame with the derived columns added.
+    """
+
+    if data.empty:
+        return data
+
+    derived_columns = {}
+
+    for name, required_columns, metric_function in METRIC_CATALOG:
+        if name in data.columns:
+            continue
+        if not all(column in data.columns for column in required_columns):
+            continue
+        try:
+            derived_columns[name] = pd.to_numeric(metric_function(data), errors="coerce").round(4)
+        except Exception as e:
+            # A bad column shouldn't stop the rest of the snapshot from being ingested
+            logging.error(f"Failed to compute {name}. Error: {e}")
+
+    # Percentiles are computed over every row in the snapshot, including the metrics derived above
+    available_columns = {**{column: data[column] for column in data.columns}, **derived_columns}
+    for column in PERCENTILE_COLUMNS:
+        percentile_name = f"{column}_PCTILE"
+        if column not in available_columns or percentile_name in data.columns:
+            continue
+        series = pd.to_numeric(available_columns[column], errors="coerce")
+        percentile = series.rank(pct=True, ascending=column not in LOWER_IS_BETTER) * 100
+        derived_columns[percentile_name] = percentile.round(1)
+
+    if not derived_columns:
+        return data
+
+    logging.debug(f"Added derived metrics: {list(derived_columns.keys())}")
+    return data.assign(**derived_columns)
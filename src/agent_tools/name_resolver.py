@@ -0,0 +1,207 @@
+"""
+In-process index for turning player and team names into NBA IDs. The index is built from the static player and team
+lists that ship with nba_api so it doesn't need a network call, and it is updated whenever a new player_stats snapshot
+is added to the DB.
+"""
+
+from settings import logging
+from nba_api.stats.static import players, teams
+
+from difflib import get_close_matches
+import unicodedata
+import threading
+import bisect
+
+# Sorts after every character a normalized name can have
+MAX_CHARACTER = chr(0x10FFFF)
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalize a name for matching. Accents are removed, punctuation is dropped and the name is lower cased, so
+    "Nikola Jokić" and "nikola jokic" are the same.
+    :param name: The name.
+    :return: The normalized name.
+    """
+
+    decomposed = unicodedata.normalize("NFKD", name)
+    without_accents = "".join(character for character in decomposed if not unicodedata.combining(character))
+    cleaned = "".join(character if character.isalnum() else " " for character in without_accents.lower())
+
+    return " ".join(cleaned.split())
+
+
+class NameIndex:
+    """
+    A thread-safe index of players and teams. Every entry can be found by any of its names (full name, last name, team
+    nickname, abbreviation, ...). Lookups try an exact match, then a prefix match and then a fuzzy match.
+    """
+    def __init__(self):
+        # entry key ("player:2544") -> entry
+        self.entries = {}
+        # normalized name -> set of entry keys
+        self.names = {}
+        # entry key -> the normalized names it can be found by, so the old ones can be removed when it is updated
+        self.entry_names = {}
+        # Sorted normalized names so prefix matches are a range found with bisect
+        self.sorted_names = []
+        self.lock = threading.Lock()
+
+    def add(self, kind: str, entry_id, name: str, aliases: list, extra: dict = None) -> None:
+        """
+        Add or update an entry. An updated entry can only be found by its new names.
+        :param kind: "player" or "team".
+        :param entry_id: The NBA ID.
+        :param name: The display name.
+        :param aliases: Other names the entry can be found by.
+        :param extra: Extra info to return with the entry, e.g. the team abbreviation.
+        :return: None
+        """
+
+        entry_key = f"{kind}:{entry_id}"
+        entry = {"type": kind, "id": entry_id, "name": name, **(extra if extra else {})}
+        normalized_aliases = {normalize_name(str(alias)) for alias in [name] + aliases if alias}
+        normalized_aliases.discard("")
+
+        with self.lock:
+            self.entries[entry_key] = entry
+
+            for stale_alias in self.entry_names.get(entry_key, set()) - normalized_aliases:
+                self.names[stale_alias].discard(entry_key)
+                if not self.names[stale_alias]:
+                    del self.names[stale_alias]
+                    del self.sorted_names[bisect.bisect_left(self.sorted_names, stale_alias)]
+
+            for normalized_alias in normalized_aliases:
+                if normalized_alias not in self.names:
+                    self.names[normalized_alias] = set()
+                    bisect.insort(self.sorted_names, normalized_alias)
+                self.names[normalized_alias].add(entry_key)
+            self.entry_names[entry_key] = normalized_aliases
+
+        return
+
+    def has(self, kind: str, entry_id) -> bool:
+        """
+        Check if an entry is in the index.
+        :param kind: "player" or "team".
+        :param entry_id: The NBA ID.
+        :return: True if it is.
+        """
+
+        with self.lock:
+            return f"{kind}:{entry_id}" in self.entries
+
+    def prefix_matches(self, normalized_query: str) -> list:
+        """
+        Get every name that starts with the query. The names that start with the query are the ones sorted between the
+        query and the query followed by the highest character, so only the matches are read.
+        :param normalized_query: The normalized query.
+        :return: The matching names in sorted order.
+        """
+
+        start = bisect.bisect_left(self.sorted_names, normalized_query)
+        end = bisect.bisect_left(self.sorted_names, normalized_query + MAX_CHARACTER, lo=start)
+
+        return self.sorted_names[start:end]
+
+    def resolve(self, query: str, kind: str = None, limit: int = 5) -> list:
+        """
+        Find the entries that match a name.
+        :param query: The name to look up.
+        :param kind: Only return "player" or "team" entries if given.
+        :param limit: The most entries to return.
+        :return: The matching entries with how they matched.
+        """
+
+        normalized_query = normalize_name(query)
+        if not normalized_query:
+            return []
+
+        with self.lock:
+            if normalized_query in self.names:
+                matched_names = [normalized_query]
+                match_type = "exact"
+            else:
+                matched_names = self.prefix_matches(normalized_query)
+                match_type = "prefix"
+                if not matched_names:
+                    matched_names = get_close_matches(normalized_query, self.names.keys(), n=limit, cutoff=0.75)
+                    match_type = "fuzzy"
+
+            results = []
+            seen_keys = set()
+            for matched_name in matched_names:
+                for entry_key in sorted(self.names[matched_name]):
+                    entry = self.entries[entry_key]
+                    if entry_key in seen_keys or (kind and entry["type"] != kind):
+                        continue
+                    seen_keys.add(entry_key)
+                    results.append({**entry, "match": match_type})
+
+        # Active players are more likely to be who the user means
+        results.sort(key=lambda result: not result.get("is_active", True))
+
+        return results[:limit]
+
+
+def build_name_index() -> NameIndex:
+    """
+    Build the index from the static nba_api player and team lists.
+    :return: The index.
+    """
+
+    index = NameIndex()
+
+    for team in teams.get_teams():
+        index.add(
+            kind="team",
+            entry_id=team["id"],
+            name=team["full_name"],
+            aliases=[team["abbreviation"], team["nickname"], team["city"]],
+            extra={"abbreviation": team["abbreviation"]}
+        )
+
+    for player in players.get_players():
+        index.add(
+            kind="player",
+            entry_id=player["id"],
+            name=player["full_name"],
+            aliases=[player["last_name"]],
+            extra={"is_active": player["is_active"]}
+        )
+
+    logging.info(f"Built name index with {len(index.entries)} players and teams.")
+    return index
+
+
+def add_player_rows(index: NameIndex, data_list: list, is_current_season: bool) -> None:
+    """
+    Add the players from a player_stats snapshot to the index. This picks up players that aren't in the static list
+    yet, like rookies, along with their team. Only the current season's roster marks players as active. Older seasons
+    only add players the index doesn't know yet, as inactive, so they never overwrite a newer team.
+    :param index: The index.
+    :param data_list: The rows of the snapshot.
+    :param is_current_season: If the snapshot is of the current season.
+    :return: None
+    """
+
+    for row in data_list:
+        if not row.get("PLAYER_ID") or not row.get("PLAYER_NAME"):
+            continue
+        if not is_current_season and index.has("player", row["PLAYER_ID"]):
+            continue
+        name_parts = row["PLAYER_NAME"].split(" ", 1)
+        index.add(
+            kind="player",
+            entry_id=row["PLAYER_ID"],
+            name=row["PLAYER_NAME"],
+            aliases=[name_parts[-1]],
+            extra={
+                "is_active": is_current_season,
+                "team_id": row.get("TEAM_ID"),
+                "team_abbreviation": row.get("TEAM_ABBREVIATION")
+            }
+        )
+
+    return
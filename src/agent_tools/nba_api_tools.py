@@ -1,9 +1,20 @@
-from settings import logging
+from settings import (logging, NBA_CACHE_TTL_LIVE, NBA_CACHE_TTL_FINISHED, NBA_CACHE_MAX_ENTRIES,
+                      NBA_CACHE_SHARED, DERIVED_METRICS)
 from nba_api.stats import endpoints
-from db_tools import generic_create, doc_lookup
+from db_tools import (doc_lookup, snapshot_exists, create_snapshot, touch_snapshot, find_season_partition,
+                      save_season_partition, mark_snapshot_immutable, aggregate_facts)
+from cache_tools import ResponseCache, make_cache_key
+from tracing import traced, get_current_span
+from agent_tools.nba_http import install_transport
+from agent_tools.name_resolver import build_name_index, add_player_rows
+from agent_tools.derived_metrics import add_derived_metrics
+import pandas as pd
+import threading
+import hashlib
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
+import re
 
 TEAM_REF = {
     '1610612739': 'Cleveland Cavaliers',
@@ -40,55 +51,413 @@ TEAM_REF = {
 
 SEASON = '2023-24'
 
+# The most seasons a single tool call can ask for
+MAX_SEASONS_PER_CALL = 30
 
-def get_info(endpoint, endpoint_name, **kwargs) -> tuple[dict, str | None]:
-    # Set the shared ID that will be used to identify the data in the DB
-    doc_id = str(uuid.uuid4())
+# Set by the warm-up job so live partitions are fetched again instead of served from the season store. Finished seasons
+# are always served from the store.
+refresh_live_partitions = False
+
+# Send every endpoint call through the shared pooled, rate-limited and retrying session
+install_transport()
+
+# Cache of the first DataFrame returned by each endpoint. The in-process tier stores the DataFrame itself and the
+# shared tier stores it as a list of records.
+response_cache = ResponseCache(
+    name="nba_api",
+    max_entries=NBA_CACHE_MAX_ENTRIES,
+    default_ttl=NBA_CACHE_TTL_LIVE,
+    collection="swarm_api_cache" if NBA_CACHE_SHARED else None,
+    serialize=lambda data: data.to_dict('records'),
+    deserialize=lambda records: pd.DataFrame(records)
+)
+
+# The player/team name index is built the first time it is needed
+name_index = None
+name_index_lock = threading.Lock()
+
+
+def get_name_index():
+    """
+    Get the player/team name index, building it on first use.
+    :return: The name index.
+    """
+
+    global name_index
+
+    with name_index_lock:
+        if name_index is None:
+            name_index = build_name_index()
+
+    return name_index
+
+
+def season_is_finished(season: str) -> bool:
+    """
+    Check if a season is over. A season like '2023-24' is treated as finished once July 1st of 2024 has passed.
+    :param season: The season in the format 'YYYY-YY'.
+    :return: True if the season is finished.
+    """
+
+    try:
+        end_year = int(season[:4]) + 1
+    except (TypeError, ValueError):
+        return False
+
+    return datetime.utcnow() >= datetime(end_year, 7, 1)
+
+
+def endpoint_cache_key(endpoint, **kwargs) -> str:
+    """
+    Build the cache key for an endpoint call. The key is made up of the endpoint class, the normalized kwargs and the
+    season so that the same request from different conversations shares a cache entry.
+    :param endpoint: The nba_api endpoint class.
+    :param kwargs: The kwargs the endpoint is called with.
+    :return: The cache key.
+    """
+
+    # Drop empty values and compare values as strings so that 1 and '1' are the same request
+    normalized_kwargs = {key: str(value) for key, value in kwargs.items() if value is not None}
+    season = normalized_kwargs.get('season', SEASON)
+
+    return make_cache_key(f"{endpoint.__module__}.{endpoint.__qualname__}", normalized_kwargs, season)
+
+
+def fetch_data_frame(endpoint, **kwargs) -> pd.DataFrame:
+    """
+    Fetch the first DataFrame from an endpoint, serving it from the response cache when possible. The returned
+    DataFrame may be shared with other callers so it must not be modified in place.
+    :param endpoint: The nba_api endpoint class.
+    :param kwargs: The kwargs to call the endpoint with.
+    :return: The DataFrame.
+    """
+
+    cache_key = endpoint_cache_key(endpoint, **kwargs)
+
+    data = response_cache.get(cache_key)
+    get_current_span().set("cache_hit", data is not None)
+    if data is not None:
+        logging.debug(f'Serving {endpoint.__name__} from the response cache.')
+        return data
+
+    data = endpoint(**kwargs).get_data_frames()[0]
+
+    # Finished seasons won't change anymore so they can be cached for much longer
+    season = kwargs.get('season', SEASON)
+    ttl = NBA_CACHE_TTL_FINISHED if season_is_finished(season) else NBA_CACHE_TTL_LIVE
+    response_cache.put(cache_key, data, ttl=ttl)
+
+    return data
+
+
+def snapshot_id(endpoint_name: str, params: dict, data: pd.DataFrame) -> str:
+    """
+    Build a content-addressed ID for a fetched table. The same endpoint, params and rows always produce the same ID so
+    an identical snapshot can be reused instead of inserted again.
+    :param endpoint_name: The name of the endpoint.
+    :param params: The params the endpoint was called with.
+    :param data: The fetched table.
+    :return: The ID formatted like a UUID so the agents see no difference.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(make_cache_key(endpoint_name, params, list(data.columns)).encode("utf-8"))
+
+    # Hash the row contents with pandas so we don't have to serialize every row
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+
+    return str(uuid.UUID(hex=digest.hexdigest()[:32]))
+
+
+# The operators that can be used in get_info row filters. Each one builds a boolean mask over a column.
+ROW_FILTER_OPERATORS = {
+    '==': lambda series, value: series == value,
+    '!=': lambda series, value: series != value,
+    '>': lambda series, value: series > value,
+    '>=': lambda series, value: series >= value,
+    '<': lambda series, value: series < value,
+    '<=': lambda series, value: series <= value,
+    'in': lambda series, value: series.isin(value),
+    'not in': lambda series, value: ~series.isin(value),
+    'contains': lambda series, value: series.astype(str).str.contains(value, case=False, regex=False)
+}
+
+
+def apply_pushdown(data: pd.DataFrame, row_filters: list = None, columns: list = None) -> pd.DataFrame:
+    """
+    Filter and project a DataFrame before it is turned into a list of dictionaries. The filters run as vectorized
+    pandas operations so only the rows and columns that are kept get materialized.
+    :param data: The DataFrame returned by the endpoint.
+    :param row_filters: A list of (column, operator, value) tuples. All of them must match for a row to be kept, e.g.
+    [('MIN', '>=', 1)]. The operators are the keys of ROW_FILTER_OPERATORS.
+    :param columns: The columns to keep. Columns that aren't in the data are ignored.
+    :return: The filtered and projected DataFrame.
+    """
+
+    if row_filters:
+        mask = pd.Series(True, index=data.index)
+        for column, operator, value in row_filters:
+            mask &= ROW_FILTER_OPERATORS[operator](data[column], value).fillna(False)
+        data = data[mask]
 
-    # Get the lineups
+    if columns:
+        data = data[[column for column in columns if column in data.columns]]
+
+    return data
+
+
+@traced("nba_api.get_info")
+def get_info(endpoint, endpoint_name, row_filters: list = None, columns: list = None,
+             **kwargs) -> tuple[list, str | None]:
+    """
+    Fetch the data from an endpoint and get it ready to add to the DB. The derived metrics are added here so they are
+    stored next to the raw columns.
+    :param endpoint: The nba_api endpoint class.
+    :param endpoint_name: The name of the endpoint.
+    :param row_filters: Row predicates to apply before the data is materialized. See apply_pushdown.
+    :param columns: The columns to keep. All columns are kept if not given.
+    :param kwargs: The kwargs to call the endpoint with.
+    :return: The rows as a list of dictionaries and the doc_id of the snapshot.
+    """
+
+    get_current_span().set("endpoint", endpoint_name)
+
+    # Get the data from the cache or the API
     try:
-        data = endpoint(**kwargs).get_data_frames()[0]
+        data = fetch_data_frame(endpoint, **kwargs)
         logging.debug('Data fetched successfully')
     except Exception as e:
         logging.error(f'Failed to fetch {endpoint_name}. Error: {e}')
-        return {}, None
+        return [], None
+
+    # Drop the rows we don't need, add the derived metrics to the rows that are left and then drop the columns we
+    # don't need before building any dictionaries
+    try:
+        data = apply_pushdown(data, row_filters=row_filters)
+        if DERIVED_METRICS:
+            data = add_derived_metrics(data)
+        data = apply_pushdown(data, columns=columns)
+    except Exception as e:
+        logging.error(f'Failed to prepare {endpoint_name}. Error: {e}')
+        return [], None
+
+    # Set the shared ID that will be used to identify the data in the DB
+    params = {**kwargs, 'row_filters': row_filters, 'columns': columns}
+    doc_id = snapshot_id(endpoint_name, params, data)
 
     # Convert the data to a list of dictionaries
     data_list = data.to_dict('records')
+    get_current_span().set("rows", len(data_list))
 
     return data_list, doc_id
 
 
-def add_info_to_db(data_list, doc_id, endpoint_name, hint) -> str:
-    # Add the ID and the current time to the data
+def parse_seasons(season: str | None) -> list:
+    """
+    Parse a season argument into a list of seasons.
+    :param season: A single season like '2023-24', a range like '2019-20:2023-24', a comma separated list like
+    '2019-20,2023-24' or None for the current season.
+    :return: The seasons in order.
+    """
+
+    if not season:
+        return [SEASON]
+
+    season_pattern = re.compile(r"^\d{4}-\d{2}$")
+
+    if ":" in season:
+        start_season, end_season = [part.strip() for part in season.split(":", 1)]
+        if not season_pattern.match(start_season) or not season_pattern.match(end_season):
+            raise ValueError(f"Invalid season range '{season}'. Use the format '2019-20:2023-24'.")
+        start_year = int(start_season[:4])
+        end_year = int(end_season[:4])
+        seasons = [f"{year}-{str(year + 1)[2:]}" for year in range(start_year, end_year + 1)]
+    else:
+        seasons = [part.strip() for part in season.split(",") if part.strip()]
+        for single_season in seasons:
+            if not season_pattern.match(single_season):
+                raise ValueError(f"Invalid season '{single_season}'. Use the format '2023-24'.")
+
+    if not seasons:
+        raise ValueError(f"No seasons found in '{season}'.")
+    if len(seasons) > MAX_SEASONS_PER_CALL:
+        raise ValueError(f"Too many seasons requested. The limit is {MAX_SEASONS_PER_CALL}.")
+
+    return seasons
+
+
+def add_info_to_db(data_list, doc_id, endpoint_name, season, immutable) -> dict | None:
+    """
+    Add a snapshot to the DB. Each row is stamped with the doc_id, the time it was added and its season partition.
+    :param data_list: The rows of the snapshot.
+    :param doc_id: The content-addressed ID of the snapshot.
+    :param endpoint_name: The name of the endpoint.
+    :param season: The season of the snapshot.
+    :param immutable: True if the season is finished. These rows are never expired or fetched again.
+    :return: An example row or None if the snapshot couldn't be added.
+    """
+
+    # Add the ID, the current time and the partition to the data
     current_time = datetime.utcnow()
     for item in data_list:
         item['createdAt'] = current_time
         item['doc_id'] = doc_id
+        item['season'] = season
+        item['endpoint'] = endpoint_name
+        item['immutable'] = immutable
 
-    schema_example = data_list[0]
+    # Copy the example row since the insert adds an _id to each row
+    schema_example = dict(data_list[0])
     logging.info(f"Schema example: {schema_example}")
 
-    # Add the info to the database
-    create_result = generic_create(collection='swarm_facts', content=data_list)
+    # Identical snapshots share a doc_id so only insert the rows if this snapshot isn't in the DB yet
+    if snapshot_exists(doc_id):
+        logging.info(f"Reusing {endpoint_name} snapshot {doc_id}.")
+        touch_snapshot(doc_id)
+        # The snapshot may have been added while the season was still live
+        if immutable:
+            mark_snapshot_immutable(doc_id)
+        create_result = True
+    else:
+        create_result = create_snapshot(doc_id, data_list)
 
-    # generic_create returns False if the insert fails and the ID of the insert if it succeeds.
-    if create_result:
-        logging.info(f"Added lineups to DB.")
+    # create_snapshot returns False if the insert fails.
+    if not create_result:
+        logging.error(f"Failed to add {endpoint_name} to DB.")
+        return None
 
-        dba_msg = (f"\n\nNEXT STEP: You have successfully added the {endpoint_name} info to the database. Using the "
-                   "info above you can now use the data_lookup function to query the data.\n\n")
-        msg = (f"{endpoint_name} info added to DB with doc_id: "
-               f"{doc_id}\n\nExample entry:\n{schema_example}{dba_msg}{hint}")
-        return msg
-    else:
-        logging.error(f"Failed to add lineups to DB.")
-        return f"Failed to add {endpoint_name} info to DB."
+    logging.info(f"Added {endpoint_name} to DB.")
+    return schema_example
+
+
+def get_season_partition(endpoint, endpoint_name, season, row_filters: list = None, columns: list = None,
+                         on_new_rows=None, **kwargs) -> dict | None:
+    """
+    Get the snapshot for one season of an endpoint. The season store is checked first. Finished seasons are served from
+    it forever and live seasons until they expire. Otherwise the data is fetched and added to the store.
+    :param endpoint: The nba_api endpoint class.
+    :param endpoint_name: The name of the endpoint.
+    :param season: The season.
+    :param row_filters: Row predicates to apply before the data is materialized. See apply_pushdown.
+    :param columns: The columns to keep. All columns are kept if not given.
+    :param on_new_rows: Called with the rows and the season when the data is fetched instead of served from the store.
+    :param kwargs: The other kwargs to call the endpoint with.
+    :return: The partition or None if the data couldn't be fetched or stored.
+    """
+
+    kwargs['season'] = season
+
+    # The partition is identified by the endpoint, the season and everything else that changes the data
+    normalized_kwargs = {key: str(value) for key, value in kwargs.items() if value is not None}
+    partition_key = make_cache_key(endpoint_name, normalized_kwargs, row_filters, columns)
+
+    partition = find_season_partition(partition_key)
+    if partition:
+        is_fresh = partition["immutable"] or (
+            not refresh_live_partitions and partition["expiresAt"] > datetime.utcnow()
+        )
+        if is_fresh and snapshot_exists(partition["doc_id"]):
+            logging.info(f"Serving {endpoint_name} {season} from the season store.")
+            return partition
+
+    data_list, doc_id = get_info(endpoint, endpoint_name, row_filters=row_filters, columns=columns, **kwargs)
+    if not data_list:
+        return None
 
+    immutable = season_is_finished(season)
+    schema_example = add_info_to_db(data_list, doc_id, endpoint_name, season, immutable)
+    if schema_example is None:
+        return None
 
-def get_lineups(**kwargs) -> str:
+    if on_new_rows:
+        on_new_rows(data_list, season)
+
+    current_time = datetime.utcnow()
+    partition = {
+        "_id": partition_key,
+        "endpoint": endpoint_name,
+        "season": season,
+        "params": normalized_kwargs,
+        "doc_id": doc_id,
+        "rows": len(data_list),
+        "example": schema_example,
+        "immutable": immutable,
+        "fetchedAt": current_time,
+        "expiresAt": None if immutable else current_time + timedelta(seconds=NBA_CACHE_TTL_LIVE)
+    }
+    save_season_partition(partition)
+
+    return partition
+
+
+def ingest(endpoint, endpoint_name, season: str | None, hint: str, empty_msg: str, row_filters: list = None,
+           columns: list = None, on_new_rows=None, **kwargs) -> str:
+    """
+    Get the snapshots for every requested season of an endpoint and build the message for the agent.
+    :param endpoint: The nba_api endpoint class.
+    :param endpoint_name: The name of the endpoint.
+    :param season: The season argument from the tool call. See parse_seasons.
+    :param hint: Things for the agent to consider when looking at the data.
+    :param empty_msg: The message to return if there is no data.
+    :param row_filters: Row predicates to apply before the data is materialized. See apply_pushdown.
+    :param columns: The columns to keep. All columns are kept if not given.
+    :param on_new_rows: Called with the rows and the season of every season that is fetched instead of served from the
+    store.
+    :param kwargs: The other kwargs to call the endpoint with.
+    :return: The message for the agent.
+    """
+
+    try:
+        seasons = parse_seasons(season)
+    except ValueError as e:
+        return str(e)
+
+    partitions = []
+    for single_season in seasons:
+        partition = get_season_partition(
+            endpoint,
+            endpoint_name,
+            single_season,
+            row_filters=row_filters,
+            columns=columns,
+            on_new_rows=on_new_rows,
+            **dict(kwargs)
+        )
+        if partition:
+            partitions.append(partition)
+
+    if not partitions:
+        return empty_msg
+
+    schema_example = partitions[0]["example"]
+    dba_msg = (f"\n\nNEXT STEP: You have successfully added the {endpoint_name} info to the database. Using the "
+               "info above you can now use the data_lookup function to query the data.\n\n")
+    if DERIVED_METRICS:
+        dba_msg += ("Rows also include derived metrics such as TS_PCT, EFG_PCT, PTS_PER_100 and league percentiles in "
+                    "the *_PCTILE columns. You can sort and filter on them directly with data_lookup.\n\n")
+
+    if len(partitions) == 1:
+        return (f"{endpoint_name} info added to DB with doc_id: "
+                f"{partitions[0]['doc_id']}\n\nExample entry:\n{schema_example}{dba_msg}{hint}")
+
+    # Each season is its own snapshot. They can all be read at once by querying every doc_id together.
+    season_lines = "\n".join(f"- {partition['season']}: doc_id: {partition['doc_id']}" for partition in partitions)
+    doc_ids = json.dumps([partition['doc_id'] for partition in partitions])
+    missing_seasons = [single_season for single_season in seasons
+                       if single_season not in [partition['season'] for partition in partitions]]
+    missing_msg = f"\nNo data was found for: {', '.join(missing_seasons)}" if missing_seasons else ""
+
+    return (f"{endpoint_name} info added to DB for {len(partitions)} seasons. Each season has its own doc_id:\n"
+            f"{season_lines}{missing_msg}\n\nTo compare seasons query them together with "
+            f'{{"doc_id": {{"$in": {doc_ids}}}}}. Every row has a `season` field.\n\n'
+            f"Example entry:\n{schema_example}{dba_msg}{hint}")
+
+
+def get_lineups(season: str = None, **kwargs) -> str:
     """
     Get lineup stats. This function will source data relating to on court lineups for a team.
+    Use the season argument for other seasons, e.g. '2019-20', a range like '2019-20:2023-24' or a comma separated
+    list. Defaults to the current season.
     Expected Data:
     - GROUP_SET
     - GROUP_ID
@@ -148,35 +517,33 @@ def get_lineups(**kwargs) -> str:
     - PTS_RANK
     - PLUS_MINUS_RANK
     """
-    kwargs['season'] = SEASON
     kwargs['measure_type_detailed_defense'] = 'Advanced'
 
-    # Get the lineups
-    data_list, doc_id = get_info(
-        endpoint=endpoints.leaguedashlineups.LeagueDashLineups,
-        endpoint_name='lineups',
-        **kwargs
-    )
-
-    # Remove all lineups with less than 1 minute played
-    data_list = [lineup for lineup in data_list if lineup['MIN'] >= 1]
-
-    if not data_list:
-        return "No lineups found."
-
     hint = ("Some things to consider when looking at lineup data:\n\n- You should consider sample size of lineups. "
             "Maybe include games played or minutes played in your query.\n- Net rating should generally be used as the "
             "overall metric for lineup performance.\n- If you are looking for specific lineup combinations, you should "
             "include the players' surname(s) in the query when doing a lookup.")
-    # Add the lineups to the database
-    msg = add_info_to_db(data_list, doc_id, 'lineups', hint)
+
+    # Get the lineups and add them to the database. Lineups with less than 1 minute played are removed before they are
+    # materialized.
+    msg = ingest(
+        endpoint=endpoints.leaguedashlineups.LeagueDashLineups,
+        endpoint_name='lineups',
+        season=season,
+        hint=hint,
+        empty_msg="No lineups found.",
+        row_filters=[('MIN', '>=', 1)],
+        **kwargs
+    )
 
     return msg
 
 
-def get_hustle_stats_team(**kwargs) -> str:
+def get_hustle_stats_team(season: str = None, **kwargs) -> str:
     """
     Get team hustle stats. This function will source data relating to team hustle stats. Stats are per game.
+    Use the season argument for other seasons, e.g. '2019-20', a range like '2019-20:2023-24' or a comma separated
+    list. Defaults to the current season.
     Expected Data:
     - TEAM_ID
     - TEAM_NAME
@@ -201,32 +568,30 @@ def get_hustle_stats_team(**kwargs) -> str:
     """
 
     # Set defaults for required parameters
-    kwargs['season'] = SEASON
     kwargs['per_mode_time'] = 'PerGame'
 
-    # Get the hustle stats
-    data_list, doc_id = get_info(
-        endpoint=endpoints.leaguehustlestatsteam.LeagueHustleStatsTeam,
-        endpoint_name='hustle_stats_team',
-        **kwargs
-    )
-
-    if not data_list:
-        return "No hustle stats found."
-
     hint = ("Some things to consider when looking at hustle stats:\n\n- Deflections are a good indicator of defensive "
             "activity.\n- Charges drawn are a good indicator of defensive positioning.\n- Screen assists are a good "
             "indicator of offensive activity.")
 
-    # Add the hustle stats to the database
-    msg = add_info_to_db(data_list, doc_id, 'hustle_stats_team', hint)
+    # Get the hustle stats and add them to the database
+    msg = ingest(
+        endpoint=endpoints.leaguehustlestatsteam.LeagueHustleStatsTeam,
+        endpoint_name='hustle_stats_team',
+        season=season,
+        hint=hint,
+        empty_msg="No hustle stats found.",
+        **kwargs
+    )
 
     return msg
 
 
-def get_player_clutch_stats(**kwargs) -> str:
+def get_player_clutch_stats(season: str = None, **kwargs) -> str:
     """
     Get player clutch stats. This function will source data relating to clutch performance for players.
+    Use the season argument for other seasons, e.g. '2019-20', a range like '2019-20:2023-24' or a comma separated
+    list. Defaults to the current season.
     Expected Data:
     - GROUP_SET
     - PLAYER_ID
@@ -289,33 +654,30 @@ def get_player_clutch_stats(**kwargs) -> str:
     - PFD_RANK
     - PTS_RANK
     """
-    kwargs['season'] = SEASON
-
-    # Get the player clutch stats
-    data_list, doc_id = get_info(
-        endpoint=endpoints.leaguedashplayerclutch.LeagueDashPlayerClutch,
-        endpoint_name='player_clutch_stats',
-        **kwargs
-    )
-
-    if not data_list:
-        return "No player clutch stats found."
-
     hint = ("Some things to consider when looking at player clutch stats:\n\n- Clutch stats are generally defined as "
             "stats in the last 5 minutes of a game within 5 points.\n- The RANK columns are useful for comparing "
             "players to the rest of the league.\n- You can lookup all players from a team by including the TEAM_ID "
             "in the query.")
 
-    # Add the player clutch stats to the database
-    msg = add_info_to_db(data_list, doc_id, 'player_clutch_stats', hint)
+    # Get the player clutch stats and add them to the database
+    msg = ingest(
+        endpoint=endpoints.leaguedashplayerclutch.LeagueDashPlayerClutch,
+        endpoint_name='player_clutch_stats',
+        season=season,
+        hint=hint,
+        empty_msg="No player clutch stats found.",
+        **kwargs
+    )
 
     return msg
 
 
-def get_player_stats() -> str:
+def get_player_stats(season: str = None) -> str:
     """
     Get player stats. This function will source data relating to player performance stats for all players. This function
     can also be used to get a player's ID to use in other functions.
+    Use the season argument for other seasons, e.g. '2019-20', a range like '2019-20:2023-24' or a comma separated
+    list. Defaults to the current season.
     Expected Data:
     - PLAYER_ID
     - PLAYER_NAME
@@ -350,31 +712,45 @@ def get_player_stats() -> str:
     - DD2
     - TD3
     """
-    kwargs = {
-        'season': SEASON
-    }
+    hint = ("Some things to consider when looking at player stats:\n\n- You can lookup all players from a team by "
+            "including the TEAM_ID in the query.\n- PLUS_MINUS should be used as a general indicator of a player's "
+            "performance.")
 
-    # Get the player stats
-    data_list, doc_id = get_info(
+    # Get the player stats and add them to the database. New snapshots update the name index with players that aren't
+    # in the static list yet.
+    msg = ingest(
         endpoint=endpoints.leaguedashplayerstats.LeagueDashPlayerStats,
         endpoint_name='player_stats',
-        **kwargs
+        season=season,
+        hint=hint,
+        empty_msg="Could not retrieve player stats.",
+        on_new_rows=lambda data_list, fetched_season: add_player_rows(
+            get_name_index(), data_list, is_current_season=fetched_season == SEASON
+        )
     )
 
-    if not data_list:
-        return "Could not retrieve player stats."
+    return msg
 
-    hint = ("Some things to consider when looking at player stats:\n\n- You can lookup all players from a team by "
-            "including the TEAM_ID in the query.\n- PLUS_MINUS should be used as a general indicator of a player's "
-            "performance.")
 
-    # Add the player stats to the database
-    msg = add_info_to_db(data_list, doc_id, 'player_stats', hint)
+def resolve_name(name: str, kind: str = None, limit: int = 5) -> str:
+    """
+    Resolve a player or team name to its ID. Use this to get a PLAYER_ID or TEAM_ID instead of pulling the whole player
+    stats table. Matching ignores case and accents and works with partial names (e.g. "jokic", "lebr", "Celtics",
+    "BOS"). Misspelled names are matched approximately.
+    :param name: The player or team name to look up.
+    :param kind: Set to "player" or "team" to only return that kind of match.
+    :param limit: The most matches to return.
+    """
+
+    results = get_name_index().resolve(name, kind=kind, limit=limit)
 
-    return msg
+    if not results:
+        return f"No players or teams found matching '{name}'."
+
+    return json.dumps(results)
 
 
-def data_lookup(query: str, sort: str = None, limit: int = None) -> str:
+def data_lookup(query: str = None, sort: str = None, limit: int = None, fields: str = None, cursor: str = None) -> str:
     """
     Lookup data in the database. This function is used to retrieve specific document data based on a given document
     ID and query.  All queries should include the id as `doc_id`. Examples:
@@ -388,11 +764,62 @@ def data_lookup(query: str, sort: str = None, limit: int = None) -> str:
     ```
     query = {"doc_id": "0000-1111-2222-3333-4444", "name": "John"}
     ```
+
+    To only return some fields pass them as a comma separated list:
+    ```
+    fields = "PLAYER_NAME,PTS,PLUS_MINUS"
+    ```
+
+    The result is compact JSON with the column names once in `columns` and one list of values per row in `rows`.
+    `total` is the number of matching documents. If they don't all fit in one page the result has a `next_cursor`.
+    Pass it back on its own to get the next page:
+    ```
+    cursor = "eyJxdWVyeSI6..."
+    ```
     """
 
+    if cursor:
+        return doc_lookup(query={}, sort=None, limit=None, cursor=cursor)
+
+    if not query:
+        return "A query or a cursor is required."
+
     query_dict = json.loads(query)
 
-    return doc_lookup(query=query_dict, sort=sort, limit=limit)
+    # Parse the fields
+    field_list = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+
+    return doc_lookup(query=query_dict, sort=sort, limit=limit, fields=field_list)
+
+
+def aggregate_data(spec: str) -> str:
+    """
+    Aggregate data in the database without pulling every row. Use this for rankings, averages and per team or per
+    player summaries instead of doing the math over data_lookup results. The spec is a JSON object with the doc_id, an
+    optional match query, an optional group_by field and the metrics and/or top_k rows to compute. Examples:
+
+    Top 5 lineups by net rating with at least 100 minutes for each team:
+    ```
+    spec = {"doc_id": "0000-1111-2222-3333-4444", "match": {"MIN": {"$gte": 100}}, "group_by": "TEAM_ID",
+            "top_k": {"field": "NET_RATING", "k": 5, "fields": ["GROUP_NAME", "MIN", "NET_RATING"]}}
+    ```
+
+    Average and 90th percentile net rating of every lineup:
+    ```
+    spec = {"doc_id": "0000-1111-2222-3333-4444",
+            "metrics": [{"op": "avg", "field": "NET_RATING"}, {"op": "percentile", "field": "NET_RATING", "p": 0.9}]}
+    ```
+
+    Metric ops are avg, sum, min, max, count and percentile. Groups are sorted by `order_by` (a metric name or count)
+    and cut to `limit`.
+    """
+
+    try:
+        spec_dict = json.loads(spec)
+    except json.JSONDecodeError as e:
+        return f"The spec is not valid JSON. Error: {e}"
+
+    return aggregate_facts(spec_dict)
 
 
 function_map = {
@@ -400,5 +827,7 @@ function_map = {
     "get_hustle_stats_team": get_hustle_stats_team,
     "get_player_clutch_stats": get_player_clutch_stats,
     "get_player_stats": get_player_stats,
-    "data_lookup": data_lookup
+    "resolve_name": resolve_name,
+    "data_lookup": data_lookup,
+    "aggregate_data": aggregate_data
 }
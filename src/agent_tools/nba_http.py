@@ -0,0 +1,253 @@
+"""
+Shared HTTP transport for the nba_api endpoints. Every endpoint call in the process goes through one pooled session
+with a shared token-bucket rate limit and jittered exponential backoff on transient errors. The session can also record
+responses to disk and replay them so the data path can be load tested without network access.
+"""
+
+from settings import (logging, NBA_HTTP_MODE, NBA_HTTP_RECORD_DIR, NBA_HTTP_POOL_SIZE, NBA_RATE_LIMIT,
+                      NBA_RATE_BURST, NBA_MAX_RETRIES, NBA_BACKOFF_BASE, NBA_BACKOFF_MAX)
+from cache_tools import make_cache_key
+from tracing import get_current_span
+from nba_api.stats.library.http import NBAStatsHTTP
+
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import requests
+import threading
+import random
+import time
+import json
+import os
+
+# Status codes that are worth retrying. stats.nba.com answers with these when it is throttling or having a bad moment.
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Tokens are added at `rate` per second up to `capacity` and every request takes one.
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Take a token, waiting until one is available.
+        :return: The number of seconds spent waiting.
+        """
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+
+                wait_time = (1 - self.tokens) / self.rate
+
+            time.sleep(wait_time)
+            waited += wait_time
+
+
+class NBASession(requests.Session):
+    """
+    A requests session for stats.nba.com. It keeps connections alive in a pool, shares a rate limit with every thread in
+    the process and retries transient errors with jittered exponential backoff.
+
+    Modes:
+    - live: Make real requests.
+    - record: Make real requests and save every successful response to the record directory.
+    - replay: Serve responses from the record directory and never touch the network.
+    """
+    def __init__(self, mode: str, record_dir: str, pool_size: int, rate_limiter: TokenBucket, max_retries: int,
+                 backoff_base: float, backoff_max: float):
+        super().__init__()
+        self.mode = mode
+        self.record_dir = record_dir
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # Retries are handled in `request` so turn off the adapter's own retries
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self.retry_count = 0
+        self.replay_count = 0
+        self.rate_limit_wait = 0.0
+
+        if self.mode in ("record", "replay"):
+            os.makedirs(self.record_dir, exist_ok=True)
+
+    def recording_path(self, method: str, url: str, params) -> str:
+        """
+        Get the path of the recording for a request. Headers aren't part of the key since nba_api sets them itself.
+        :param method: The HTTP method.
+        :param url: The URL without the query string.
+        :param params: The query params as a dictionary or a list of pairs.
+        :return: The path of the recording file.
+        """
+
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        elif params:
+            params = sorted(params)
+
+        return os.path.join(self.record_dir, f"{make_cache_key(method.upper(), url, params)}.json")
+
+    def replay(self, method: str, url: str, params) -> requests.Response:
+        """
+        Build a response from a recording.
+        :param method: The HTTP method.
+        :param url: The URL without the query string.
+        :param params: The query params.
+        :return: The recorded response.
+        """
+
+        path = self.recording_path(method, url, params)
+        if not os.path.exists(path):
+            raise requests.ConnectionError(f"No recorded response for {url} with params {params}.")
+
+        with open(path, "r") as recording_file:
+            recording = json.load(recording_file)
+
+        response = requests.Response()
+        response.status_code = recording["status_code"]
+        response.headers = CaseInsensitiveDict(recording["headers"])
+        response.url = recording["url"]
+        response.encoding = "utf-8"
+        response._content = recording["content"].encode("utf-8")
+
+        with self.stats_lock:
+            self.replay_count += 1
+
+        return response
+
+    def record(self, method: str, url: str, params, response: requests.Response) -> None:
+        """
+        Save a response to the record directory.
+        :param method: The HTTP method.
+        :param url: The URL without the query string.
+        :param params: The query params.
+        :param response: The response to save.
+        :return: None
+        """
+
+        recording = {
+            "status_code": response.status_code,
+            "headers": dict(response.headers),
+            "url": response.url,
+            "content": response.text
+        }
+
+        with open(self.recording_path(method, url, params), "w") as recording_file:
+            json.dump(recording, recording_file)
+
+        return
+
+    def backoff(self, attempt: int, response: requests.Response = None) -> None:
+        """
+        Sleep before the next attempt. Uses the Retry-After header if the server sent one, otherwise full jitter
+        exponential backoff.
+        :param attempt: The attempt that just failed, starting at 0.
+        :param response: The failed response if there was one.
+        :return: None
+        """
+
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            sleep_time = min(float(retry_after), self.backoff_max)
+        else:
+            sleep_time = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+        logging.info(f"Retrying NBA API request in {round(sleep_time, 2)}s (attempt {attempt + 1}).")
+        time.sleep(sleep_time)
+
+        return
+
+    def request(self, method, url, params=None, **kwargs) -> requests.Response:
+        if self.mode == "replay":
+            return self.replay(method, url, params)
+
+        attempt = 0
+        while True:
+            waited = self.rate_limiter.acquire()
+            with self.stats_lock:
+                self.request_count += 1
+                self.rate_limit_wait += waited
+            get_current_span().add("rate_limit_wait_s", waited)
+
+            try:
+                response = super().request(method, url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f"NBA API request failed. Error: {e}")
+                self.backoff(attempt)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    if self.mode == "record" and response.status_code == 200:
+                        self.record(method, url, params, response)
+                    get_current_span().add("response_bytes", len(response.content))
+                    return response
+                logging.warning(f"NBA API request returned {response.status_code}.")
+                self.backoff(attempt, response)
+
+            attempt += 1
+            with self.stats_lock:
+                self.retry_count += 1
+            get_current_span().add("retries")
+
+    def stats(self) -> dict:
+        """
+        Get the request counters for the session.
+        :return: The counters.
+        """
+
+        with self.stats_lock:
+            return {
+                "mode": self.mode,
+                "requests": self.request_count,
+                "retries": self.retry_count,
+                "replays": self.replay_count,
+                "rate_limit_wait": round(self.rate_limit_wait, 3)
+            }
+
+
+# The one session shared by every endpoint call in the process
+nba_session = NBASession(
+    mode=NBA_HTTP_MODE,
+    record_dir=NBA_HTTP_RECORD_DIR,
+    pool_size=NBA_HTTP_POOL_SIZE,
+    rate_limiter=TokenBucket(rate=NBA_RATE_LIMIT, capacity=NBA_RATE_BURST),
+    max_retries=NBA_MAX_RETRIES,
+    backoff_base=NBA_BACKOFF_BASE,
+    backoff_max=NBA_BACKOFF_MAX
+)
+
+
+def install_transport() -> None:
+    """
+    Make nba_api use the shared session for every endpoint call.
+    :return: None
+    """
+
+    if hasattr(NBAStatsHTTP, "set_session"):
+        NBAStatsHTTP.set_session(nba_session)
+    else:
+        NBAStatsHTTP._session = nba_session
+
+    logging.info(f"NBA API transport installed in {NBA_HTTP_MODE} mode.")
+    return
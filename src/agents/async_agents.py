@@ -0,0 +1,1002 @@
+"""
+The agent. It is built on the async OpenAI client so one worker can interleave many conversations on a single event
+loop. The blocking parts, the tool functions and the DB writes, run on threads so they never block the loop. Blocking
+code uses it through agents.agents.Agent, which runs it on the agent loop.
+"""
+
+from settings import (logging, openai, AGENT_TOOL_WORKERS, AGENT_TOOL_EXECUTOR_WORKERS, AGENT_RUN_STREAMING,
+                      RUN_POLL_INITIAL, RUN_POLL_BACKOFF, RUN_POLL_MAX, LLM_CACHE_ENABLED, LLM_CACHE_TTL,
+                      LLM_CACHE_MAX_ENTRIES, LLM_CACHE_SHARED, AGENT_THREAD_TOKEN_BUDGET, COMPACT_MIN_TOKENS)
+from db_tools import add_to_convo as add_it_to_convo, find_assistant, register_assistant
+from cache_tools import ResponseCache, make_cache_key
+from agents.openai_client import (get_async_openai_client, close_async_openai_client, openai_pool_stats,
+                                  fake_openai_backend)
+from agents.compaction import FETCH_OUTPUT_TOOL, estimate_tokens, compact_text, fetch_output
+from tracing import span, get_current_span, record_usage, in_context
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+import asyncio
+import httpx
+import atexit
+import time
+import json
+
+# The tool functions are blocking (nba_api, Mongo, pandas) so every async agent in the process runs them here. The pool
+# bounds the tool calls in flight across all conversations.
+tool_executor = ThreadPoolExecutor(max_workers=AGENT_TOOL_EXECUTOR_WORKERS, thread_name_prefix="agent-tool")
+
+# Run statuses that end a run without a response
+TERMINAL_RUN_STATUSES = ("failed", "cancelled", "expired", "incomplete")
+
+# Run statuses of a run that is still going
+ACTIVE_RUN_STATUSES = ("queued", "in_progress", "requires_action", "cancelling")
+
+# The errors of a broken run stream. The run itself may still be going so it is picked up by polling.
+STREAM_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, httpx.TransportError)
+
+# Assistant IDs by definition hash for every assistant this process has used. Warm conversations get their assistant
+# from here without a DB or OpenAI call.
+assistant_ids = {}
+assistant_ids_lock = threading.Lock()
+
+# Replies to one off messages. The same question with the same tools gets the same extrapolated query so repeated
+# questions skip the completion.
+llm_cache = ResponseCache(
+    name="llm",
+    max_entries=LLM_CACHE_MAX_ENTRIES,
+    default_ttl=LLM_CACHE_TTL,
+    collection="swarm_llm_cache" if LLM_CACHE_SHARED else None
+)
+
+# The model one off messages are sent to
+ONE_OFF_MODEL = "gpt-4o"
+
+
+def llm_cache_key(model: str, instructions: str, prompt: str) -> str:
+    """
+    Build the cache key for a one off message. Whitespace and case in the prompt don't change the key.
+    :param model: The model.
+    :param instructions: The system instructions.
+    :param prompt: The prompt.
+    :return: The cache key.
+    """
+
+    normalized_prompt = " ".join(prompt.split()).casefold()
+
+    return make_cache_key("one_off", model, instructions, normalized_prompt)
+
+
+def compaction_note(planned: list) -> str:
+    """
+    Build the note that replaces compacted messages in a thread. It is added as a user message, so it says that it is
+    context and not a new request.
+    :param planned: The pairs from AsyncAgent.plan_message_compaction.
+    :return: The note.
+    """
+
+    return (
+        "[Conversation context, not a new request. Earlier messages of this conversation were compacted to keep it "
+        "short. Their digests follow in the order they were sent.]\n\n"
+        + "\n\n".join(f"{message['role']}: {replacement}" for message, replacement in planned)
+    )
+
+
+# The event loop every conversation in the process runs on. It lives for the whole process so its async OpenAI client
+# and connection pool are shared by every conversation.
+agent_loop = None
+agent_loop_thread = None
+agent_loop_lock = threading.Lock()
+
+
+def get_agent_loop() -> asyncio.AbstractEventLoop:
+    """
+    Get the event loop the conversations run on. It is started on a background thread the first time it is needed.
+    :return: The loop.
+    """
+
+    global agent_loop, agent_loop_thread
+
+    with agent_loop_lock:
+        if agent_loop is None:
+            agent_loop = asyncio.new_event_loop()
+            agent_loop_thread = threading.Thread(target=agent_loop.run_forever, name="agent-loop", daemon=True)
+            agent_loop_thread.start()
+            atexit.register(stop_agent_loop)
+
+    return agent_loop
+
+
+def run_on_agent_loop(coroutine):
+    """
+    Run a coroutine on the agent loop and wait for it. This is how blocking code starts a conversation.
+    :param coroutine: The coroutine.
+    :return: The result of the coroutine.
+    """
+
+    loop = get_agent_loop()
+    # Waiting on the loop from the loop's own thread would never return
+    if threading.current_thread() is agent_loop_thread:
+        coroutine.close()
+        raise RuntimeError("run_on_agent_loop was called from the agent loop. Await the coroutine instead.")
+
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def stop_agent_loop() -> None:
+    """
+    Close the agent loop's OpenAI client and stop the loop.
+    :return: None
+    """
+
+    global agent_loop
+
+    with agent_loop_lock:
+        loop = agent_loop
+        agent_loop = None
+
+    if loop is None:
+        return
+
+    try:
+        asyncio.run_coroutine_threadsafe(close_async_openai_client(), loop).result(timeout=10)
+    except Exception as e:
+        logging.warning(f"Failed to close the async OpenAI client. Error: {e}")
+    loop.call_soon_threadsafe(loop.stop)
+    agent_loop_thread.join(timeout=10)
+
+    return
+
+
+class AsyncAgent:
+    """
+    An agent that talks to the LLM through an OpenAI assistant. For now it is just using OpenAI but will be expanded to
+    include Anthropic and Google. Its OpenAI calls are awaited instead of blocking. Create it with
+    `await AsyncAgent.create(...)`.
+    """
+    def __init__(
+            self,
+            name: str,
+            instructions: str,
+            model: str,
+            tools: list,
+            main_thread_id: str,
+            function_map: dict = None,
+            max_tool_workers: int = None
+    ):
+        self.name = name
+        self.instructions = instructions
+        self.model = model
+        self.tools = tools
+        self.main_thread_id = main_thread_id
+        self.function_map = function_map
+
+        # With compaction on the agent can read the pieces that were compacted out of its thread
+        if AGENT_THREAD_TOKEN_BUDGET:
+            self.tools = tools + [FETCH_OUTPUT_TOOL]
+            self.function_map = {**(function_map or {}), "fetch_output": fetch_output}
+
+        # The number of tool calls from a single requires_action that can run at the same time
+        self.max_tool_workers = max_tool_workers if max_tool_workers else AGENT_TOOL_WORKERS
+        # The timing of every tool call this agent has made
+        self.tool_timings = []
+        # The time it took to see every run state change, measured from the last time the agent acted on the run
+        self.run_timings = []
+        # The run the agent is waiting on, so polling can pick up a run if its stream breaks
+        self.active_run_id = None
+        # Tool outputs that were computed but not submitted because the stream broke, so polling doesn't run them again
+        self.pending_tool_outputs = None
+        # The newest thread message the agent has seen, so replies are fetched without listing the whole thread
+        self.last_message_id = None
+        # The number and size of the messages fetched after every run
+        self.message_fetches = []
+        # The estimated tokens the agent has put in its thread and the messages that can still be compacted. Submitted
+        # tool outputs and compaction notes count towards the tokens but can't be compacted.
+        self.thread_tokens = 0
+        self.thread_messages = []
+        # The tokens every run used and the thread's tokens before and after it was compacted
+        self.run_tokens = []
+        self.last_run_usage = None
+
+        self.response_msg = None
+        # The assistant and thread need the event loop so they are set up in start
+        self.id = None
+        self.thread_id = None
+
+    @classmethod
+    async def create(cls, *args, **kwargs) -> "AsyncAgent":
+        """
+        Create the agent and get its assistant and thread.
+        :return: The agent.
+        """
+
+        agent = cls(*args, **kwargs)
+        await agent.start()
+
+        return agent
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        # The async client belongs to the running event loop
+        return get_async_openai_client()
+
+    async def start(self) -> None:
+        """
+        Get the assistant and a thread for the agent.
+        :return: None
+        """
+
+        self.id = await self.get_assistant()
+        thread = await self.client.beta.threads.create()
+        self.thread_id = thread.id
+
+        return
+
+    def definition_hash(self) -> str:
+        """
+        Hash the parts of the agent that define its assistant. A change to any of them needs a new assistant.
+        :return: The hash.
+        """
+
+        return make_cache_key("assistant", self.name, self.instructions, self.model, self.tools)
+
+    async def get_assistant(self) -> str:
+        """
+        Get the assistant for this agent's definition. The assistant is looked up in process, then in the assistant
+        registry and is only created if the definition has never been seen.
+        :return: The assistant ID.
+        """
+
+        definition_hash = self.definition_hash()
+
+        # The fake API keeps its own registry so its assistants never end up in swarm_assistants
+        backend = fake_openai_backend()
+        if backend is not None:
+            return backend.assistant_for(definition_hash, self.name, self.instructions, tools=self.tools,
+                                         model=self.model)
+
+        with assistant_ids_lock:
+            if definition_hash in assistant_ids:
+                return assistant_ids[definition_hash]
+
+        entry = await asyncio.to_thread(find_assistant, definition_hash)
+        replace = False
+        if entry:
+            try:
+                # Make sure nobody deleted the assistant on OpenAI. This only happens once per process.
+                await self.client.beta.assistants.retrieve(entry["assistant_id"])
+                logging.info(f"Reusing assistant {entry['assistant_id']} for {self.name}.")
+            except openai.NotFoundError:
+                logging.warning(f"Assistant {entry['assistant_id']} for {self.name} is gone. Creating a new one.")
+                entry = None
+                replace = True
+
+        if not entry:
+            assistant = await self.client.beta.assistants.create(
+                name=self.name,
+                instructions=self.instructions,
+                tools=self.tools,
+                model=self.model
+            )
+            entry = await asyncio.to_thread(
+                register_assistant,
+                {
+                    "_id": definition_hash,
+                    "assistant_id": assistant.id,
+                    "name": self.name,
+                    "model": self.model,
+                    "createdAt": datetime.utcnow(),
+                    "lastUsedAt": datetime.utcnow()
+                },
+                replace
+            )
+            # Another worker or conversation registered an assistant for this definition first so use theirs
+            if entry["assistant_id"] != assistant.id:
+                await self.client.beta.assistants.delete(assistant.id)
+
+        with assistant_ids_lock:
+            assistant_ids[definition_hash] = entry["assistant_id"]
+
+        return entry["assistant_id"]
+
+    def add_to_convo(self, response_msg: str | list, msg_type: str, from_agent: str, to_agent: str = None) -> bool:
+        """
+        Add a message to the conversation in the database.
+        :param response_msg: The message to add.
+        :param msg_type: The type of message to add.
+        :param from_agent: The agent that the message is from.
+        :param to_agent: The agent that the message is to.
+        :return:
+        """
+
+        msg_dict = {
+            "message": response_msg,
+            "from_agent": from_agent,
+            "to_agent": self.name if to_agent is None else to_agent,
+            "msg_type": msg_type
+        }
+
+        return add_it_to_convo(main_thread_id=self.main_thread_id, msg_dict=msg_dict)
+
+    async def add_to_convo_async(self, response_msg: str | list, msg_type: str, from_agent: str,
+                                 to_agent: str = None) -> bool:
+        """
+        Add a message to the conversation in the database without blocking the loop.
+        :param response_msg: The message to add.
+        :param msg_type: The type of message to add.
+        :param from_agent: The agent that the message is from.
+        :param to_agent: The agent that the message is to.
+        :return: If the message was added.
+        """
+
+        return await asyncio.to_thread(self.add_to_convo, response_msg, msg_type, from_agent, to_agent)
+
+    async def add_message(self, message: str, as_agent: bool = False) -> None:
+        """
+        Add a message to the thread.
+        :param message: The message to add.
+        :param as_agent: If the message is from the agent.
+        :return: None
+        """
+
+        logging.info(f"Adding message to thread.")
+
+        thread_message = await self.client.beta.threads.messages.create(
+            thread_id=self.thread_id,
+            role="user" if not as_agent else "assistant",
+            content=message
+        )
+        self.last_message_id = thread_message.id
+        self.track_message(thread_message.id, "user" if not as_agent else "assistant", message)
+
+        await self.add_to_convo_async(response_msg=message, msg_type="message", from_agent="system")
+
+        return
+
+    def track_message(self, message_id: str, role: str, text: str) -> None:
+        """
+        Count a thread message towards the thread's tokens and remember it so it can be compacted later.
+        :param message_id: The message ID.
+        :param role: The role of the message.
+        :param text: The text of the message.
+        :return: None
+        """
+
+        tokens = estimate_tokens(text)
+        self.thread_tokens += tokens
+        self.thread_messages.append({"id": message_id, "role": role, "text": text, "tokens": tokens})
+
+        return
+
+    def track_run_usage(self, run) -> None:
+        """
+        Record the token usage of a run. The API only sets it once the run has ended.
+        :param run: The run.
+        :return: None
+        """
+
+        record_usage(run.usage)
+        if run.usage is not None:
+            self.last_run_usage = run.usage
+
+        return
+
+    def compact_tool_outputs(self, required_action: list, tools_output: list) -> list:
+        """
+        Replace the large tool outputs that would take the thread over its token budget with a digest. Tool outputs
+        can't be changed once they are submitted so this is their only chance to be compacted. fetch_output is never
+        compacted since the agent asked for the full piece.
+        :param required_action: The tool calls from the run's required action.
+        :param tools_output: The tool outputs in the same order.
+        :return: The tool outputs to submit.
+        """
+
+        compacted_outputs = []
+        for action, tool_output in zip(required_action, tools_output):
+            func_name = action.function.name
+            output = str(tool_output["output"])
+            tokens = estimate_tokens(output)
+
+            if (AGENT_THREAD_TOKEN_BUDGET and tokens >= COMPACT_MIN_TOKENS and func_name != "fetch_output"
+                    and self.thread_tokens + tokens > AGENT_THREAD_TOKEN_BUDGET):
+                replacement = compact_text(self.main_thread_id, self.name, f"{func_name} output", output)
+                if replacement:
+                    compacted_tokens = estimate_tokens(replacement)
+                    logging.info(f"Compacted {func_name} output from {tokens} to {compacted_tokens} tokens.")
+                    tool_output = {**tool_output, "output": replacement}
+                    tokens = compacted_tokens
+
+            self.thread_tokens += tokens
+            compacted_outputs.append(tool_output)
+
+        return compacted_outputs
+
+    def plan_message_compaction(self) -> list:
+        """
+        Archive the oldest large messages until the messages that can be compacted are back under the thread's token
+        budget. Only they are counted since compacting can't make the rest any smaller. The last two messages are kept
+        since the next run builds on them.
+        :return: Pairs of the compacted message and the digest that replaces it.
+        """
+
+        compactable_tokens = sum(message["tokens"] for message in self.thread_messages)
+        if not AGENT_THREAD_TOKEN_BUDGET or compactable_tokens <= AGENT_THREAD_TOKEN_BUDGET:
+            return []
+
+        planned = []
+        for message in self.thread_messages[:-2]:
+            if compactable_tokens <= AGENT_THREAD_TOKEN_BUDGET:
+                break
+            if message["tokens"] < COMPACT_MIN_TOKENS:
+                continue
+
+            replacement = compact_text(self.main_thread_id, self.name, f"{message['role']} message", message["text"])
+            if replacement:
+                planned.append((message, replacement))
+                compactable_tokens -= message["tokens"]
+
+        return planned
+
+    def messages_after_compaction(self, planned: list) -> list:
+        """
+        Get the messages that were kept but come after the first compacted one. The API only adds messages at the end
+        of a thread, so these are moved behind the note to keep the note where the compacted messages were.
+        :param planned: The pairs from plan_message_compaction.
+        :return: The messages to move.
+        """
+
+        compacted_ids = [message["id"] for message, _ in planned]
+        first_index = next(
+            index for index, message in enumerate(self.thread_messages) if message["id"] in compacted_ids
+        )
+
+        return [message for message in self.thread_messages[first_index:] if message["id"] not in compacted_ids]
+
+    def apply_message_compaction(self, planned: list, note_id: str, note: str, moved: list) -> None:
+        """
+        Update the thread's tokens and messages after the compacted messages were deleted, the note that replaces them
+        was added and the messages after them were moved behind it.
+        :param planned: The pairs from plan_message_compaction.
+        :param note_id: The message ID of the note.
+        :param note: The note.
+        :param moved: Pairs of a moved message and its new message ID.
+        :return: None
+        """
+
+        removed_ids = [message["id"] for message, _ in planned] + [message["id"] for message, _ in moved]
+        self.thread_tokens -= sum(message["tokens"] for message, _ in planned)
+        self.thread_tokens += estimate_tokens(note)
+        self.thread_messages = [message for message in self.thread_messages if message["id"] not in removed_ids]
+        self.thread_messages += [{**message, "id": message_id} for message, message_id in moved]
+        self.last_message_id = moved[-1][1] if moved else note_id
+        logging.info(f"Compacted {len(planned)} messages. The thread is now about {self.thread_tokens} tokens.")
+
+        return
+
+    async def compact_messages(self) -> None:
+        """
+        Replace the messages picked by plan_message_compaction with one note of their digests. Only call this between
+        runs.
+        :return: None
+        """
+
+        planned = await asyncio.to_thread(self.plan_message_compaction)
+        if not planned:
+            return
+
+        to_move = self.messages_after_compaction(planned)
+        await asyncio.gather(*[
+            self.client.beta.threads.messages.delete(message_id=message["id"], thread_id=self.thread_id)
+            for message in [message for message, _ in planned] + to_move
+        ])
+
+        note = compaction_note(planned)
+        note_message = await self.client.beta.threads.messages.create(
+            thread_id=self.thread_id,
+            role="user",
+            content=note
+        )
+
+        # One at a time so the moved messages keep their order
+        moved = []
+        for message in to_move:
+            moved_message = await self.client.beta.threads.messages.create(
+                thread_id=self.thread_id,
+                role=message["role"],
+                content=message["text"]
+            )
+            moved.append((message, moved_message.id))
+
+        self.apply_message_compaction(planned, note_message.id, note, moved)
+
+        return
+
+    def record_run_tokens(self, thread_tokens_before: int) -> None:
+        """
+        Record the tokens of the run that just finished and of the thread before and after it was compacted.
+        :param thread_tokens_before: The thread's estimated tokens before compaction.
+        :return: None
+        """
+
+        usage = self.last_run_usage
+        run_tokens = {
+            "run_id": self.active_run_id,
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None),
+            "thread_tokens_before": thread_tokens_before,
+            "thread_tokens_after": self.thread_tokens
+        }
+        self.run_tokens.append(run_tokens)
+        get_current_span().set("thread_tokens_before", thread_tokens_before)
+        get_current_span().set("thread_tokens_after", self.thread_tokens)
+        logging.info(
+            f"Run {run_tokens['run_id']} used {run_tokens['prompt_tokens']} prompt tokens. The thread went from about "
+            f"{thread_tokens_before} to {self.thread_tokens} tokens."
+        )
+
+        return
+
+    def message_list_options(self, run_id: str = None) -> dict:
+        """
+        Get the options for listing only the messages of a run. The messages come oldest first and start after the
+        newest message the agent has already seen, so the cost of a fetch doesn't grow with the thread.
+        :param run_id: The run that just completed.
+        :return: The options for messages.list.
+        """
+
+        list_options = {"thread_id": self.thread_id, "order": "asc", "limit": 20}
+        if run_id:
+            list_options["run_id"] = run_id
+        if self.last_message_id:
+            list_options["after"] = self.last_message_id
+
+        return list_options
+
+    def read_reply(self, messages: list, run_id: str = None) -> str | None:
+        """
+        Get the assistant's reply from the messages of a run and record the size of the fetch.
+        :param messages: The messages, oldest first.
+        :param run_id: The run that just completed.
+        :return: The text of the assistant's last message or None if it didn't send one.
+        """
+
+        payload_bytes = sum(
+            len(message.model_dump_json()) if hasattr(message, "model_dump_json") else len(str(message))
+            for message in messages
+        )
+        self.message_fetches.append({"run_id": run_id, "messages": len(messages), "bytes": payload_bytes})
+        get_current_span().set("payload_bytes", payload_bytes)
+        logging.info(f"Fetched {len(messages)} messages ({payload_bytes} bytes) for run {run_id}.")
+
+        if messages:
+            self.last_message_id = messages[-1].id
+
+        response_msg = None
+        for message in messages:
+            if message.assistant_id == self.id:
+                texts = [response.text.value for response in message.content if response.type == "text"]
+                if texts:
+                    response_msg = texts[-1]
+                    self.track_message(message.id, "assistant", "".join(texts))
+
+        if response_msg is not None:
+            logging.info(f"Message ({self.thread_id}): {response_msg}")
+
+        return response_msg
+
+    async def get_message_content(self, run_id: str = None) -> str:
+        """
+        Get the content of a message after a run. Only the messages added since the last fetch are listed.
+        :param run_id: The run that just completed.
+        :return: The content of the message sent by the assistant.
+        """
+
+        with span("agent.get_message_content", agent=self.name):
+            messages = [message async for message in self.client.beta.threads.messages.list(
+                **self.message_list_options(run_id)
+            )]
+
+            return self.read_reply(messages, run_id)
+
+    def call_tool(self, action) -> dict:
+        """
+        Call the function for a single tool call.
+        :param action: The tool call from the run's required action.
+        :return: The tool output to submit to the run.
+        """
+
+        func_name = action.function.name
+        arguements = json.loads(action.function.arguments)
+        start_time = time.perf_counter()
+        with span(f"tool.{func_name}", agent=self.name) as tool_span:
+            try:
+                # This is where we call the function with the arguments
+                output = self.function_map[func_name](**arguements)
+                logging.info(f"Function {func_name} successful. Response to assistant: {output}")
+            except TypeError as e:
+                if 'multi_tool_use.parallel' in str(e):
+                    # Sometimes the assistant will hallucinate and call parallel fucntions with
+                    # 'multi_tool_use.parallel' in the name. If this happens we need to send back an error and
+                    # tell the assistant to try again.
+                    logging.info(
+                        f"Received 'multi_tool_use.parallel' hallucination. Sending error to assistant.")
+                    message = "Please ignore any 'multi_tool_use.parallel' functions. They are not real. " \
+                              "Simply send the functions in an array. Please try again."
+                    output = json.dumps({"status": "error", "msg": message})
+                else:
+                    output = json.dumps({"status": "error", "msg": "Function not found."})
+                    logging.error(f"Function {func_name} failed. Response to assistant: {output}")
+                    logging.error(f"Error: {e}")
+
+            tool_span.set("payload_bytes", len(str(output).encode("utf-8")))
+
+        call_time = time.perf_counter() - start_time
+        logging.info(f"Function {func_name} took {round(call_time, 2)}s.")
+        self.tool_timings.append(
+            {
+                "tool_call_id": action.id,
+                "function": func_name,
+                "seconds": call_time
+            }
+        )
+
+        return {
+            "tool_call_id": action.id,
+            "output": output
+        }
+
+    async def run_tools(self, required_action: list) -> list:
+        """
+        Run all of the tool calls from a single requires_action on the tool executor. At most max_tool_workers of this
+        agent's calls run at the same time.
+        :param required_action: The tool calls from the run's required action.
+        :return: The tool outputs in the same order as the tool calls.
+        """
+
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_tool_workers)
+
+        async def call_tool(action) -> dict:
+            async with slots:
+                # run_in_executor doesn't copy the context so the tool span would lose its conversation
+                return await loop.run_in_executor(tool_executor, in_context(self.call_tool), action)
+
+        start_time = time.perf_counter()
+        # gather returns the results in the order of the tool calls, not the order they finish in
+        tools_output = await asyncio.gather(*[call_tool(action) for action in required_action])
+        logging.info(f"Ran {len(required_action)} tools in {round(time.perf_counter() - start_time, 2)}s.")
+
+        return list(tools_output)
+
+    def record_transition(self, run_id: str, status: str, mode: str, waited_since: float,
+                          detect_lag: float = 0.0) -> None:
+        """
+        Record the time it took to see a run state change.
+        :param run_id: The run ID.
+        :param status: The new status of the run.
+        :param mode: "stream" or "poll".
+        :param waited_since: The perf_counter time the agent last acted on the run (created it or submitted tool
+        outputs).
+        :param detect_lag: The most time that could have passed between the change and seeing it. This is the last
+        poll interval when polling and 0 when streaming.
+        :return: None
+        """
+
+        seconds = time.perf_counter() - waited_since
+        logging.info(f"Run {run_id} is {status} after {round(seconds, 2)}s ({mode}, detect lag <= {detect_lag}s).")
+        self.run_timings.append(
+            {
+                "run_id": run_id,
+                "status": status,
+                "mode": mode,
+                "seconds": seconds,
+                "max_detect_lag": detect_lag
+            }
+        )
+
+        return
+
+    async def handle_required_action(self, run) -> list:
+        """
+        Run the tool calls a run is waiting on and add them to the convo.
+        :param run: The run with status requires_action.
+        :return: The tool outputs to submit to the run.
+        """
+
+        required_action = run.required_action.submit_tool_outputs.tool_calls
+        logging.info(f"Tools request: {required_action}")
+        # Add the function call to the convo in the database
+        func_call = [{act.function.name: json.loads(act.function.arguments)} for act in required_action]
+        await self.add_to_convo_async(response_msg=func_call, msg_type="function_call", from_agent=self.name)
+        tools_output = await self.run_tools(required_action)
+
+        logging.info(f"Adding Func responses to DB.")
+        await self.add_to_convo_async(response_msg=tools_output, msg_type="function_response", from_agent=self.name)
+
+        # The convo keeps the full outputs. The thread may get digests of them, which are archived off the loop.
+        return await asyncio.to_thread(self.compact_tool_outputs, required_action, tools_output)
+
+    async def finish_run(self, run_id: str = None) -> str:
+        """
+        Get the response of a completed run and add it to the convo.
+        :param run_id: The run that completed.
+        :return: The response message from the assistant.
+        """
+
+        response_msg = await self.get_message_content(run_id)
+        await self.add_to_convo_async(response_msg, msg_type="message", from_agent=self.name, to_agent="system")
+        self.response_msg = response_msg
+
+        return response_msg
+
+    async def fail_run(self, run) -> str:
+        """
+        Handle a run that ended without a response.
+        :param run: The run with a terminal status.
+        :return: A message saying why the run ended.
+        """
+
+        if run.status == "incomplete" and run.incomplete_details:
+            reason = run.incomplete_details.reason
+        elif run.last_error:
+            reason = run.last_error.message
+        else:
+            reason = "unknown"
+
+        message = f"The run ended with status {run.status}. Reason: {reason}"
+        logging.error(f"Run {run.id}: {message}")
+        await self.add_to_convo_async(message, msg_type="error", from_agent=self.name, to_agent="system")
+
+        return message
+
+    async def stream_run(self) -> tuple[bool, str | None]:
+        """
+        Create a run and follow its event stream. Tool calls are run as soon as the run asks for them and the
+        response is read as soon as the run completes.
+        :return: If the run finished on the stream and the response. If it didn't finish the run should be polled.
+        """
+
+        stream_manager = self.client.beta.threads.runs.stream(thread_id=self.thread_id, assistant_id=self.id)
+        waited_since = time.perf_counter()
+
+        while stream_manager is not None:
+            required_run = None
+            ended_run = None
+            try:
+                async with stream_manager as stream:
+                    async for event in stream:
+                        # Only the run events change the state of the run. Steps and message deltas are skipped.
+                        if not event.event.startswith("thread.run.") or event.event.startswith("thread.run.step."):
+                            continue
+
+                        run = event.data
+                        self.active_run_id = run.id
+                        # A run event on the submit stream means the tool outputs were accepted
+                        self.pending_tool_outputs = None
+                        self.record_transition(run.id, run.status, "stream", waited_since)
+                        self.track_run_usage(run)
+
+                        if run.status == "requires_action":
+                            required_run = run
+                            break
+                        if run.status == "completed" or run.status in TERMINAL_RUN_STATUSES:
+                            ended_run = run
+                            break
+            except STREAM_ERRORS as e:
+                logging.warning(f"The stream of run {self.active_run_id} broke. Falling back to polling. Error: {e}")
+                return False, None
+
+            # The stream holds a pool slot until it is closed so the run is only finished once the stream is left
+            if ended_run is not None:
+                if ended_run.status == "completed":
+                    return True, await self.finish_run(ended_run.id)
+                return True, await self.fail_run(ended_run)
+
+            if required_run is None:
+                logging.warning(f"The stream of run {self.active_run_id} ended before the run finished.")
+                return False, None
+
+            tools_output = await self.handle_required_action(required_run)
+            self.pending_tool_outputs = tools_output
+            logging.info(f"Submitting output to run.")
+            stream_manager = self.client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=self.thread_id,
+                run_id=required_run.id,
+                tool_outputs=tools_output
+            )
+            waited_since = time.perf_counter()
+
+        return False, None
+
+    def take_pending_tool_outputs(self, run) -> list | None:
+        """
+        Get the tool outputs the stream computed but couldn't submit, if the run is still waiting on those tool calls.
+        :param run: The run with status requires_action.
+        :return: The tool outputs to submit or None if the tools have to be run.
+        """
+
+        pending = self.pending_tool_outputs
+        self.pending_tool_outputs = None
+        if pending is None:
+            return None
+
+        tool_call_ids = [action.id for action in run.required_action.submit_tool_outputs.tool_calls]
+        if [tool_output["tool_call_id"] for tool_output in pending] != tool_call_ids:
+            return None
+
+        logging.info(f"Submitting the tool outputs the stream couldn't submit to run {run.id}.")
+
+        return pending
+
+    async def get_active_run(self):
+        """
+        Get the run a broken stream left behind. If the stream broke before its first event the run may have been
+        started anyway, so the thread's newest run is picked up if it is still going. A thread can only have one active
+        run so a new one can't be created next to it.
+        :return: The run or None if there is no run to pick up.
+        """
+
+        if self.active_run_id:
+            return await self.client.beta.threads.runs.retrieve(
+                thread_id=self.thread_id,
+                run_id=self.active_run_id
+            )
+
+        async for run in self.client.beta.threads.runs.list(thread_id=self.thread_id, order="desc", limit=1):
+            if run.status in ACTIVE_RUN_STATUSES:
+                logging.info(f"Picking up run {run.id} that the broken stream started.")
+                self.active_run_id = run.id
+                return run
+            break
+
+        return None
+
+    async def poll_run(self, run) -> str:
+        """
+        Poll a run until it finishes. Polling starts every RUN_POLL_INITIAL seconds and backs off to RUN_POLL_MAX so
+        short runs are seen quickly without polling long runs too often. The backoff starts over after tool outputs are
+        submitted. The loop is free while waiting.
+        :param run: The run.
+        :return: The response message from the assistant.
+        """
+
+        logging.info(f"Polling run: {run.id}")
+        status = None
+        waited_since = time.perf_counter()
+        poll_interval = RUN_POLL_INITIAL
+        last_sleep = 0.0
+
+        while True:
+            if run.status != status:
+                status = run.status
+                self.record_transition(run.id, status, "poll", waited_since, last_sleep)
+                self.track_run_usage(run)
+
+            if run.status == 'requires_action':
+                tools_output = self.take_pending_tool_outputs(run)
+                if tools_output is None:
+                    tools_output = await self.handle_required_action(run)
+                logging.info(f"Submitting output to run.")
+                run = await self.client.beta.threads.runs.submit_tool_outputs(
+                    thread_id=self.thread_id,
+                    run_id=run.id,
+                    tool_outputs=tools_output
+                )
+                waited_since = time.perf_counter()
+                poll_interval = RUN_POLL_INITIAL
+                last_sleep = 0.0
+                continue
+
+            if run.status == 'completed':
+                return await self.finish_run(run.id)
+
+            if run.status in TERMINAL_RUN_STATUSES:
+                return await self.fail_run(run)
+
+            await asyncio.sleep(poll_interval)
+            get_current_span().add("polls")
+            last_sleep = poll_interval
+            poll_interval = min(poll_interval * RUN_POLL_BACKOFF, RUN_POLL_MAX)
+            run = await self.client.beta.threads.runs.retrieve(
+                thread_id=self.thread_id,
+                run_id=run.id
+            )
+
+    async def do_run(self) -> str:
+        """
+        Create a run in a thread and wait for it to finish. The run event stream is used when it is on and the run is
+        polled otherwise, or if the stream breaks.
+        :return: The response message from the assistant.
+        """
+
+        logging.info(f"Call to do run in thread: {self.thread_id}")
+
+        with span("agent.run", agent=self.name) as run_span:
+            start_time = time.perf_counter()
+            timings_start = len(self.run_timings)
+            self.active_run_id = None
+            self.pending_tool_outputs = None
+            self.last_run_usage = None
+
+            finished = False
+            response_msg = None
+            run = None
+            if AGENT_RUN_STREAMING:
+                # Only a broken stream falls back to polling. Errors from the tools or the DB are raised.
+                finished, response_msg = await self.stream_run()
+                if not finished:
+                    run = await self.get_active_run()
+
+            if not finished:
+                if run is None:
+                    run = await self.client.beta.threads.runs.create(
+                        thread_id=self.thread_id,
+                        assistant_id=self.id
+                    )
+                response_msg = await self.poll_run(run)
+
+            run_timings = self.run_timings[timings_start:]
+            logging.info(
+                f"Run finished in {round(time.perf_counter() - start_time, 2)}s with {len(run_timings)} state changes "
+                f"and at most {round(sum(timing['max_detect_lag'] for timing in run_timings), 2)}s of detect lag."
+            )
+            logging.info(f"OpenAI pool: {openai_pool_stats()}")
+            run_span.set("state_changes", len(run_timings))
+            run_span.set("streamed", finished)
+
+            thread_tokens_before = self.thread_tokens
+            await self.compact_messages()
+            self.record_run_tokens(thread_tokens_before)
+
+        return response_msg
+
+    async def one_off_message(self, message: str) -> str:
+        """
+        Send a one off message to the gpt-4o using chat completion.
+        :param message: The message to send.
+        :return: The response from the assistant.
+        """
+
+        logging.info(f"Sending one off message to GPT-4o.")
+
+        await self.add_to_convo_async(response_msg=message, msg_type="message", from_agent="system", to_agent=self.name)
+
+        with span("agent.one_off_message", agent=self.name) as one_off_span:
+            # The shared tier of the cache is in Mongo so it is read and written off the loop
+            cache_key = llm_cache_key(ONE_OFF_MODEL, self.instructions, message)
+            agent_response = await asyncio.to_thread(llm_cache.get, cache_key) if LLM_CACHE_ENABLED else None
+            one_off_span.set("cache_hit", agent_response is not None)
+
+            if agent_response is None:
+                response = await self.client.chat.completions.create(
+                    model=ONE_OFF_MODEL,
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": self.instructions
+                        },
+                        {
+                            "role": "user",
+                            "content": message
+                        }
+                    ]
+                )
+
+                record_usage(response.usage, one_off_span)
+                agent_response = response.choices[0].message.content
+                if LLM_CACHE_ENABLED and agent_response:
+                    await asyncio.to_thread(llm_cache.put, cache_key, agent_response)
+            else:
+                logging.info("One off message served from the LLM cache.")
+
+        logging.info(f"LLM cache: {llm_cache.stats()}")
+
+        await self.add_to_convo_async(
+            response_msg=agent_response,
+            msg_type="message",
+            from_agent=self.name,
+            to_agent="system"
+        )
+
+        return agent_response
@@ -0,0 +1,148 @@
+"""
+Thread compaction for the agents. Everything an agent adds to its OpenAI thread is sent again with every later run, so
+large tool outputs and data-heavy prompts make each follow up slower and more expensive. Once a thread would go over
+AGENT_THREAD_TOKEN_BUDGET the large pieces are archived in swarm_archived_outputs and replaced in the thread by a short
+digest and a reference. The agent gets the fetch_output tool to read an archived piece again.
+"""
+
+from settings import logging, COMPACT_DIGEST_TOKENS, COMPACT_ARCHIVE_DAYS, LOOKUP_MAX_BYTES
+from db_tools import save_archived_output, find_archived_output
+
+from datetime import datetime, timedelta
+import math
+import json
+import uuid
+import re
+
+# The tool the agents get when compaction is on
+FETCH_OUTPUT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "fetch_output",
+        "description": "Read a tool output or message that was compacted out of the conversation. Compacted pieces "
+                       "are replaced by a digest with a ref. Only fetch one again if the digest isn't enough.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "ref": {
+                    "type": "string",
+                    "description": "The ref from the digest."
+                },
+                "offset": {
+                    "type": "integer",
+                    "description": "Where to start reading. Use the next_offset of the previous page."
+                }
+            },
+            "required": ["ref"]
+        }
+    }
+}
+
+# doc_ids are UUIDs. They are kept in the digest so the data can still be looked up.
+DOC_ID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+# The rows of a lookup kept in its digest
+DIGEST_ROWS = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the tokens of a piece of text at 4 bytes per token, the same estimate the lookup budget uses.
+    :param text: The text.
+    :return: The estimated tokens.
+    """
+
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
+
+def digest_text(text: str, max_tokens: int = COMPACT_DIGEST_TOKENS) -> str:
+    """
+    Build a short digest of a compacted piece. Lookup results keep their columns, counts, first rows and next_cursor.
+    Everything else keeps its beginning. The doc_ids in the text are always kept.
+    :param text: The text.
+    :param max_tokens: The most tokens of the digest.
+    :return: The digest.
+    """
+
+    max_bytes = max_tokens * 4
+
+    try:
+        parsed = json.loads(text)
+    except ValueError:
+        parsed = None
+
+    if isinstance(parsed, dict) and "columns" in parsed and "rows" in parsed:
+        summary = {
+            "columns": parsed["columns"],
+            "returned": parsed.get("returned", len(parsed["rows"])),
+            "total": parsed.get("total"),
+            "first_rows": parsed["rows"][:DIGEST_ROWS]
+        }
+        digest = json.dumps(summary, separators=(',', ':'), default=str)
+    else:
+        digest = text
+
+    if len(digest) > max_bytes:
+        digest = digest[:max_bytes] + "..."
+
+    # The cursor is added after the cut so the agent can always page on with data_lookup
+    if isinstance(parsed, dict) and parsed.get("next_cursor"):
+        digest += f"\nnext_cursor: {parsed['next_cursor']}"
+
+    doc_ids = list(dict.fromkeys(DOC_ID_PATTERN.findall(text)))
+    if doc_ids:
+        digest += f"\ndoc_ids: {', '.join(doc_ids)}"
+
+    return digest
+
+
+def compact_text(main_thread_id: str, agent_name: str, kind: str, text: str) -> str | None:
+    """
+    Archive a piece of the thread and build the digest that replaces it.
+    :param main_thread_id: The main thread ID.
+    :param agent_name: The agent the thread belongs to.
+    :param kind: What the piece is, e.g. "get_player_stats output" or "message". Shown in the digest.
+    :param text: The text.
+    :return: The replacement or None if the piece couldn't be archived and has to stay as it is.
+    """
+
+    ref = f"out_{uuid.uuid4().hex[:16]}"
+    archived = save_archived_output(
+        {
+            "_id": ref,
+            "main_thread_id": main_thread_id,
+            "agent": agent_name,
+            "kind": kind,
+            "text": text,
+            "createdAt": datetime.utcnow(),
+            "expiresAt": datetime.utcnow() + timedelta(days=COMPACT_ARCHIVE_DAYS)
+        }
+    )
+    if not archived:
+        return None
+
+    return (f"[Compacted {kind}, about {estimate_tokens(text)} tokens. ref: {ref}. Call fetch_output with this ref to "
+            f"read it again.]\n{digest_text(text)}")
+
+
+def fetch_output(ref: str, offset: int = 0) -> str:
+    """
+    Read a compacted piece again, one page at a time.
+    :param ref: The ref from the digest.
+    :param offset: Where to start reading.
+    :return: The page and the next_offset if there is more.
+    """
+
+    entry = find_archived_output(ref)
+    if not entry:
+        return f"No compacted output with ref {ref}. It may have expired. Run the tool again instead."
+
+    offset = max(int(offset or 0), 0)
+    page = entry["text"][offset:offset + LOOKUP_MAX_BYTES]
+    next_offset = offset + len(page)
+    logging.info(f"Fetched {len(page)} characters of compacted output {ref}.")
+
+    if next_offset < len(entry["text"]):
+        return f"{page}\n[More follows. Call fetch_output with offset {next_offset} to read on.]"
+
+    return page
@@ -0,0 +1,540 @@
+"""
+A local stand-in for the OpenAI API that needs no network. It implements the part of the assistants, threads, runs,
+messages and chat completions API that the agents use, for both the sync and the async client, so Agent, AsyncAgent,
+nba_analyst and nba_data_guy can run end to end against it.
+
+What the assistant says is scripted. A script looks like:
+
+{
+    "latency": {"request": 0.05, "run_step": 1.0, "chat": 0.5},    (seconds, all optional)
+    "runs": {
+        "nba_data_guy": [
+            [{"tool_calls": [{"name": "resolve_name", "arguments": {"name": "Tatum"}}]}, {"message": "Here it is."}]
+        ]
+    },
+    "chat": {"nba_analyst": ["get_player_stats for 2023-24"]},
+    "default_message": "yes"
+}
+
+Each item in `runs` is one run of that assistant: tool call rounds and then a final message (or {"fail": "reason"}).
+Each thread works through the runs from the start so many conversations can use one script at the same time. `chat`
+is the replies to one off messages. When a script runs out the assistant answers with default_message.
+
+A recorded conversation from swarm_convos can be replayed with replay_script. A replay is one list of responses per
+agent, which runs and one off messages take from in the order they were recorded, so it serves one conversation at a
+time.
+"""
+
+from settings import logging, DB, OPENAI_FAKE_SCRIPT, OPENAI_FAKE_REPLAY
+
+from types import SimpleNamespace
+import threading
+import asyncio
+import time
+import json
+import uuid
+
+
+def fake_id(prefix: str) -> str:
+    """
+    Make an ID that looks like an OpenAI one.
+    :param prefix: The prefix, e.g. "run".
+    :return: The ID.
+    """
+
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def replay_script(main_thread_id: str, latency: dict = None) -> dict:
+    """
+    Build a script that replays a recorded conversation from swarm_convos.
+    :param main_thread_id: The ID of the conversation.
+    :param latency: The latencies to replay it with.
+    :return: The script.
+    """
+
+    convo_doc = DB['swarm_convos'].find_one({"id": main_thread_id})
+    if not convo_doc:
+        raise ValueError(f"There is no conversation {main_thread_id} in swarm_convos.")
+
+    responses = {}
+    current_turns = {}
+    for entry in convo_doc.get("convo", []):
+        agent_name = entry.get("from_agent")
+        if not agent_name or agent_name == "system":
+            continue
+        turn = current_turns.setdefault(agent_name, [])
+
+        if entry.get("msg_type") == "function_call":
+            tool_calls = [
+                {"name": name, "arguments": arguments}
+                for call in entry["message"] for name, arguments in call.items()
+            ]
+            turn.append({"tool_calls": tool_calls})
+        elif entry.get("msg_type") == "message" and entry.get("to_agent") == "system":
+            turn.append({"message": entry["message"]})
+            responses.setdefault(agent_name, []).append(turn)
+            current_turns[agent_name] = []
+        elif entry.get("msg_type") == "error":
+            turn.append({"fail": entry["message"]})
+            responses.setdefault(agent_name, []).append(turn)
+            current_turns[agent_name] = []
+
+    logging.info(f"Replaying {main_thread_id}: {({name: len(turns) for name, turns in responses.items()})} responses.")
+
+    return {"latency": latency if latency else {}, "responses": responses}
+
+
+class FakeBackend:
+    """
+    The state of the fake API: assistants, threads and runs. It never sleeps. The clients add the latency.
+    """
+    def __init__(self, script: dict = None):
+        script = script if script else {}
+        self.script = script
+        self.latency = {"request": 0.0, "run_step": 0.0, "chat": 0.0, **script.get("latency", {})}
+        self.default_message = script.get("default_message", "yes")
+
+        self.assistants = {}
+        # The assistant made for each agent definition. It stands in for swarm_assistants so the made up assistant ids
+        # never reach the real registry.
+        self.assistant_ids = {}
+        self.threads = {}
+        self.runs = {}
+        # Position in the script, by thread for runs and by agent for one off messages and replays
+        self.cursors = {}
+        self.lock = threading.Lock()
+
+        # What the agents sent, for checking and for the benchmarks
+        self.request_count = 0
+        self.tool_output_bytes = 0
+
+    def next_turn(self, kind: str, agent_name: str, cursor_key: str) -> list:
+        """
+        Take the next scripted turn for an agent.
+        :param kind: "runs" or "chat".
+        :param agent_name: The name of the agent.
+        :param cursor_key: What the position in the script is kept by.
+        :return: The steps of the turn.
+        """
+
+        if "responses" in self.script:
+            turns = self.script["responses"].get(agent_name, [])
+            cursor_key = f"responses:{agent_name}"
+        else:
+            turns = self.script.get(kind, {}).get(agent_name, [])
+            cursor_key = f"{kind}:{cursor_key}"
+
+        position = self.cursors.get(cursor_key, 0)
+        self.cursors[cursor_key] = position + 1
+        if position >= len(turns):
+            return [{"message": self.default_message}]
+
+        turn = turns[position]
+        # A chat reply can be given as just the text
+        return [{"message": turn}] if isinstance(turn, str) else turn
+
+    def create_assistant(self, name: str, instructions: str, **kwargs) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            assistant = SimpleNamespace(id=fake_id("asst"), name=name, instructions=instructions, **kwargs)
+            self.assistants[assistant.id] = assistant
+            return assistant
+
+    def retrieve_assistant(self, assistant_id: str) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            return self.assistants.get(assistant_id, SimpleNamespace(id=assistant_id, name=None, instructions=None))
+
+    def assistant_for(self, definition_hash: str, name: str, instructions: str, **kwargs) -> str:
+        """
+        Get the assistant for an agent definition, creating it the first time. This is the fake's assistant registry.
+        :param definition_hash: The hash of the agent definition.
+        :param name: The name of the agent. Runs find their script by it.
+        :param instructions: The instructions of the agent.
+        :return: The assistant ID.
+        """
+
+        with self.lock:
+            assistant_id = self.assistant_ids.get(definition_hash)
+        if assistant_id is None:
+            assistant_id = self.create_assistant(name, instructions, **kwargs).id
+            with self.lock:
+                assistant_id = self.assistant_ids.setdefault(definition_hash, assistant_id)
+
+        return assistant_id
+
+    def delete_assistant(self, assistant_id: str) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            self.assistants.pop(assistant_id, None)
+            return SimpleNamespace(id=assistant_id, deleted=True)
+
+    def create_thread(self) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            thread = SimpleNamespace(id=fake_id("thread"))
+            self.threads[thread.id] = []
+            return thread
+
+    def add_thread_message(self, thread_id: str, role: str, content: str, assistant_id: str = None,
+                           run_id: str = None) -> SimpleNamespace:
+        message = SimpleNamespace(
+            id=fake_id("msg"),
+            thread_id=thread_id,
+            role=role,
+            assistant_id=assistant_id,
+            run_id=run_id,
+            created_at=int(time.time()),
+            content=[SimpleNamespace(type="text", text=SimpleNamespace(value=content, annotations=[]))]
+        )
+        self.threads.setdefault(thread_id, []).append(message)
+        return message
+
+    def create_message(self, thread_id: str, role: str, content: str, **kwargs) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            return self.add_thread_message(thread_id, role, content)
+
+    def delete_message(self, message_id: str, thread_id: str) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            messages = self.threads.get(thread_id, [])
+            self.threads[thread_id] = [message for message in messages if message.id != message_id]
+            return SimpleNamespace(id=message_id, deleted=len(messages) != len(self.threads[thread_id]))
+
+    def list_messages(self, thread_id: str, order: str = "desc", after: str = None, limit: int = 20,
+                      run_id: str = None, **kwargs) -> list:
+        with self.lock:
+            self.request_count += 1
+            messages = list(self.threads.get(thread_id, []))
+
+        if order == "desc":
+            messages.reverse()
+        # after is a position in the whole thread so it is applied before the run filter
+        if after:
+            ids = [message.id for message in messages]
+            messages = messages[ids.index(after) + 1:] if after in ids else []
+        if run_id:
+            messages = [message for message in messages if message.run_id == run_id]
+
+        return messages[:limit]
+
+    def run_snapshot(self, run: dict) -> SimpleNamespace:
+        """
+        Make the object the API returns for a run.
+        :param run: The state of the run.
+        :return: The run object.
+        """
+
+        required_action = None
+        if run["status"] == "requires_action":
+            required_action = SimpleNamespace(
+                type="submit_tool_outputs",
+                submit_tool_outputs=SimpleNamespace(tool_calls=run["tool_calls"])
+            )
+        last_error = SimpleNamespace(code="server_error", message=run["error"]) if run.get("error") else None
+
+        return SimpleNamespace(
+            id=run["id"],
+            thread_id=run["thread_id"],
+            assistant_id=run["assistant_id"],
+            status=run["status"],
+            required_action=required_action,
+            last_error=last_error,
+            incomplete_details=None,
+            # Like the API, usage is only set once the run has ended
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+            if run["status"] in ("completed", "failed") else None
+        )
+
+    def create_run(self, thread_id: str, assistant_id: str, **kwargs) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            assistant = self.assistants.get(assistant_id)
+            agent_name = assistant.name if assistant else assistant_id
+            run = {
+                "id": fake_id("run"),
+                "thread_id": thread_id,
+                "assistant_id": assistant_id,
+                "status": "queued",
+                "steps": self.next_turn("runs", agent_name, thread_id),
+                "position": 0,
+                "ready_at": time.monotonic() + self.latency["run_step"],
+                "tool_calls": []
+            }
+            self.runs[run["id"]] = run
+            return self.run_snapshot(run)
+
+    def advance_run(self, run_id: str) -> SimpleNamespace:
+        """
+        Move a run on to its next step if the step's latency has passed.
+        :param run_id: The run ID.
+        :return: The run object.
+        """
+
+        with self.lock:
+            run = self.runs[run_id]
+            if run["status"] not in ("queued", "in_progress"):
+                return self.run_snapshot(run)
+
+            if time.monotonic() < run["ready_at"]:
+                run["status"] = "in_progress"
+                return self.run_snapshot(run)
+
+            step = run["steps"][run["position"]] if run["position"] < len(run["steps"]) else {}
+            run["position"] += 1
+
+            if "tool_calls" in step:
+                run["status"] = "requires_action"
+                run["tool_calls"] = [
+                    SimpleNamespace(
+                        id=fake_id("call"),
+                        type="function",
+                        function=SimpleNamespace(name=call["name"], arguments=json.dumps(call.get("arguments", {})))
+                    )
+                    for call in step["tool_calls"]
+                ]
+            elif "fail" in step:
+                run["status"] = "failed"
+                run["error"] = step["fail"]
+            else:
+                run["status"] = "completed"
+                self.add_thread_message(
+                    run["thread_id"],
+                    "assistant",
+                    step.get("message", self.default_message),
+                    assistant_id=run["assistant_id"],
+                    run_id=run["id"]
+                )
+
+            return self.run_snapshot(run)
+
+    def retrieve_run(self, thread_id: str, run_id: str) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+        return self.advance_run(run_id)
+
+    def list_runs(self, thread_id: str, order: str = "desc", limit: int = 20, **kwargs) -> list:
+        with self.lock:
+            self.request_count += 1
+            runs = [self.run_snapshot(run) for run in self.runs.values() if run["thread_id"] == thread_id]
+
+        if order == "desc":
+            runs.reverse()
+
+        return runs[:limit]
+
+    def submit_tool_outputs(self, thread_id: str, run_id: str, tool_outputs: list) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            run = self.runs[run_id]
+            if run["status"] != "requires_action":
+                raise ValueError(f"Run {run_id} is {run['status']} and isn't waiting on tool outputs.")
+
+            self.tool_output_bytes += sum(len(str(output.get("output", ""))) for output in tool_outputs)
+            run["status"] = "queued"
+            run["tool_calls"] = []
+            run["ready_at"] = time.monotonic() + self.latency["run_step"]
+            return self.run_snapshot(run)
+
+    def run_wait(self, run_id: str) -> float:
+        """
+        Get how long until a run's next step is ready.
+        :param run_id: The run ID.
+        :return: The seconds to wait.
+        """
+
+        with self.lock:
+            return max(self.runs[run_id]["ready_at"] - time.monotonic(), 0.0)
+
+    def chat_completion(self, model: str, messages: list, **kwargs) -> SimpleNamespace:
+        with self.lock:
+            self.request_count += 1
+            # The agent is found by its instructions, which one off messages send as the system message
+            system_content = next((message["content"] for message in messages if message["role"] == "system"), None)
+            agent_name = next(
+                (assistant.name for assistant in self.assistants.values() if assistant.instructions == system_content),
+                "default"
+            )
+            turn = self.next_turn("chat", agent_name, agent_name)
+
+        content = next((step["message"] for step in reversed(turn) if "message" in step), self.default_message)
+        return SimpleNamespace(
+            id=fake_id("chatcmpl"),
+            model=model,
+            choices=[SimpleNamespace(index=0, message=SimpleNamespace(role="assistant", content=content))],
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+        )
+
+
+class FakeRunStream:
+    """
+    The event stream of a fake run. It can be iterated by both the sync and the async agents.
+    """
+    def __init__(self, backend: FakeBackend, start):
+        self.backend = backend
+        self.start = start
+
+    def events(self, run) -> list:
+        """
+        Get the events for a run that just changed state.
+        :param run: The run object.
+        :return: The events.
+        """
+
+        return [SimpleNamespace(event=f"thread.run.{run.status}", data=run)]
+
+    def __iter__(self):
+        run = self.start()
+        yield from self.events(run)
+        while run.status in ("queued", "in_progress"):
+            time.sleep(self.backend.run_wait(run.id))
+            previous_status = run.status
+            run = self.backend.advance_run(run.id)
+            if run.status != previous_status:
+                yield from self.events(run)
+
+    async def __aiter__(self):
+        run = self.start()
+        for event in self.events(run):
+            yield event
+        while run.status in ("queued", "in_progress"):
+            await asyncio.sleep(self.backend.run_wait(run.id))
+            previous_status = run.status
+            run = self.backend.advance_run(run.id)
+            if run.status != previous_status:
+                for event in self.events(run):
+                    yield event
+
+
+class FakeStreamManager:
+    """
+    Starts the run when the stream is entered, like the SDK's stream managers.
+    """
+    def __init__(self, backend: FakeBackend, start):
+        self.stream = FakeRunStream(backend, start)
+
+    def __enter__(self) -> FakeRunStream:
+        return self.stream
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+    async def __aenter__(self) -> FakeRunStream:
+        return self.stream
+
+    async def __aexit__(self, *exc_info) -> None:
+        return None
+
+
+class FakePage:
+    """
+    A page of messages that can be iterated by both the sync and the async agents.
+    """
+    def __init__(self, load, delay: float, is_async: bool):
+        self.load = load
+        self.delay = delay
+        self.is_async = is_async
+        self.data = None if is_async else load()
+
+    def __iter__(self):
+        return iter(self.data)
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.delay)
+        for message in self.load():
+            yield message
+
+
+class FakeOpenAI:
+    """
+    A fake OpenAI client. Pass it to agents.openai_client.use_openai_client. With is_async it stands in for
+    AsyncOpenAI and every call has to be awaited.
+    """
+    def __init__(self, backend: FakeBackend, is_async: bool = False):
+        self.backend = backend
+        self.is_async = is_async
+
+        latency = backend.latency
+        call = self.call
+
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(
+                create=lambda **kwargs: call(backend.create_assistant, latency["request"], **kwargs),
+                retrieve=lambda assistant_id: call(backend.retrieve_assistant, latency["request"], assistant_id),
+                delete=lambda assistant_id: call(backend.delete_assistant, latency["request"], assistant_id)
+            ),
+            threads=SimpleNamespace(
+                create=lambda **kwargs: call(backend.create_thread, latency["request"]),
+                messages=SimpleNamespace(
+                    create=lambda **kwargs: call(backend.create_message, latency["request"], **kwargs),
+                    delete=lambda **kwargs: call(backend.delete_message, latency["request"], **kwargs),
+                    list=self.list_messages
+                ),
+                runs=SimpleNamespace(
+                    create=lambda **kwargs: call(backend.create_run, latency["request"], **kwargs),
+                    retrieve=lambda **kwargs: call(backend.retrieve_run, latency["request"], **kwargs),
+                    submit_tool_outputs=lambda **kwargs: call(
+                        backend.submit_tool_outputs, latency["request"], **kwargs
+                    ),
+                    list=self.list_runs,
+                    stream=lambda **kwargs: FakeStreamManager(backend, lambda: backend.create_run(**kwargs)),
+                    submit_tool_outputs_stream=lambda **kwargs: FakeStreamManager(
+                        backend, lambda: backend.submit_tool_outputs(**kwargs)
+                    )
+                )
+            )
+        )
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(
+                create=lambda **kwargs: call(backend.chat_completion, latency["chat"], **kwargs)
+            )
+        )
+
+    def call(self, function, delay: float, *args, **kwargs):
+        """
+        Call the backend after the latency. The async client returns a coroutine for the caller to await.
+        :param function: The backend method.
+        :param delay: The latency in seconds.
+        :return: The result of the backend method.
+        """
+
+        if self.is_async:
+            async def call_async():
+                await asyncio.sleep(delay)
+                return function(*args, **kwargs)
+            return call_async()
+
+        if delay:
+            time.sleep(delay)
+        return function(*args, **kwargs)
+
+    def list_messages(self, **kwargs) -> FakePage:
+        # Like the SDK, the async client's list is iterated with `async for` instead of being awaited
+        if not self.is_async and self.backend.latency["request"]:
+            time.sleep(self.backend.latency["request"])
+        return FakePage(lambda: self.backend.list_messages(**kwargs), self.backend.latency["request"], self.is_async)
+
+
+    def list_runs(self, **kwargs) -> FakePage:
+        # Iterated like list_messages
+        if not self.is_async and self.backend.latency["request"]:
+            time.sleep(self.backend.latency["request"])
+        return FakePage(lambda: self.backend.list_runs(**kwargs), self.backend.latency["request"], self.is_async)
+
+
+def load_fake_backend() -> FakeBackend:
+    """
+    Build the backend from the OPENAI_FAKE_SCRIPT file or the OPENAI_FAKE_REPLAY conversation.
+    :return: The backend.
+    """
+
+    if OPENAI_FAKE_REPLAY:
+        return FakeBackend(replay_script(OPENAI_FAKE_REPLAY))
+
+    if OPENAI_FAKE_SCRIPT:
+        with open(OPENAI_FAKE_SCRIPT) as script_file:
+            return FakeBackend(json.load(script_file))
+
+    return FakeBackend()
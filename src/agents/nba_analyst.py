@@ -1,14 +1,16 @@
 from dns.e164 import query
 
-from settings import logging
+from settings import logging, ANALYST_FAN_OUT_WORKERS
 from db_tools import get_agent_from_db, get_nba_data_guys
-from agents.agents import Agent
-from agents.nba_data_guy import nba_data_guy
+from agents.async_agents import AsyncAgent, run_on_agent_loop
+from agents.nba_data_guy import nba_data_guy_async
+from agents.prompt_registry import prompt_registry
+from tracing import span, trace_conversation
 
-from langchain import hub
+import asyncio
 
 
-def extrapolate_query(agent: Agent, init_query: str, nba_data_guy_tools: list) -> str:
+async def extrapolate_query(agent: AsyncAgent, init_query: str, nba_data_guy_tools: list) -> str:
     """
     Extrapolate the query. This call is made to best reasoning AI to extrapolate the query.
     :param agent: The agent object.
@@ -17,19 +19,20 @@ def extrapolate_query(agent: Agent, init_query: str, nba_data_guy_tools: list) -
     :return: The query.
     """
 
-    # Load the LangChain Hub prompt template
-    prompt_template = hub.pull("extrapolate_query_template")
+    with span("analyst.extrapolate_query"):
+        # Get the LangChain Hub prompt template. The registry loaded it at startup.
+        prompt_template = prompt_registry.get("extrapolate_query_template")
 
-    # Format the prompt with the query and available tools
-    prompt = prompt_template.format(query=init_query, tools=nba_data_guy_tools)
+        # Format the prompt with the query and available tools
+        prompt = prompt_template.format(query=init_query, tools=nba_data_guy_tools)
 
-    # Use the AI to generate the extrapolated query
-    extrapolated_query = agent.one_off_message(prompt)
+        # Use the AI to generate the extrapolated query
+        extrapolated_query = await agent.one_off_message(prompt)
 
     return extrapolated_query
 
 
-def planning_step(agent: Agent) -> str:
+async def planning_step(agent: AsyncAgent) -> str:
     """
     Break down the tasks and determine the data points needed.
     :param agent: The agent object.
@@ -37,19 +40,20 @@ def planning_step(agent: Agent) -> str:
     """
 
     # Pull the prompt
-    prompt_template = hub.pull("oai_nba_analyst_plan")
+    prompt_template = prompt_registry.get("oai_nba_analyst_plan")
     prompt = prompt_template.format()
 
     # Add the prompt to the conversation
-    agent.add_message(prompt)
+    await agent.add_message(prompt)
 
     # Run the agent
-    request = agent.do_run()
+    request = await agent.do_run()
 
     return request
 
 
-def get_data(main_thread_id: str, request: str, ndg_id: str, data_guy: Agent = None) -> tuple[Agent, str]:
+async def get_data(main_thread_id: str, request: str, ndg_id: str,
+                   data_guy: AsyncAgent = None) -> tuple[AsyncAgent, str]:
     """
     Get the data from the NBA API.
     :param main_thread_id: The main thread ID.
@@ -60,12 +64,13 @@ def get_data(main_thread_id: str, request: str, ndg_id: str, data_guy: Agent = N
     """
 
     # Call the NBA Data Guy
-    data_guy, data = nba_data_guy(main_thread_id, request, ndg_id, data_guy)
+    with span("analyst.get_data", data_guy=ndg_id, follow_up=data_guy is not None):
+        data_guy, data = await nba_data_guy_async(main_thread_id, request, ndg_id, data_guy)
 
     return data_guy, data
 
 
-def analyze_data(agent: Agent, data_guy: Agent, data: str, data_guy_id: str, message: str) -> str:
+async def analyze_data(agent: AsyncAgent, data_guy: AsyncAgent, data: str, data_guy_id: str, message: str) -> str:
     """
     Analyze the data.
     :param agent: The agent object.
@@ -76,93 +81,134 @@ def analyze_data(agent: Agent, data_guy: Agent, data: str, data_guy_id: str, mes
     :return: The analysis.
     """
 
-    # Pull the prompt
-    prompt_template = hub.pull("oai_nba_analyst_eval")
-    prompt = prompt_template.format(data=data, query=message)
+    with span("analyst.analyze_data", data_guy=data_guy_id) as analysis_span:
+        # Pull the prompt
+        prompt_template = prompt_registry.get("oai_nba_analyst_eval")
+        prompt = prompt_template.format(data=data, query=message)
 
-    # Add the prompt to the conversation
-    agent.add_message(prompt)
+        # Add the prompt to the conversation
+        await agent.add_message(prompt)
 
-    # Run the agent
-    evaluation = agent.do_run()
+        # Run the agent
+        evaluation = await agent.do_run()
 
-    # If the evaluation is not "yes", then follow up with the research team until it is.
-    while "yes" not in evaluation.lower():
-        msg = "Please respond with a follow up request to the reseach team."
-        agent.add_message(msg)
+        # If the evaluation is not "yes", then follow up with the research team until it is.
+        while "yes" not in evaluation.lower():
+            msg = "Please respond with a follow up request to the reseach team."
+            await agent.add_message(msg)
 
-        # Run the agent
-        follow_up = agent.do_run()
+            # Run the agent
+            follow_up = await agent.do_run()
 
-        # Call the NBA Data Guy
-        follow_up_data = get_data(agent.main_thread_id, follow_up, data_guy_id, data_guy)
+            analysis_span.add("follow_ups")
 
-        prompt = prompt_template.format(data=follow_up_data, query=message)
-        agent.add_message(prompt)
-        evaluation = agent.do_run()
+            # Call the NBA Data Guy
+            data_guy, follow_up_data = await get_data(agent.main_thread_id, follow_up, data_guy_id, data_guy)
 
-    # Analyze the data
-    analysis_prompt_template = hub.pull("oai_nba_analyst_analysis")
-    analysis_prompt = analysis_prompt_template.format()
-    agent.add_message(analysis_prompt)
+            prompt = prompt_template.format(data=follow_up_data, query=message)
+            await agent.add_message(prompt)
+            evaluation = await agent.do_run()
 
-    # Run the agent
-    analysis = agent.do_run()
+        # Analyze the data
+        analysis_prompt_template = prompt_registry.get("oai_nba_analyst_analysis")
+        analysis_prompt = analysis_prompt_template.format()
+        await agent.add_message(analysis_prompt)
+
+        # Run the agent
+        analysis = await agent.do_run()
 
     return analysis
 
 
-def nba_analyst(main_thread_id: str, message: str) -> str:
+async def nba_analyst_async(main_thread_id: str, message: str) -> str:
+    """
+    Answer a message with the NBA Analyst and the NBA Data Guys. The agents' OpenAI calls are awaited so many
+    conversations can share one event loop.
+    :param main_thread_id: The main thread ID.
+    :param message: The message from the user.
+    :return: The analysis.
+    """
 
-    # Get the agent from the database
-    db_agent = get_agent_from_db("nba_analyst", "nba")
-
-    # Initialize the agent
-    logging.info("Initializing NBA Analyst.")
-    analyst = Agent(
-        name="nba_analyst",
-        instructions=db_agent["instructions"],
-        model=db_agent["model"],
-        tools=db_agent["tools"],
-        main_thread_id=main_thread_id
-    )
-
-    # Add the message to the conversation
-    analyst.add_message(message)
-
-    # Get list of nba_data_guy instances
-    nba_data_guys = get_nba_data_guys()
-
-    # Get the extrapolated query for each nba_data_guy
-    all_data_requests = {}
-    for data_guy in nba_data_guys:
-        # Remove the data_lookup tool from the list of tools since we don't need the analyst to ask for that
-        no_data_lookup_tools = [tool for tool in data_guy["tools"] if tool['function']['name'] != 'data_lookup']
-        data_requests = extrapolate_query(analyst, message, no_data_lookup_tools)
-        all_data_requests[f'nba_data_guy_{data_guy["id"]}'] = data_requests
-
-    # Format string for each nba_data_guy
-    requests_str = ""
-    for data_guy_id, requests in all_data_requests.items():
-        requests_str += f"{data_guy_id}: {requests}\n"
-
-    # Add the requests to the conversation as the agent
-    analyst.add_message(requests_str, as_agent=True)
-
-    # Fetch data from each nba_data_guy
-    all_data = {}
-    for data_guy_id, requests in all_data_requests.items():
-        # Get the data
-        data_guy, data = get_data(main_thread_id, requests, data_guy_id.split("_")[-1])
-        all_data[data_guy_id] = {"data": data, "agent": data_guy}
-
-    # Analyze the data
-    analysis = ""
-    # For each data guy, analyze the data
-    for data_guy_id, data_agent in all_data.items():
-        data_guy = data_agent["agent"]
-        data = data_agent["data"]
-        # Since this is being done in a thread the last `analysis` will be the culmination of all the analysis
-        analysis = analyze_data(analyst, data_guy, data, data_guy_id, message)
+    with trace_conversation(main_thread_id):
+        # Get the agent from the database
+        db_agent = await asyncio.to_thread(get_agent_from_db, "nba_analyst", "nba")
+
+        # Initialize the agent
+        logging.info("Initializing NBA Analyst.")
+        analyst = await AsyncAgent.create(
+            name="nba_analyst",
+            instructions=db_agent["instructions"],
+            model=db_agent["model"],
+            tools=db_agent["tools"],
+            main_thread_id=main_thread_id
+        )
+
+        # Add the message to the conversation
+        await analyst.add_message(message)
+
+        # Get list of nba_data_guy instances
+        nba_data_guys = await asyncio.to_thread(lambda: list(get_nba_data_guys()))
+
+        # The data guys are independent until their data is analyzed so their queries and fetches run at the same time.
+        # At most ANALYST_FAN_OUT_WORKERS of them run at once.
+        slots = asyncio.Semaphore(ANALYST_FAN_OUT_WORKERS)
+
+        async def extrapolate_for(data_guy: dict) -> str:
+            # Remove the data_lookup tool from the list of tools since we don't need the analyst to ask for that
+            no_data_lookup_tools = [tool for tool in data_guy["tools"] if tool['function']['name'] != 'data_lookup']
+            async with slots:
+                return await extrapolate_query(analyst, message, no_data_lookup_tools)
+
+        # Get the extrapolated query for each nba_data_guy. If one of them fails the task group cancels the rest. The
+        # tasks are kept in the order of the data guys so the requests are always merged in the same order.
+        async with asyncio.TaskGroup() as task_group:
+            request_tasks = [task_group.create_task(extrapolate_for(data_guy)) for data_guy in nba_data_guys]
+        all_data_requests = {
+            f'nba_data_guy_{data_guy["id"]}': task.result() for data_guy, task in zip(nba_data_guys, request_tasks)
+        }
+
+        # Format string for each nba_data_guy
+        requests_str = ""
+        for data_guy_id, requests in all_data_requests.items():
+            requests_str += f"{data_guy_id}: {requests}\n"
+
+        # Add the requests to the conversation as the agent
+        await analyst.add_message(requests_str, as_agent=True)
+
+        async def get_data_for(data_guy_id: str, requests: str) -> tuple[AsyncAgent, str]:
+            async with slots:
+                return await get_data(main_thread_id, requests, data_guy_id.split("_")[-1])
+
+        # Fetch data from each nba_data_guy at the same time and wait for all of them. A failed fetch cancels the rest.
+        async with asyncio.TaskGroup() as task_group:
+            fetch_tasks = [
+                task_group.create_task(get_data_for(data_guy_id, requests))
+                for data_guy_id, requests in all_data_requests.items()
+            ]
+        all_data = {
+            data_guy_id: {"data": task.result()[1], "agent": task.result()[0]}
+            for data_guy_id, task in zip(all_data_requests, fetch_tasks)
+        }
+
+        # Analyze the data. This stays one data guy at a time since every analysis is a run on the analyst's thread and
+        # a thread can only have one active run.
+        analysis = ""
+        # For each data guy, analyze the data
+        for data_guy_id, data_agent in all_data.items():
+            data_guy = data_agent["agent"]
+            data = data_agent["data"]
+            # Since this is being done in a thread the last `analysis` will be the culmination of all the analysis
+            analysis = await analyze_data(analyst, data_guy, data, data_guy_id, message)
 
     return analysis
+
+
+def nba_analyst(main_thread_id: str, message: str) -> str:
+    """
+    Answer a message with the NBA Analyst. This is the blocking wrapper around nba_analyst_async.
+    :param main_thread_id: The main thread ID.
+    :param message: The message from the user.
+    :return: The analysis.
+    """
+
+    return run_on_agent_loop(nba_analyst_async(main_thread_id, message))
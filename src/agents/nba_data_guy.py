@@ -1,14 +1,17 @@
 from settings import logging
 from db_tools import get_agent_from_db
-from agents.agents import Agent
+from agents.async_agents import AsyncAgent, run_on_agent_loop
 from agent_tools.nba_api_tools import function_map as nba_api_tools_function_map
 
+import asyncio
+
 function_map = {
     "1": nba_api_tools_function_map
 }
 
 
-def nba_data_guy(main_thread_id: str, request: str, ndg_id: str, data_guy: Agent) -> tuple[Agent, str]:
+async def nba_data_guy_async(main_thread_id: str, request: str, ndg_id: str,
+                             data_guy: AsyncAgent) -> tuple[AsyncAgent, str]:
     """
     Get the data from the NBA API.
     :param main_thread_id: The main thread ID.
@@ -22,22 +25,36 @@ def nba_data_guy(main_thread_id: str, request: str, ndg_id: str, data_guy: Agent
         logging.info(f"Initializing NBA Data Guy. ID: {ndg_id}")
 
         # Get the agent from the database
-        db_agent = get_agent_from_db("nba_data_guy", "nba", ndg_id)
+        db_agent = await asyncio.to_thread(get_agent_from_db, "nba_data_guy", "nba", ndg_id)
 
         # Initialize the agent
-        data_guy = Agent(
+        data_guy = await AsyncAgent.create(
             name="nba_data_guy",
             instructions=db_agent["instructions"],
             model=db_agent["model"],
             tools=db_agent["tools"],
             main_thread_id=main_thread_id,
-            function_map=function_map[ndg_id]
+            function_map=function_map[ndg_id],
+            max_tool_workers=db_agent.get("max_tool_workers")
         )
 
     # Add the request to the conversation
-    data_guy.add_message(request)
+    await data_guy.add_message(request)
 
     # Run the agent
-    data = data_guy.do_run()
+    data = await data_guy.do_run()
 
     return data_guy, data
+
+
+def nba_data_guy(main_thread_id: str, request: str, ndg_id: str, data_guy: AsyncAgent) -> tuple[AsyncAgent, str]:
+    """
+    Get the data from the NBA API. This is the blocking wrapper around nba_data_guy_async.
+    :param main_thread_id: The main thread ID.
+    :param request: The request.
+    :param ndg_id: The NBA Data Guy ID.
+    :param data_guy: The agent object. This is passed back if follow up requests are needed.
+    :return: The data.
+    """
+
+    return run_on_agent_loop(nba_data_guy_async(main_thread_id, request, ndg_id, data_guy))
@@ -0,0 +1,392 @@
+"""
+The OpenAI client shared by every agent in the process. One client means one connection pool, so connections are kept
+alive and reused across agents and conversations instead of every agent doing its own TLS handshakes.
+
+The pool is fronted by a semaphore with one slot per connection. A request holds its slot until its response is
+closed, which includes streamed runs, so the slots in use is the pool utilization and the time spent waiting for a slot
+is the pool wait time. A request that can't get a slot within the pool timeout fails with httpx.PoolTimeout.
+"""
+
+from settings import (logging, openai, OPENAI_POOL_SIZE, OPENAI_KEEPALIVE, OPENAI_TIMEOUT, OPENAI_CONNECT_TIMEOUT,
+                      OPENAI_MAX_RETRIES, OPENAI_MODE)
+
+import threading
+import asyncio
+import weakref
+import httpx
+import time
+
+
+class PoolCounters:
+    """
+    Counts how a pool is used. Shared by the sync and async transports.
+    """
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.wait_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquired(self, wait_time: float) -> None:
+        """
+        Count a request that got a slot.
+        :param wait_time: The seconds it waited for the slot.
+        :return: None
+        """
+
+        with self.lock:
+            self.request_count += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            # Anything over a millisecond means every connection was busy
+            if wait_time > 0.001:
+                self.wait_count += 1
+            self.total_wait += wait_time
+            self.max_wait = max(self.max_wait, wait_time)
+
+        return
+
+    def released(self) -> None:
+        with self.lock:
+            self.in_use -= 1
+
+    def stats(self) -> dict:
+        """
+        Get the pool counters.
+        :return: The counters.
+        """
+
+        with self.lock:
+            return {
+                "pool_size": self.pool_size,
+                "requests": self.request_count,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "utilization": round(self.in_use / self.pool_size, 3),
+                "waits": self.wait_count,
+                "total_wait": round(self.total_wait, 3),
+                "max_wait": round(self.max_wait, 3)
+            }
+
+
+def pool_limits(pool_size: int, keepalive: float) -> httpx.Limits:
+    return httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=keepalive)
+
+
+def request_pool_timeout(request: httpx.Request, default: float) -> float:
+    # Use the pool timeout of the request if the client set one
+    return request.extensions.get("timeout", {}).get("pool") or default
+
+
+def release_once(release):
+    """
+    Make sure a slot is only given back once even if its response is closed twice.
+    :param release: The function that gives the slot back.
+    :return: The wrapped function.
+    """
+
+    released = threading.Event()
+
+    def release_slot() -> None:
+        if not released.is_set():
+            released.set()
+            release()
+
+    return release_slot
+
+
+class PooledStream(httpx.SyncByteStream):
+    """
+    Wraps the body of a response so the pool slot is given back when the response is closed.
+    """
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    def __iter__(self):
+        for chunk in self.stream:
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            self.stream.close()
+        finally:
+            self.release()
+
+
+class AsyncPooledStream(httpx.AsyncByteStream):
+    """
+    The async version of PooledStream.
+    """
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            self.release()
+
+
+class PooledTransport(httpx.HTTPTransport):
+    """
+    An httpx transport that limits the requests in flight to the pool size and counts how the pool is used.
+    """
+    def __init__(self, pool_size: int, keepalive: float, pool_timeout: float = OPENAI_TIMEOUT):
+        super().__init__(limits=pool_limits(pool_size, keepalive))
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.counters = PoolCounters(pool_size)
+
+    def release_slot(self) -> None:
+        """
+        Give a pool slot back.
+        :return: None
+        """
+
+        self.counters.released()
+        self.slots.release()
+
+        return
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        """
+        Wait for a pool slot and send the request.
+        :param request: The request.
+        :return: The response. Its slot is released when the response is closed.
+        """
+
+        pool_timeout = request_pool_timeout(request, self.pool_timeout)
+
+        wait_start = time.perf_counter()
+        if not self.slots.acquire(timeout=pool_timeout):
+            raise httpx.PoolTimeout(f"No OpenAI pool slot was free within {pool_timeout}s.", request=request)
+        self.counters.acquired(time.perf_counter() - wait_start)
+
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            self.release_slot()
+            raise
+
+        response.stream = PooledStream(response.stream, release_once(self.release_slot))
+
+        return response
+
+    def stats(self) -> dict:
+        return self.counters.stats()
+
+
+class AsyncPooledTransport(httpx.AsyncHTTPTransport):
+    """
+    The async version of PooledTransport. It belongs to one event loop like the async client that uses it.
+    """
+    def __init__(self, pool_size: int, keepalive: float, pool_timeout: float = OPENAI_TIMEOUT):
+        super().__init__(limits=pool_limits(pool_size, keepalive))
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.slots = asyncio.BoundedSemaphore(pool_size)
+        self.counters = PoolCounters(pool_size)
+
+    def release_slot(self) -> None:
+        self.counters.released()
+        self.slots.release()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        """
+        Wait for a pool slot and send the request. See PooledTransport.handle_request.
+        :param request: The request.
+        :return: The response. Its slot is released when the response is closed.
+        """
+
+        pool_timeout = request_pool_timeout(request, self.pool_timeout)
+
+        wait_start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout=pool_timeout)
+        except asyncio.TimeoutError:
+            raise httpx.PoolTimeout(f"No OpenAI pool slot was free within {pool_timeout}s.", request=request)
+        self.counters.acquired(time.perf_counter() - wait_start)
+
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self.release_slot()
+            raise
+
+        response.stream = AsyncPooledStream(response.stream, release_once(self.release_slot))
+
+        return response
+
+    def stats(self) -> dict:
+        return self.counters.stats()
+
+
+openai_transport = None
+openai_client = None
+openai_client_lock = threading.Lock()
+
+# An async httpx client belongs to the event loop it was created on so there is one async client and transport per loop
+async_openai_clients = weakref.WeakKeyDictionary()
+async_openai_transports = weakref.WeakKeyDictionary()
+
+# Clients that replace the real ones, e.g. the local stand-in from agents/fake_openai.py
+client_override = None
+async_client_override = None
+
+
+def use_openai_client(client, async_client=None) -> None:
+    """
+    Make every agent use the given clients instead of the real ones. Pass None to go back to the real clients.
+    :param client: The client for the sync agents.
+    :param async_client: The client for the async agents.
+    :return: None
+    """
+
+    global client_override, async_client_override
+
+    with openai_client_lock:
+        client_override = client
+        async_client_override = async_client
+
+    return
+
+
+def use_fake_openai(backend=None) -> None:
+    """
+    Make every agent use the local stand-in for the OpenAI API.
+    :param backend: The fake backend. It is loaded from the OPENAI_FAKE_* settings if not given.
+    :return: None
+    """
+
+    from agents.fake_openai import FakeOpenAI, load_fake_backend
+
+    backend = backend if backend else load_fake_backend()
+    use_openai_client(FakeOpenAI(backend), FakeOpenAI(backend, is_async=True))
+    logging.info("Agents are using the fake OpenAI API.")
+
+    return
+
+
+def fake_openai_backend():
+    """
+    Get the fake backend the agents are using.
+    :return: The FakeBackend or None if the agents use the real API.
+    """
+
+    with openai_client_lock:
+        client = client_override
+
+    return getattr(client, "backend", None)
+
+
+def get_openai_client() -> openai.OpenAI:
+    """
+    Get the OpenAI client shared by the process. It is created the first time it is needed.
+    :return: The client.
+    """
+
+    global openai_transport, openai_client
+
+    if OPENAI_MODE == "fake" and client_override is None:
+        use_fake_openai()
+
+    with openai_client_lock:
+        if client_override is not None:
+            return client_override
+        if openai_client is None:
+            openai_transport = PooledTransport(pool_size=OPENAI_POOL_SIZE, keepalive=OPENAI_KEEPALIVE)
+            http_client = httpx.Client(
+                transport=openai_transport,
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+            openai_client = openai.OpenAI(
+                http_client=http_client,
+                max_retries=OPENAI_MAX_RETRIES,
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+            logging.info(f"Created the shared OpenAI client with a pool of {OPENAI_POOL_SIZE} connections.")
+
+    return openai_client
+
+
+def get_async_openai_client() -> openai.AsyncOpenAI:
+    """
+    Get the async OpenAI client for the running event loop. Every async agent on the loop shares it. It is created the
+    first time it is needed on each loop.
+    :return: The client.
+    """
+
+    if OPENAI_MODE == "fake" and async_client_override is None:
+        use_fake_openai()
+
+    loop = asyncio.get_running_loop()
+
+    with openai_client_lock:
+        if async_client_override is not None:
+            return async_client_override
+        client = async_openai_clients.get(loop)
+        if client is None:
+            async_openai_transports[loop] = AsyncPooledTransport(pool_size=OPENAI_POOL_SIZE, keepalive=OPENAI_KEEPALIVE)
+            http_client = httpx.AsyncClient(
+                transport=async_openai_transports[loop],
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+            client = openai.AsyncOpenAI(
+                http_client=http_client,
+                max_retries=OPENAI_MAX_RETRIES,
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+            async_openai_clients[loop] = client
+            logging.info(f"Created an async OpenAI client with a pool of {OPENAI_POOL_SIZE} connections.")
+
+    return client
+
+
+async def close_async_openai_client() -> None:
+    """
+    Close the async OpenAI client of the running event loop and its connections. Call this before the loop ends.
+    :return: None
+    """
+
+    with openai_client_lock:
+        loop = asyncio.get_running_loop()
+        client = async_openai_clients.pop(loop, None)
+        async_openai_transports.pop(loop, None)
+
+    if client is not None:
+        await client.close()
+        logging.info("Closed the async OpenAI client.")
+
+    return
+
+
+def openai_pool_stats() -> dict:
+    """
+    Get the pool counters of the shared client, or of the async client of the running event loop when called on one.
+    :return: The counters or an empty dictionary if the client hasn't been created.
+    """
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    async_transport = async_openai_transports.get(loop) if loop else None
+    if async_transport is not None:
+        return async_transport.stats()
+
+    if openai_transport is None:
+        return {}
+
+    return openai_transport.stats()
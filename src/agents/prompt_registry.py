@@ -0,0 +1,256 @@
+"""
+The LangChain Hub prompt templates the agents use, loaded once per worker instead of pulled on every use. Templates are
+loaded from the on-disk bundle first so a worker can start without the hub, then pulled from the hub. A background
+thread pulls them again every PROMPT_REFRESH_MINUTES and swaps in the ones whose version changed. If the hub is down
+the cached templates keep being served.
+
+Write a bundle for workers that can't reach the hub by running from the src directory:
+
+    python -m agents.prompt_registry --write-bundle
+"""
+
+from settings import logging, PROMPT_SOURCE, PROMPT_BUNDLE_PATH, PROMPT_REFRESH_MINUTES, PROMPT_VERSIONS
+
+from langchain import hub
+from langchain_core.load import dumpd, load
+
+from datetime import datetime
+import threading
+import argparse
+import tempfile
+import hashlib
+import json
+import time
+import os
+
+# Every template the agents use
+PROMPT_NAMES = [
+    "extrapolate_query_template",
+    "oai_nba_analyst_plan",
+    "oai_nba_analyst_eval",
+    "oai_nba_analyst_analysis"
+]
+
+
+def template_version(template) -> str:
+    """
+    Get the version of a template. The hub commit is used when the hub sets it, otherwise a hash of the template.
+    :param template: The prompt template.
+    :return: The version.
+    """
+
+    metadata = getattr(template, "metadata", None) or {}
+    if metadata.get("lc_hub_commit_hash"):
+        return metadata["lc_hub_commit_hash"]
+
+    serialized = json.dumps(dumpd(template), sort_keys=True, default=str)
+
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:16]
+
+
+class PromptRegistry:
+    """
+    A cache of prompt templates by name. Templates are served from memory and only replaced by a newer version.
+    """
+    def __init__(self, names: list, source: str, bundle_path: str, versions: dict):
+        self.names = names
+        self.source = source
+        self.bundle_path = bundle_path
+        self.versions = versions
+
+        self.templates = {}
+        self.template_versions = {}
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+
+    def hub_name(self, name: str) -> str:
+        """
+        Get the name to pull a template with. Templates pinned in PROMPT_VERSIONS are pulled at that commit.
+        :param name: The name of the template.
+        :return: The name for hub.pull.
+        """
+
+        return f"{name}:{self.versions[name]}" if self.versions.get(name) else name
+
+    def set_template(self, name: str, template, version: str) -> bool:
+        """
+        Cache a template.
+        :param name: The name of the template.
+        :param template: The prompt template.
+        :param version: Its version.
+        :return: True if the template is new or its version changed.
+        """
+
+        with self.lock:
+            if self.template_versions.get(name) == version:
+                return False
+            self.templates[name] = template
+            self.template_versions[name] = version
+
+        return True
+
+    def load_bundle(self) -> int:
+        """
+        Load the templates from the on-disk bundle.
+        :return: The number of templates loaded.
+        """
+
+        if not os.path.exists(self.bundle_path):
+            return 0
+
+        try:
+            with open(self.bundle_path, "r") as bundle_file:
+                bundle = json.load(bundle_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to read the prompt bundle {self.bundle_path}. Error: {e}")
+            return 0
+
+        loaded = 0
+        for name, entry in bundle.get("prompts", {}).items():
+            try:
+                self.set_template(name, load(entry["template"]), entry["version"])
+                loaded += 1
+            except Exception as e:
+                logging.warning(f"Failed to load prompt {name} from the bundle. Error: {e}")
+
+        logging.info(f"Loaded {loaded} prompts from {self.bundle_path}.")
+
+        return loaded
+
+    def write_bundle(self) -> None:
+        """
+        Write the cached templates to the on-disk bundle. The file is replaced in one step so a worker reading it never
+        sees half of it.
+        :return: None
+        """
+
+        with self.lock:
+            bundle = {
+                "writtenAt": datetime.utcnow().isoformat(),
+                "prompts": {
+                    name: {"template": dumpd(template), "version": self.template_versions[name]}
+                    for name, template in self.templates.items()
+                }
+            }
+
+        # Every worker writes its own temp file so workers refreshing at the same time don't write over each other
+        temp_path = None
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(self.bundle_path)),
+                                             prefix=".prompt-bundle-", suffix=".tmp", delete=False) as bundle_file:
+                temp_path = bundle_file.name
+                json.dump(bundle, bundle_file, default=str)
+            os.replace(temp_path, self.bundle_path)
+        except OSError as e:
+            logging.warning(f"Failed to write the prompt bundle {self.bundle_path}. Error: {e}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        return
+
+    def pull(self, name: str) -> bool:
+        """
+        Pull a template from the hub and cache it if its version changed. Failures are logged and the cached template
+        is kept. Nothing is pulled when the templates come from the bundle only.
+        :param name: The name of the template.
+        :return: True if the template changed.
+        """
+
+        if self.source != "hub":
+            return False
+
+        try:
+            template = hub.pull(self.hub_name(name))
+        except Exception as e:
+            logging.warning(f"Failed to pull prompt {name} from the hub. Using the cached one. Error: {e}")
+            return False
+
+        changed = self.set_template(name, template, template_version(template))
+        if changed:
+            logging.info(f"Prompt {name} is now version {self.template_versions[name]}.")
+
+        return changed
+
+    def refresh(self) -> int:
+        """
+        Pull every template from the hub and write the bundle if any of them changed.
+        :return: The number of templates that changed.
+        """
+
+        changed = sum(self.pull(name) for name in self.names)
+        if changed:
+            self.write_bundle()
+
+        return changed
+
+    def load(self) -> None:
+        """
+        Load every template. Call this once at worker startup.
+        :return: None
+        """
+
+        self.load_bundle()
+        self.refresh()
+
+        missing = [name for name in self.names if name not in self.templates]
+        if missing:
+            logging.error(f"No template for prompts {missing} in the bundle or the hub.")
+
+        return
+
+    def start_refresh(self, interval_minutes: float = PROMPT_REFRESH_MINUTES) -> None:
+        """
+        Refresh the templates on a background thread.
+        :param interval_minutes: The minutes between refreshes. 0 never refreshes.
+        :return: None
+        """
+
+        if not interval_minutes or self.source != "hub" or self.refresh_thread is not None:
+            return
+
+        def refresh_loop():
+            while True:
+                time.sleep(interval_minutes * 60)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logging.error(f"Failed to refresh the prompts. Error: {e}")
+
+        self.refresh_thread = threading.Thread(target=refresh_loop, name="prompt-refresh", daemon=True)
+        self.refresh_thread.start()
+        logging.info(f"Refreshing prompts every {interval_minutes} minutes.")
+
+        return
+
+    def get(self, name: str):
+        """
+        Get a template. This is called on the event loop so it never pulls from the hub. A template that wasn't loaded
+        at startup fails until the background refresh pulls it.
+        :param name: The name of the template.
+        :return: The prompt template.
+        """
+
+        template = self.templates.get(name)
+        if template is None:
+            raise KeyError(f"No template for prompt {name}. Load the prompts at startup or write a bundle.")
+
+        return template
+
+
+prompt_registry = PromptRegistry(PROMPT_NAMES, PROMPT_SOURCE, PROMPT_BUNDLE_PATH, PROMPT_VERSIONS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pull the prompt templates from the hub.")
+    parser.add_argument("--write-bundle", action="store_true", help="Write the templates to PROMPT_BUNDLE_PATH.")
+    args = parser.parse_args()
+
+    # Always pull from the hub here, even if the workers only use the bundle
+    prompt_registry.source = "hub"
+    for prompt_name in PROMPT_NAMES:
+        prompt_registry.pull(prompt_name)
+    logging.info(f"Pulled prompts: {prompt_registry.template_versions}")
+
+    if args.write_bundle:
+        prompt_registry.write_bundle()
+        logging.info(f"Wrote {len(prompt_registry.templates)} prompts to {PROMPT_BUNDLE_PATH}.")
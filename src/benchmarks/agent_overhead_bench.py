@@ -0,0 +1,108 @@
+"""
+Measure the agent framework's own overhead against the fake OpenAI API. Every conversation creates a data guy, sends it
+a request and runs it through a scripted tool call round. With the default zero latencies the time is all framework:
+the run loop, the tool executor and the convo writes.
+
+Run from the src directory:
+
+    python -m benchmarks.agent_overhead_bench [--conversations 50] [--concurrency 10] [--run-step 0.5]
+
+Set SYS_MODE=testing to leave the convo writes out. The fake API keeps its own assistant registry so nothing is written
+to swarm_assistants.
+"""
+
+from settings import logging
+from agents.async_agents import AsyncAgent
+from agents.fake_openai import FakeBackend
+from agents.openai_client import use_fake_openai, close_async_openai_client
+from agent_tools.nba_api_tools import function_map
+
+import argparse
+import statistics
+import asyncio
+import time
+
+# One data guy run: a round of in-process tool calls and then the answer
+DATA_GUY_SCRIPT = {
+    "runs": {
+        "bench_data_guy": [
+            [
+                {"tool_calls": [
+                    {"name": "resolve_name", "arguments": {"name": "Jayson Tatum"}},
+                    {"name": "resolve_name", "arguments": {"name": "Celtics", "kind": "team"}}
+                ]},
+                {"message": "Jayson Tatum plays for the Boston Celtics."}
+            ]
+        ]
+    }
+}
+
+
+async def run_conversation(conversation_number: int) -> float:
+    """
+    Run one scripted conversation.
+    :param conversation_number: The number of the conversation, used as its main thread ID.
+    :return: The seconds it took.
+    """
+
+    start_time = time.perf_counter()
+
+    data_guy = await AsyncAgent.create(
+        name="bench_data_guy",
+        instructions="Benchmark data guy.",
+        model="gpt-4o",
+        tools=[],
+        main_thread_id=f"bench-{conversation_number}",
+        function_map=function_map
+    )
+    await data_guy.add_message("Which team does Jayson Tatum play for?")
+    await data_guy.do_run()
+
+    return time.perf_counter() - start_time
+
+
+async def run_benchmark(conversations: int, concurrency: int) -> list:
+    """
+    Run the conversations with at most `concurrency` at the same time.
+    :param conversations: The number of conversations.
+    :param concurrency: The most conversations at the same time.
+    :return: The seconds each conversation took.
+    """
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def bounded_conversation(conversation_number: int) -> float:
+        async with slots:
+            return await run_conversation(conversation_number)
+
+    # Create the assistants and warm the name index so they aren't part of the numbers
+    await run_conversation(-1)
+
+    timings = list(await asyncio.gather(*[bounded_conversation(number) for number in range(conversations)]))
+    await close_async_openai_client()
+
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the agent framework overhead against the fake OpenAI API.")
+    parser.add_argument("--conversations", type=int, default=50, help="The number of conversations.")
+    parser.add_argument("--concurrency", type=int, default=10, help="The most conversations at the same time.")
+    parser.add_argument("--request", type=float, default=0.0, help="The latency of each API request in seconds.")
+    parser.add_argument("--run-step", type=float, default=0.0, help="The time each run step takes in seconds.")
+    args = parser.parse_args()
+
+    backend = FakeBackend({**DATA_GUY_SCRIPT, "latency": {"request": args.request, "run_step": args.run_step}})
+    use_fake_openai(backend)
+
+    total_start = time.perf_counter()
+    timings = asyncio.run(run_benchmark(args.conversations, args.concurrency))
+    total_time = time.perf_counter() - total_start
+
+    timings.sort()
+    logging.info(
+        f"{args.conversations} conversations at concurrency {args.concurrency} in {round(total_time, 2)}s: "
+        f"p50 {round(statistics.median(timings) * 1000, 1)}ms, "
+        f"p95 {round(timings[int(len(timings) * 0.95) - 1] * 1000, 1)}ms, "
+        f"{round(args.conversations / total_time, 1)} conversations/s, {backend.request_count} API requests."
+    )
@@ -0,0 +1,106 @@
+"""
+Benchmark the columnar engine against the Mongo path of doc_lookup on a real lineup snapshot.
+
+Run from the src directory:
+
+    python -m benchmarks.data_lookup_bench [--doc-id <doc_id>] [--repeat 20]
+
+If no doc_id is given the most recent lineup snapshot in swarm_facts is used.
+"""
+
+from settings import logging, DB
+from columnar_engine import ColumnarEngine
+import db_tools
+
+from pymongo import DESCENDING
+import argparse
+import statistics
+import time
+
+
+# Query shapes the data guy commonly sends for lineups
+LINEUP_QUERIES = [
+    ({}, None, None),
+    ({}, "PLUS_MINUS:DESCENDING", 10),
+    ({"MIN": {"$gte": 100}}, "NET_RATING:DESCENDING", 5),
+    ({"GROUP_NAME": {"$regex": "james", "$options": "i"}}, None, None),
+    ({"$or": [{"TEAM_ABBREVIATION": "BOS"}, {"TEAM_ABBREVIATION": "DEN"}]}, "MIN:DESCENDING", 20),
+]
+
+
+def latest_lineup_doc_id() -> str | None:
+    """
+    Find the doc_id of the most recent lineup snapshot.
+    :return: The doc_id or None if there are no lineup snapshots.
+    """
+
+    doc = DB['swarm_facts'].find_one({"GROUP_NAME": {"$exists": True}}, sort=[("createdAt", DESCENDING)])
+    return doc["doc_id"] if doc else None
+
+
+def time_lookup(query: dict, sort: str | None, limit: int | None, repeat: int) -> tuple[list, str]:
+    """
+    Time doc_lookup for a query.
+    :param query: The query.
+    :param sort: The sort string.
+    :param limit: The limit.
+    :param repeat: The number of times to run the lookup.
+    :return: The timings in milliseconds and the output of the last run.
+    """
+
+    timings = []
+    output = ""
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = db_tools.doc_lookup(query=query, sort=sort, limit=limit)
+        timings.append((time.perf_counter() - start_time) * 1000)
+
+    return timings, output
+
+
+def run_benchmark(doc_id: str, repeat: int) -> None:
+    """
+    Run every lineup query through the Mongo path and the columnar engine and log the results.
+    :param doc_id: The doc_id of the snapshot to query.
+    :param repeat: The number of times to run each lookup.
+    :return: None
+    """
+
+    rows = DB['swarm_facts'].count_documents({"doc_id": doc_id})
+    logging.info(f"Benchmarking snapshot {doc_id} with {rows} rows.")
+
+    engine = ColumnarEngine(max_bytes=512 * 1024 * 1024)
+
+    # Time the cold load separately so the query timings only measure the warm path
+    start_time = time.perf_counter()
+    engine.get_frame(doc_id)
+    logging.info(f"Columnar engine cold load: {round((time.perf_counter() - start_time) * 1000, 1)} ms")
+
+    for query, sort, limit in LINEUP_QUERIES:
+        full_query = {"doc_id": doc_id, **query}
+
+        db_tools.columnar_engine = None
+        mongo_timings, mongo_output = time_lookup(full_query, sort, limit, repeat)
+
+        db_tools.columnar_engine = engine
+        engine_timings, engine_output = time_lookup(full_query, sort, limit, repeat)
+
+        logging.info(
+            f"{query} sort={sort} limit={limit}: "
+            f"mongo p50 {round(statistics.median(mongo_timings), 1)} ms, "
+            f"engine p50 {round(statistics.median(engine_timings), 1)} ms, "
+            f"same output: {mongo_output == engine_output}"
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the columnar engine against Mongo for data_lookup.")
+    parser.add_argument("--doc-id", help="The doc_id of the snapshot to query.")
+    parser.add_argument("--repeat", type=int, default=20, help="The number of times to run each lookup.")
+    args = parser.parse_args()
+
+    snapshot_doc_id = args.doc_id or latest_lineup_doc_id()
+    if not snapshot_doc_id:
+        logging.error("No lineup snapshot found in swarm_facts.")
+    else:
+        run_benchmark(snapshot_doc_id, args.repeat)
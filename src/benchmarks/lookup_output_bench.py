@@ -0,0 +1,93 @@
+"""
+Measure the size and serialization time of data_lookup output before and after the compact format.
+
+Run from the src directory:
+
+    python -m benchmarks.lookup_output_bench [--doc-id <doc_id>] [--repeat 20]
+
+If no doc_id is given the most recent lineup snapshot in swarm_facts is used.
+"""
+
+from settings import logging, DB
+from db_tools import format_rows, HIDDEN_LOOKUP_FIELDS
+from benchmarks.data_lookup_bench import latest_lineup_doc_id
+
+from bson.json_util import dumps
+import argparse
+import statistics
+import time
+
+
+def legacy_format(docs: list) -> str:
+    """
+    Format docs the way doc_lookup did before the compact format: str() of a list of bson dumps strings.
+    :param docs: The docs from Mongo.
+    :return: The output string.
+    """
+
+    data_list = []
+    for doc in docs:
+        doc = dict(doc)
+        del doc["_id"]
+        data_list.append(dumps(doc))
+    return str(data_list)
+
+
+def compact_format(docs: list, fields: list = None) -> str:
+    """
+    Format docs with the compact format, projecting them the same way doc_lookup does.
+    :param docs: The docs from Mongo.
+    :param fields: The fields to keep. The bookkeeping fields are dropped if not given.
+    :return: The output string.
+    """
+
+    if fields:
+        rows = [{field: doc.get(field) for field in fields} for doc in docs]
+    else:
+        rows = [{key: value for key, value in doc.items() if key not in HIDDEN_LOOKUP_FIELDS} for doc in docs]
+    # Use an unlimited budget so both formats cover the same rows
+    return format_rows(rows, max_rows=len(rows) + 1, max_bytes=2 ** 62)
+
+
+def measure(name: str, format_function, docs: list, repeat: int) -> None:
+    """
+    Log the output size and serialization time of a format.
+    :param name: The name of the format.
+    :param format_function: The function that formats the docs.
+    :param docs: The docs from Mongo.
+    :param repeat: The number of times to format the docs.
+    :return: None
+    """
+
+    timings = []
+    output = ""
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = format_function(docs)
+        timings.append((time.perf_counter() - start_time) * 1000)
+
+    logging.info(
+        f"{name}: {len(output.encode('utf-8'))} bytes, "
+        f"p50 {round(statistics.median(timings), 2)} ms over {len(docs)} rows"
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure data_lookup output size and serialization time.")
+    parser.add_argument("--doc-id", help="The doc_id of the snapshot to format.")
+    parser.add_argument("--repeat", type=int, default=20, help="The number of times to format the rows.")
+    args = parser.parse_args()
+
+    snapshot_doc_id = args.doc_id or latest_lineup_doc_id()
+    if not snapshot_doc_id:
+        logging.error("No lineup snapshot found in swarm_facts.")
+    else:
+        snapshot_docs = list(DB['swarm_facts'].find({"doc_id": snapshot_doc_id}))
+        measure("legacy", legacy_format, snapshot_docs, args.repeat)
+        measure("compact", compact_format, snapshot_docs, args.repeat)
+        measure(
+            "compact with fields",
+            lambda docs: compact_format(docs, ["GROUP_NAME", "TEAM_ABBREVIATION", "MIN", "NET_RATING"]),
+            snapshot_docs,
+            args.repeat
+        )
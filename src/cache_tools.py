@@ -0,0 +1,235 @@
+from settings import logging, DB
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+import hashlib
+import time
+import json
+
+
+def make_cache_key(*parts) -> str:
+    """
+    Build a stable cache key from any number of JSON-serializable parts. Dictionaries are serialized with sorted keys
+    so that the same kwargs in a different order produce the same key.
+    :param parts: The parts that identify the cached value.
+    :return: A hex digest that can be used as a cache key.
+    """
+
+    raw_key = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    A process-wide cache with size-bounded LRU eviction and a TTL per entry. The in-process tier is always used. If a
+    collection name is given then a Mongo-backed tier is also used so that cached values are shared across workers.
+
+    Values in the in-process tier are stored as-is so callers must not mutate what they get back. Values written to the
+    shared tier go through `serialize` and come back through `deserialize`.
+    """
+    def __init__(
+            self,
+            name: str,
+            max_entries: int,
+            default_ttl: int | None,
+            collection: str = None,
+            serialize=None,
+            deserialize=None
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.collection = collection
+        self.serialize = serialize if serialize else (lambda value: value)
+        self.deserialize = deserialize if deserialize else (lambda value: value)
+
+        # Set by jobs that want to refresh the cache. refresh_only makes every lookup a miss so values are fetched
+        # again and min_ttl keeps what they write around for at least that many seconds.
+        self.refresh_only = False
+        self.min_ttl = 0
+
+        # The key is the cache key and the value is a tuple of (expires_at, value). expires_at is a monotonic time or
+        # None if the entry never expires.
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str):
+        """
+        Get a value from the cache. The in-process tier is checked first and then the shared tier.
+        :param key: The cache key.
+        :return: The cached value or None if it is missing or expired.
+        """
+
+        if self.refresh_only:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    # Mark the entry as recently used
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                # The entry has expired so drop it
+                del self.entries[key]
+                self.expirations += 1
+
+        value, ttl = self.get_shared(key)
+        if value is not None:
+            # Promote the shared entry into the in-process tier for the rest of its lifetime
+            self.put_local(key, value, ttl)
+            with self.lock:
+                self.shared_hits += 1
+            return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value, ttl: int | None = -1) -> None:
+        """
+        Put a value in the cache.
+        :param key: The cache key.
+        :param value: The value to cache.
+        :param ttl: The time to live in seconds. None means the entry never expires. If not given the default TTL is
+        used.
+        :return: None
+        """
+
+        if ttl == -1:
+            ttl = self.default_ttl
+        if ttl is not None and ttl < self.min_ttl:
+            ttl = self.min_ttl
+
+        self.put_local(key, value, ttl)
+        self.put_shared(key, value, ttl)
+
+        return
+
+    def put_local(self, key: str, value, ttl: int | None) -> None:
+        """
+        Put a value in the in-process tier and evict the least recently used entries if the cache is full.
+        :param key: The cache key.
+        :param value: The value to cache.
+        :param ttl: The time to live in seconds or None if the entry never expires.
+        :return: None
+        """
+
+        expires_at = None if ttl is None else time.monotonic() + ttl
+
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return
+
+    def get_shared(self, key: str) -> tuple:
+        """
+        Get a value from the shared tier.
+        :param key: The cache key.
+        :return: A tuple of (value, remaining ttl). The value is None if there is no shared tier or the entry is
+        missing or expired.
+        """
+
+        if not self.collection:
+            return None, None
+
+        try:
+            doc = DB[self.collection].find_one({"_id": key})
+        except Exception as e:
+            logging.error(f"Failed to read {self.name} cache entry from DB. Error: {e}")
+            return None, None
+
+        if not doc:
+            return None, None
+
+        # Mongo only removes expired documents periodically so check the expiry here as well
+        expires_at = doc.get("expiresAt")
+        if expires_at is None:
+            ttl = None
+        else:
+            ttl = (expires_at - datetime.utcnow()).total_seconds()
+            if ttl <= 0:
+                return None, None
+
+        return self.deserialize(doc["value"]), ttl
+
+    def put_shared(self, key: str, value, ttl: int | None) -> None:
+        """
+        Put a value in the shared tier. Failures are logged and otherwise ignored since the shared tier is only an
+        optimization.
+        :param key: The cache key.
+        :param value: The value to cache.
+        :param ttl: The time to live in seconds or None if the entry never expires.
+        :return: None
+        """
+
+        if not self.collection:
+            return
+
+        doc = {
+            "_id": key,
+            "cache": self.name,
+            "value": self.serialize(value),
+            "createdAt": datetime.utcnow(),
+            "expiresAt": None if ttl is None else datetime.utcnow() + timedelta(seconds=ttl)
+        }
+
+        try:
+            DB[self.collection].replace_one({"_id": key}, doc, upsert=True)
+        except Exception as e:
+            logging.error(f"Failed to write {self.name} cache entry to DB. Error: {e}")
+
+        return
+
+    def invalidate(self, key: str) -> None:
+        """
+        Remove a value from both tiers of the cache.
+        :param key: The cache key.
+        :return: None
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+        if self.collection:
+            try:
+                DB[self.collection].delete_one({"_id": key})
+            except Exception as e:
+                logging.error(f"Failed to remove {self.name} cache entry from DB. Error: {e}")
+
+        return
+
+    def stats(self) -> dict:
+        """
+        Get the hit/miss counters for the cache.
+        :return: The counters and the current size of the in-process tier.
+        """
+
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "name": self.name,
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0
+            }
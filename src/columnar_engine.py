@@ -0,0 +1,447 @@
+from settings import logging, DB, FACTS_RETENTION_DAYS
+from pymongo import ASCENDING
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import pandas as pd
+import numpy as np
+import threading
+import re
+
+
+class UnsupportedQuery(ValueError):
+    """
+    Raised when a query uses something the columnar engine can't evaluate. The caller should fall back to Mongo.
+    """
+
+
+# Map the Mongo regex options to the python re flags
+REGEX_FLAGS = {
+    "i": re.IGNORECASE,
+    "m": re.MULTILINE,
+    "s": re.DOTALL,
+    "x": re.VERBOSE
+}
+
+
+def regex_mask(series: pd.Series, pattern: str, options: str = "") -> pd.Series:
+    """
+    Match a column against a regex the way Mongo does. Values that aren't strings never match.
+    :param series: The column.
+    :param pattern: The regex pattern.
+    :param options: The Mongo regex options, e.g. "i".
+    :return: A boolean mask.
+    """
+
+    flags = 0
+    for option in options:
+        if option not in REGEX_FLAGS:
+            raise UnsupportedQuery(f"Unsupported regex option: {option}")
+        flags |= REGEX_FLAGS[option]
+
+    if series.dtype != object:
+        return pd.Series(False, index=series.index)
+
+    return series.str.contains(pattern, flags=flags, regex=True, na=False).astype(bool)
+
+
+def operator_mask(series: pd.Series, operators: dict) -> pd.Series:
+    """
+    Evaluate a dictionary of query operators against a column, e.g. {"$gte": 10, "$lt": 20}.
+    :param series: The column.
+    :param operators: The operators and their values.
+    :return: A boolean mask.
+    """
+
+    mask = pd.Series(True, index=series.index)
+
+    for operator, value in operators.items():
+        if operator == "$eq":
+            mask &= equality_mask(series, value)
+        elif operator == "$ne":
+            mask &= ~equality_mask(series, value)
+        elif operator == "$gt":
+            mask &= (series > value).fillna(False)
+        elif operator == "$gte":
+            mask &= (series >= value).fillna(False)
+        elif operator == "$lt":
+            mask &= (series < value).fillna(False)
+        elif operator == "$lte":
+            mask &= (series <= value).fillna(False)
+        elif operator == "$in":
+            mask &= series.isin(value)
+        elif operator == "$nin":
+            mask &= ~series.isin(value)
+        elif operator == "$exists":
+            mask &= series.notna() if value else series.isna()
+        elif operator == "$regex":
+            mask &= regex_mask(series, value, operators.get("$options", ""))
+        elif operator == "$options":
+            # Handled together with $regex
+            continue
+        elif operator == "$not":
+            if not isinstance(value, dict):
+                raise UnsupportedQuery("$not only supports operator expressions.")
+            mask &= ~operator_mask(series, value)
+        else:
+            raise UnsupportedQuery(f"Unsupported operator: {operator}")
+
+    return mask
+
+
+def equality_mask(series: pd.Series, value) -> pd.Series:
+    """
+    Match a column against a value. A None value matches missing values like it does in Mongo.
+    :param series: The column.
+    :param value: The value to match.
+    :return: A boolean mask.
+    """
+
+    if value is None:
+        return series.isna()
+
+    if isinstance(value, (dict, list)):
+        raise UnsupportedQuery("Matching embedded documents or arrays is not supported.")
+
+    return (series == value).fillna(False)
+
+
+def query_mask(frame: pd.DataFrame, query: dict) -> pd.Series:
+    """
+    Build a boolean mask for a Mongo-style query over a frame.
+    :param frame: The snapshot frame.
+    :param query: The query.
+    :return: A boolean mask.
+    """
+
+    mask = pd.Series(True, index=frame.index)
+
+    for key, value in query.items():
+        if key == "$and":
+            for sub_query in value:
+                mask &= query_mask(frame, sub_query)
+        elif key == "$or":
+            or_mask = pd.Series(False, index=frame.index)
+            for sub_query in value:
+                or_mask |= query_mask(frame, sub_query)
+            mask &= or_mask
+        elif key == "$nor":
+            for sub_query in value:
+                mask &= ~query_mask(frame, sub_query)
+        elif key.startswith("$") or "." in key:
+            raise UnsupportedQuery(f"Unsupported query key: {key}")
+        else:
+            # A field that isn't in the snapshot behaves like a column of missing values
+            series = frame[key] if key in frame.columns else pd.Series(None, index=frame.index, dtype=object)
+            if isinstance(value, dict) and any(operator.startswith("$") for operator in value):
+                mask &= operator_mask(series, value)
+            else:
+                mask &= equality_mask(series, value)
+
+    return mask
+
+
+def to_python(value):
+    """
+    Convert numpy scalars and missing values into plain python values so they serialize like Mongo values.
+    :param value: The value.
+    :return: The python value.
+    """
+
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+
+    return value
+
+
+def compute_metric(rows: pd.DataFrame, metric: dict):
+    """
+    Compute one aggregation metric over a set of rows.
+    :param rows: The rows.
+    :param metric: The validated metric from the aggregation spec.
+    :return: The value of the metric.
+    """
+
+    if metric["op"] == "count":
+        return len(rows)
+
+    if metric["field"] not in rows.columns:
+        return 0 if metric["op"] == "sum" else None
+
+    series = pd.to_numeric(rows[metric["field"]], errors="coerce")
+    if metric["op"] == "avg":
+        return to_python(series.mean())
+    if metric["op"] == "sum":
+        return to_python(series.sum())
+    if metric["op"] == "min":
+        return to_python(series.min())
+    if metric["op"] == "max":
+        return to_python(series.max())
+    if metric["op"] == "percentile":
+        # The discrete percentile: the smallest value with at least p of the values at or below it. Mongo's
+        # approximate $percentile estimates the same value and can be slightly off on large inputs.
+        values = series.dropna().to_numpy()
+        return to_python(np.quantile(values, metric["p"], method="inverted_cdf")) if len(values) else None
+
+    raise UnsupportedQuery(f"Unsupported metric op: {metric['op']}")
+
+
+def top_rows(rows: pd.DataFrame, top_k: dict) -> list:
+    """
+    Get the top k rows by a field.
+    :param rows: The rows.
+    :param top_k: The validated top_k from the aggregation spec.
+    :return: The top rows with only the requested fields.
+    """
+
+    if top_k["field"] not in rows.columns:
+        return []
+
+    # Mongo sorts missing values as the lowest, so they come first when ascending
+    ascending = top_k["order"] == ASCENDING
+    top = rows.sort_values(
+        by=top_k["field"],
+        ascending=ascending,
+        kind="mergesort",
+        na_position="first" if ascending else "last"
+    ).head(top_k["k"])
+    top = top[[field for field in top_k["fields"] if field in top.columns]]
+
+    return [{key: to_python(value) for key, value in row.items()} for row in top.to_dict('records')]
+
+
+def summarize(rows: pd.DataFrame, spec: dict) -> dict:
+    """
+    Compute the count, metrics and top rows for a set of rows.
+    :param rows: The rows.
+    :param spec: The validated aggregation spec.
+    :return: The summary.
+    """
+
+    summary = {"count": len(rows)}
+    for metric in spec["metrics"]:
+        summary[metric["as"]] = compute_metric(rows, metric)
+    if spec["top_k"]:
+        summary["top"] = top_rows(rows, spec["top_k"])
+
+    return summary
+
+
+def frame_expiry(frame: pd.DataFrame) -> datetime | None:
+    """
+    Get the time the TTL index can start removing the rows of a snapshot. The rows of a reused snapshot get a newer
+    createdAt so this can be early, which only means the frame is loaded again.
+    :param frame: The frame of the snapshot.
+    :return: The time, or None if the snapshot is immutable and never removed.
+    """
+
+    if "immutable" in frame.columns and frame["immutable"].eq(True).all():
+        return None
+
+    oldest = pd.to_datetime(frame["createdAt"]).min() if "createdAt" in frame.columns else pd.NaT
+    created_at = datetime.utcnow() if pd.isna(oldest) else oldest.to_pydatetime()
+
+    return created_at + timedelta(days=FACTS_RETENTION_DAYS)
+
+
+class ColumnarEngine:
+    """
+    An in-process query engine over swarm_facts snapshots. Each doc_id snapshot is loaded once from Mongo into a
+    pandas frame and kept in memory until the memory budget forces it out. Snapshots are content-addressed so a cached
+    frame never changes, but it is dropped once the TTL index can remove its rows so a lookup never finds facts that
+    are gone from Mongo. Mongo is still the persistence layer.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+
+        # doc_id -> frame, ordered from least to most recently used
+        self.frames = OrderedDict()
+        self.frame_sizes = {}
+        # doc_id -> when the TTL index can remove the snapshot. None for immutable snapshots.
+        self.frame_expiries = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def load_frame(self, doc_id: str) -> pd.DataFrame:
+        """
+        Load a snapshot from swarm_facts into a frame.
+        :param doc_id: The doc_id of the snapshot.
+        :return: The frame. It is empty if the snapshot doesn't exist.
+        """
+
+        docs = DB['swarm_facts'].find({"doc_id": doc_id}, {"_id": 0})
+        frame = pd.DataFrame(list(docs))
+        logging.info(f"Loaded snapshot {doc_id} into the columnar engine ({len(frame)} rows).")
+        return frame
+
+    def put_frame(self, doc_id: str, frame: pd.DataFrame) -> None:
+        """
+        Keep a frame in memory and evict the least recently used frames if the memory budget is exceeded.
+        :param doc_id: The doc_id of the snapshot.
+        :param frame: The frame.
+        :return: None
+        """
+
+        frame_size = int(frame.memory_usage(deep=True).sum())
+        if frame_size > self.max_bytes:
+            logging.info(f"Snapshot {doc_id} is larger than the columnar engine budget. Not caching it.")
+            return
+        expires_at = frame_expiry(frame)
+
+        with self.lock:
+            if doc_id in self.frames:
+                return
+
+            self.frames[doc_id] = frame
+            self.frame_sizes[doc_id] = frame_size
+            self.frame_expiries[doc_id] = expires_at
+            self.total_bytes += frame_size
+
+            while self.total_bytes > self.max_bytes:
+                evicted_id, _ = self.frames.popitem(last=False)
+                self.total_bytes -= self.frame_sizes.pop(evicted_id)
+                self.frame_expiries.pop(evicted_id)
+                logging.debug(f"Evicted snapshot {evicted_id} from the columnar engine.")
+
+        return
+
+    def get_frame(self, doc_id: str) -> pd.DataFrame:
+        """
+        Get the frame for a snapshot, loading it from Mongo if it isn't in memory or the TTL index may have removed it.
+        :param doc_id: The doc_id of the snapshot.
+        :return: The frame.
+        """
+
+        with self.lock:
+            frame = self.frames.get(doc_id)
+            if frame is not None:
+                expires_at = self.frame_expiries[doc_id]
+                if expires_at is None or datetime.utcnow() < expires_at:
+                    self.frames.move_to_end(doc_id)
+                    return frame
+
+                # Load it again. It is gone if the snapshot was removed and has a newer createdAt if it was reused.
+                del self.frames[doc_id]
+                self.total_bytes -= self.frame_sizes.pop(doc_id)
+                self.frame_expiries.pop(doc_id)
+                logging.info(f"Snapshot {doc_id} may have expired. Dropped it from the columnar engine.")
+
+        frame = self.load_frame(doc_id)
+        if not frame.empty:
+            self.put_frame(doc_id, frame)
+
+        return frame
+
+    def find(self, query: dict, sort_list: list, limit: int | None, fields: list = None,
+             hidden_fields: tuple = ()) -> list | None:
+        """
+        Evaluate a Mongo-style find over a snapshot. The query must select a single snapshot with a string doc_id.
+        :param query: The query including the doc_id.
+        :param sort_list: A list of (field, ASCENDING/DESCENDING) tuples.
+        :param limit: The number of rows to return.
+        :param fields: The fields to return. If not given all fields except the hidden ones are returned.
+        :param hidden_fields: The fields to leave out when fields isn't given.
+        :return: The matching rows as dictionaries, or None if the query can't be evaluated here.
+        """
+
+        doc_id = query.get("doc_id")
+        if not isinstance(doc_id, str):
+            return None
+
+        try:
+            frame = self.get_frame(doc_id)
+            if frame.empty:
+                return []
+
+            result = frame[query_mask(frame, query)]
+
+            if sort_list:
+                sort_fields = [field for field, _ in sort_list]
+                if any(field not in result.columns for field in sort_fields):
+                    raise UnsupportedQuery("Sorting on a field that isn't in the snapshot.")
+                # Mongo puts missing values first when ascending and last when descending. pandas applies one
+                # na_position to every key, so each key is sorted after a column of its own that says if its value is
+                # missing.
+                by = []
+                ascending = []
+                missing_columns = {}
+                for index, (field, direction) in enumerate(sort_list):
+                    missing_column = f"__missing_{index}"
+                    missing_columns[missing_column] = result[field].isna()
+                    by += [missing_column, field]
+                    ascending += [direction != ASCENDING, direction == ASCENDING]
+                result = result.assign(**missing_columns).sort_values(
+                    by=by,
+                    ascending=ascending,
+                    kind="mergesort"
+                ).drop(columns=list(missing_columns))
+
+            if limit:
+                result = result.iloc[:limit]
+
+            # Project the columns the same way the Mongo projection would
+            if fields:
+                result = result[[field for field in fields if field in result.columns]]
+            else:
+                result = result[[column for column in result.columns if column not in hidden_fields]]
+
+            # Convert to python objects and turn NaN back into None so the rows look like they came from Mongo
+            result = result.astype(object).where(result.notna(), None)
+            return result.to_dict('records')
+        except Exception as e:
+            logging.info(f"Columnar engine can't evaluate the query. Falling back to Mongo. Reason: {e}")
+            return None
+
+    def aggregate(self, spec: dict, match: dict) -> dict | None:
+        """
+        Run a validated aggregation spec over one or more snapshots.
+        :param spec: The validated aggregation spec. See db_tools.validate_aggregation_spec.
+        :param match: The match query including the doc_ids.
+        :return: The reduced result, or None if the spec can't be evaluated here.
+        """
+
+        try:
+            frames = [self.get_frame(doc_id) for doc_id in spec["doc_ids"]]
+            frames = [frame for frame in frames if not frame.empty]
+            if not frames:
+                matched = pd.DataFrame()
+            else:
+                frame = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+                matched = frame[query_mask(frame, match)]
+
+            if not spec["group_by"]:
+                summary = summarize(matched, spec)
+                result = {"count": summary.pop("count"), "metrics": summary}
+                if spec["top_k"]:
+                    result["top"] = summary.pop("top")
+                return result
+
+            # Rows without a group field are grouped under None like the Mongo pipeline does, even if no row has it
+            missing_fields = [field for field in spec["group_by"] if field not in matched.columns]
+            if missing_fields:
+                matched = matched.assign(**{field: None for field in missing_fields})
+
+            groups = []
+            for group_key, group_rows in matched.groupby(spec["group_by"], sort=False, dropna=False):
+                # groupby gives a tuple key when there are several group fields
+                group_values = group_key if isinstance(group_key, tuple) else (group_key,)
+                group = {field: to_python(value) for field, value in zip(spec["group_by"], group_values)}
+                groups.append({**group, **summarize(group_rows, spec)})
+
+            # Sort the groups the same way the Mongo pipeline does. Missing values are the lowest, so they go first when
+            # ascending and last when descending.
+            sort_field = spec["order_by"] or (spec["metrics"][0]["as"] if spec["metrics"] else "count")
+            descending = spec["order"] != ASCENDING
+            groups_with_value = [group for group in groups if group.get(sort_field) is not None]
+            groups_without_value = [group for group in groups if group.get(sort_field) is None]
+            groups_with_value.sort(key=lambda group: group[sort_field], reverse=descending)
+            if descending:
+                groups = groups_with_value + groups_without_value
+            else:
+                groups = groups_without_value + groups_with_value
+
+            return {"groups": groups[:spec["limit"]]}
+        except Exception as e:
+            logging.info(f"Columnar engine can't evaluate the aggregation. Falling back to Mongo. Reason: {e}")
+            return None
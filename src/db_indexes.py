@@ -0,0 +1,225 @@
+"""
+Index management for the swarm collections. ensure_indexes is called when a worker starts and creates the indexes that
+match the query shapes in db_tools, plus the TTL indexes that expire old facts and cache entries.
+
+Run `python db_indexes.py --report` to create the indexes and print an explain-based report of the data_lookup
+query patterns.
+"""
+
+from settings import logging, DB, FACTS_RETENTION_DAYS, FACTS_SORT_INDEX_FIELDS
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+import argparse
+
+# Mongo error codes for creating an index that already exists with different options
+INDEX_OPTIONS_CONFLICT_CODES = (85, 86)
+
+
+def index_specs() -> dict:
+    """
+    Get the indexes each collection should have.
+    :return: A dictionary of collection name to a list of (keys, options) tuples.
+    """
+
+    # data_lookup always filters on doc_id and usually sorts on one stat so each common sort field gets a compound index
+    # with doc_id first. These also serve plain doc_id lookups.
+    facts_indexes = [([("doc_id", ASCENDING), (field, DESCENDING)], {}) for field in FACTS_SORT_INDEX_FIELDS]
+    # Cross-season reads of one endpoint
+    facts_indexes.append(([("endpoint", ASCENDING), ("season", ASCENDING)], {}))
+    # Only live season rows expire. Finished seasons are immutable and kept forever.
+    facts_indexes.append(
+        (
+            [("createdAt", ASCENDING)],
+            {
+                "expireAfterSeconds": FACTS_RETENTION_DAYS * 24 * 60 * 60,
+                "partialFilterExpression": {"immutable": False}
+            }
+        )
+    )
+
+    return {
+        "swarm_facts": facts_indexes,
+        "swarm_convos": [
+            ([("id", ASCENDING)], {})
+        ],
+        "swarm_agents": [
+            ([("call", ASCENDING), ("org_name", ASCENDING), ("id", ASCENDING)], {})
+        ],
+        "swarm_seasons": [
+            ([("endpoint", ASCENDING), ("season", ASCENDING)], {})
+        ],
+        "swarm_api_cache": [
+            # Remove cache entries as soon as they expire. Entries without an expiresAt never expire.
+            ([("expiresAt", ASCENDING)], {"expireAfterSeconds": 0})
+        ],
+        "swarm_llm_cache": [
+            ([("expiresAt", ASCENDING)], {"expireAfterSeconds": 0})
+        ],
+        "swarm_archived_outputs": [
+            ([("expiresAt", ASCENDING)], {"expireAfterSeconds": 0})
+        ]
+    }
+
+
+def ensure_index(collection: str, keys: list, options: dict) -> None:
+    """
+    Create an index if it doesn't exist. If a TTL index exists with a different retention then the retention is
+    updated in place. If it exists with a different partial filter then it is rebuilt.
+    :param collection: The collection name.
+    :param keys: A list of (field, direction) tuples.
+    :param options: The index options.
+    :return: None
+    """
+
+    coll = DB[collection]
+
+    # The partial filter of an index can't be changed in place so rebuild TTL indexes whose filter changed
+    if "expireAfterSeconds" in options:
+        existing_index = find_index(collection, keys)
+        if existing_index and existing_index.get("partialFilterExpression") != options.get("partialFilterExpression"):
+            coll.drop_index(existing_index["name"])
+            logging.info(f"Dropped TTL index {keys} on {collection} to rebuild it with a new filter.")
+
+    try:
+        index_name = coll.create_index(keys, **options)
+        logging.debug(f"Index {index_name} is in place on {collection}.")
+    except OperationFailure as e:
+        if e.code in INDEX_OPTIONS_CONFLICT_CODES and "expireAfterSeconds" in options:
+            DB.command(
+                "collMod",
+                collection,
+                index={"keyPattern": dict(keys), "expireAfterSeconds": options["expireAfterSeconds"]}
+            )
+            logging.info(f"Updated TTL of {keys} on {collection} to {options['expireAfterSeconds']}s.")
+        else:
+            logging.error(f"Failed to create index {keys} on {collection}. Error: {e}")
+
+    return
+
+
+def find_index(collection: str, keys: list) -> dict | None:
+    """
+    Find an existing index by its keys.
+    :param collection: The collection name.
+    :param keys: A list of (field, direction) tuples.
+    :return: The index info including its name or None if there is no such index.
+    """
+
+    for index_name, index_info in DB[collection].index_information().items():
+        if [tuple(key) for key in index_info["key"]] == [tuple(key) for key in keys]:
+            return {"name": index_name, **index_info}
+
+    return None
+
+
+def migrate_facts_immutable_flag() -> None:
+    """
+    Rows added before seasons were partitioned don't have the immutable flag, so the partial TTL index wouldn't expire
+    them. Flag them as live once, while the old TTL index without a partial filter is still in place.
+    :return: None
+    """
+
+    old_ttl_index = find_index("swarm_facts", [("createdAt", ASCENDING)])
+    if not old_ttl_index or "partialFilterExpression" in old_ttl_index:
+        return
+
+    result = DB["swarm_facts"].update_many({"immutable": {"$exists": False}}, {"$set": {"immutable": False}})
+    logging.info(f"Flagged {result.modified_count} existing facts as live season rows.")
+
+    return
+
+
+def ensure_indexes() -> None:
+    """
+    Create every index in index_specs. Failures are logged and don't stop the worker from starting.
+    :return: None
+    """
+
+    logging.info("Ensuring DB indexes.")
+
+    try:
+        migrate_facts_immutable_flag()
+    except Exception as e:
+        logging.error(f"Failed to migrate the immutable flag on facts. Error: {e}")
+
+    for collection, indexes in index_specs().items():
+        for keys, options in indexes:
+            try:
+                ensure_index(collection, keys, options)
+            except Exception as e:
+                logging.error(f"Failed to ensure index {keys} on {collection}. Error: {e}")
+
+    return
+
+
+def plan_stages(plan: dict) -> list:
+    """
+    Flatten a winning plan from explain into a list of (stage, index name) tuples.
+    :param plan: The winning plan.
+    :return: The stages from the root of the plan down.
+    """
+
+    stages = [(plan.get("stage"), plan.get("indexName"))]
+    if "inputStage" in plan:
+        stages += plan_stages(plan["inputStage"])
+    for input_stage in plan.get("inputStages", []):
+        stages += plan_stages(input_stage)
+
+    return stages
+
+
+def index_report(doc_id: str) -> list:
+    """
+    Explain the query patterns data_lookup sends and check that each one uses an index instead of a collection scan.
+    :param doc_id: The doc_id of a snapshot to run the patterns against.
+    :return: A report entry for each pattern.
+    """
+
+    coll = DB["swarm_facts"]
+
+    # The query shapes the data guy sends through data_lookup
+    patterns = [({"doc_id": doc_id}, None)]
+    patterns += [({"doc_id": doc_id}, [(field, DESCENDING)]) for field in FACTS_SORT_INDEX_FIELDS]
+    patterns.append(({"doc_id": doc_id, "TEAM_ID": 1610612738}, None))
+    patterns.append(({"doc_id": doc_id, "MIN": {"$gte": 100}}, [(FACTS_SORT_INDEX_FIELDS[0], DESCENDING)]))
+
+    report = []
+    for query, sort_list in patterns:
+        cursor = coll.find(query, {"_id": 0}).limit(10)
+        if sort_list:
+            cursor = cursor.sort(sort_list)
+
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        # Newer servers wrap the classic plan in queryPlan
+        winning_plan = winning_plan.get("queryPlan", winning_plan)
+        stages = plan_stages(winning_plan)
+
+        entry = {
+            "query": query,
+            "sort": sort_list,
+            "stages": [stage for stage, _ in stages],
+            "indexes": [index_name for _, index_name in stages if index_name],
+            "collection_scan": any(stage == "COLLSCAN" for stage, _ in stages)
+        }
+        report.append(entry)
+
+        status = "COLLSCAN" if entry["collection_scan"] else f"uses {entry['indexes']}"
+        logging.info(f"{query} sort={sort_list}: {status}")
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create the DB indexes and report on the data_lookup query plans.")
+    parser.add_argument("--report", action="store_true", help="Print the explain report.")
+    parser.add_argument("--doc-id", help="The doc_id of a snapshot to explain the patterns against.")
+    args = parser.parse_args()
+
+    ensure_indexes()
+
+    if args.report:
+        report_doc_id = args.doc_id
+        if not report_doc_id:
+            latest_doc = DB["swarm_facts"].find_one({}, {"doc_id": 1}, sort=[("createdAt", DESCENDING)])
+            report_doc_id = latest_doc["doc_id"] if latest_doc else "missing"
+        index_report(report_doc_id)
@@ -1,6 +1,17 @@
-from settings import logging, DB, SYS_MODE
+from settings import (logging, DB, SYS_MODE, COLUMNAR_ENGINE, COLUMNAR_ENGINE_MAX_MB, LOOKUP_FLOAT_PRECISION,
+                      LOOKUP_MAX_ROWS, LOOKUP_MAX_BYTES, LOOKUP_MAX_TOKENS, FACTS_RETENTION_DAYS)
 from pymongo import ASCENDING, DESCENDING
-from bson.json_util import dumps
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from columnar_engine import ColumnarEngine
+from tracing import traced, get_current_span
+from datetime import datetime, timedelta
+import binascii
+import base64
+import math
+import json
+
+# The columnar engine is optional. When it is off every lookup goes to Mongo.
+columnar_engine = ColumnarEngine(max_bytes=COLUMNAR_ENGINE_MAX_MB * 1024 * 1024) if COLUMNAR_ENGINE else None
 
 
 def create_convo_doc(main_thread_id: str) -> None:
@@ -22,6 +33,7 @@ def create_convo_doc(main_thread_id: str) -> None:
     return
 
 
+@traced("db.add_to_convo")
 def add_to_convo(main_thread_id: str, msg_dict: dict) -> bool:
     """
     Add a message to the conversation in the database.
@@ -96,18 +108,159 @@ def get_agent_from_db(agent_call: str, org_name: str, agent_id: str = None) -> d
     return agent
 
 
-def doc_lookup(query: dict, sort: str | None, limit: int | None) -> str:
+# Bookkeeping fields that are left out of lookups unless they are asked for
+HIDDEN_LOOKUP_FIELDS = ("_id", "doc_id", "createdAt", "endpoint", "immutable")
+
+
+def compact_value(value, precision: int):
+    """
+    Get a value ready for the compact lookup output. Floats are rounded and NaN becomes null.
+    :param value: The value.
+    :param precision: The number of decimal places to round floats to.
+    :return: The compact value.
+    """
+
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        return round(value, precision)
+
+    return value
+
+
+def lookup_byte_budget() -> int:
+    """
+    Get the byte budget of one lookup page. The token budget is estimated at 4 bytes per token.
+    :return: The most bytes of rows in one page.
+    """
+
+    if LOOKUP_MAX_TOKENS > 0:
+        return min(LOOKUP_MAX_BYTES, LOOKUP_MAX_TOKENS * 4)
+
+    return LOOKUP_MAX_BYTES
+
+
+def encode_lookup_cursor(state: dict) -> str:
+    """
+    Encode the state of a lookup into an opaque cursor the agent can pass back for the next page.
+    :param state: The query, sort, limit, fields, offset and total of the lookup.
+    :return: The cursor.
+    """
+
+    state_json = json.dumps(state, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(state_json.encode()).decode()
+
+
+def decode_lookup_cursor(cursor: str) -> dict:
+    """
+    Decode a cursor from encode_lookup_cursor.
+    :param cursor: The cursor.
+    :return: The state of the lookup.
+    """
+
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+    if not isinstance(state, dict) or not isinstance(state.get("query"), dict):
+        raise ValueError("Invalid cursor.")
+
+    return state
+
+
+def format_rows(rows, precision: int = LOOKUP_FLOAT_PRECISION, max_rows: int = LOOKUP_MAX_ROWS,
+                max_bytes: int = LOOKUP_MAX_BYTES, cursor_state: dict = None) -> str:
+    """
+    Format lookup rows as compact JSON: a header row with the column names and a list of value rows. Column names are
+    only written once and rows stop being added when the row or byte budget is reached. Rows are read one at a time so
+    a Mongo cursor is never read further than one row past the budget.
+    :param rows: An iterable of row dictionaries.
+    :param precision: The number of decimal places to round floats to.
+    :param max_rows: The most rows to return.
+    :param max_bytes: The most bytes of rows to return.
+    :param cursor_state: The state of the lookup. If given, the total is added and a next_cursor is added when there
+    are more rows.
+    :return: The JSON string.
+    """
+
+    columns = []
+    column_set = set()
+    row_values = []
+    total_bytes = 0
+    truncated = False
+
+    for row in rows:
+        if len(row_values) >= max_rows:
+            truncated = True
+            break
+
+        # Rows can have different keys, e.g. a season without some stat, so the columns are every key seen so far
+        # in the order they were first seen. Earlier rows are padded with nulls for columns added after them.
+        new_columns = [column for column in row.keys() if column not in column_set]
+        values = [compact_value(row.get(column), precision) for column in columns + new_columns]
+        row_bytes = len(json.dumps(values, separators=(',', ':'), default=str))
+
+        if total_bytes + row_bytes > max_bytes and row_values:
+            truncated = True
+            break
+
+        columns.extend(new_columns)
+        column_set.update(new_columns)
+        row_values.append(values)
+        total_bytes += row_bytes + 1
+
+    row_strings = [
+        json.dumps(values + [None] * (len(columns) - len(values)), separators=(',', ':'), default=str)
+        for values in row_values
+    ]
+
+    header = json.dumps(columns, separators=(',', ':'))
+    result = f'{{"columns":{header},"rows":[{",".join(row_strings)}],"returned":{len(row_strings)}'
+
+    if cursor_state is not None:
+        result += f',"total":{cursor_state["total"]}'
+        if truncated:
+            next_cursor = encode_lookup_cursor({**cursor_state, "offset": cursor_state["offset"] + len(row_strings)})
+            result += (
+                f',"next_cursor":"{next_cursor}","note":"More rows match. Pass next_cursor to data_lookup for the '
+                f'next page, or narrow the query, add a limit or select fields."'
+            )
+    elif truncated:
+        result += ',"truncated":true,"note":"Output budget reached. Narrow the query, add a limit or select fields."'
+    result += '}'
+
+    return result
+
+
+@traced("db.doc_lookup")
+def doc_lookup(query: dict, sort: str | None, limit: int | None, fields: list = None, cursor: str = None) -> str:
     """
     Look up info in a collection. When info is sourced via api the agent will insert it into swarm_facts collection.
     If the data is a list of dictionaries then they will be inserted as separate documents with a shared ID.
     This id is used to look up the data in the collection. If the data is a single dictionary then it will be inserted
     as a single document with the id of the document being the doc_id.
+
+    Results are paged. Each page fits in the lookup budget and comes with the total number of matching documents and a
+    next_cursor if there are more.
     :param query: The query to find the info in the doc this will include the ID.
     :param sort: The sort order.
     :param limit: The number of documents to return.
-    :return: The document.
+    :param fields: The fields to return. All fields except the bookkeeping ones are returned if not given.
+    :param cursor: The next_cursor of the previous page. If given the query, sort, limit and fields are taken from it.
+    :return: The matching documents in the compact format from format_rows.
     """
 
+    offset = 0
+    total = None
+    if cursor:
+        try:
+            state = decode_lookup_cursor(cursor)
+        except ValueError as e:
+            return f"Failed to find info in doc/s. Error: {e}"
+        query, sort, limit, fields = state["query"], state.get("sort"), state.get("limit"), state.get("fields")
+        offset, total = state.get("offset", 0), state.get("total")
+
     # Parse the sort
     sort_map = {
         "ASCENDING": ASCENDING,
@@ -122,29 +275,351 @@ def doc_lookup(query: dict, sort: str | None, limit: int | None) -> str:
             sort_tuple = tuple(sort_option.split(":"))
             sort_list.append((sort_tuple[0], sort_map[sort_tuple[1]]))
 
+    # Build the projection. Mongo doesn't allow mixing included and excluded fields except for _id.
+    if fields:
+        projection = {field: 1 for field in fields}
+        projection["_id"] = 0
+    else:
+        projection = {field: 0 for field in HIDDEN_LOOKUP_FIELDS}
+
+    # Everything needed to get the next page
+    cursor_state = {"query": query, "sort": sort, "limit": limit, "fields": fields, "offset": offset, "total": total}
+
+    # Serve single snapshot lookups from the columnar engine if it is on. It returns None if it can't handle the query.
+    if columnar_engine:
+        rows = columnar_engine.find(query, sort_list, limit, fields, HIDDEN_LOOKUP_FIELDS)
+        if rows is not None:
+            logging.info("Found info in doc/s with the columnar engine.")
+            cursor_state["total"] = len(rows)
+            return format_rows(rows[offset:], max_bytes=lookup_byte_budget(), cursor_state=cursor_state)
+
+    # The last page of a limited lookup has already been returned
+    if limit and offset >= limit:
+        return format_rows([], cursor_state=cursor_state)
+
     coll = DB['swarm_facts']
 
     try:
-        if sort_list and limit:
-            data = coll.find(query).sort(sort_list).limit(limit)
-        elif sort_list:
-            data = coll.find(query).sort(sort_list)
-        elif limit:
-            data = coll.find(query).limit(limit)
-        else:
-            data = coll.find(query)
+        # The total is counted on the first page and carried in the cursor after that
+        if cursor_state["total"] is None:
+            count_options = {"limit": limit} if limit else {}
+            cursor_state["total"] = coll.count_documents(query, **count_options)
+
+        # Only fetch what one page can hold. format_rows stops reading once the budget is reached.
+        data = coll.find(query, projection).batch_size(LOOKUP_MAX_ROWS + 1)
+        if sort_list:
+            data = data.sort(sort_list)
+        if offset:
+            data = data.skip(offset)
+        if limit:
+            data = data.limit(limit - offset)
         logging.info("Found info in doc/s.")
     except Exception as e:
         logging.error(f"Failed to find info in doc/s. Error: {e}")
         return f"Failed to find info in doc/s. Error: {e}"
 
-    # Convert to list of dictionaries
-    data_list = []
-    for doc in data:
-        # Remove the ID field from the document so it doesn't confuse the agent
-        del doc["_id"]
-        data_list.append(dumps(doc))
-    return str(data_list)
+    try:
+        return format_rows(data, max_bytes=lookup_byte_budget(), cursor_state=cursor_state)
+    except Exception as e:
+        logging.error(f"Failed to find info in doc/s. Error: {e}")
+        return f"Failed to find info in doc/s. Error: {e}"
+    finally:
+        data.close()
+
+
+# Aggregation ops and the Mongo accumulator each one compiles to
+AGGREGATION_OPS = {
+    "avg": "$avg",
+    "sum": "$sum",
+    "min": "$min",
+    "max": "$max",
+    "count": "$sum",
+    "percentile": "$percentile"
+}
+
+# Query operators that run code on the server and are never allowed in an aggregation match
+FORBIDDEN_MATCH_OPERATORS = ("$where", "$function", "$accumulator", "$expr")
+
+# Fields that identify a row and are returned with the top rows if no fields are given
+IDENTITY_FIELDS = ["PLAYER_NAME", "GROUP_NAME", "TEAM_NAME", "TEAM_ABBREVIATION", "season"]
+
+MAX_AGGREGATION_TOP_K = 25
+MAX_AGGREGATION_GROUPS = 100
+
+
+def check_field_name(field) -> str:
+    """
+    Check that a field name is a plain column name.
+    :param field: The field name.
+    :return: The field name.
+    """
+
+    if not isinstance(field, str) or not field or field.startswith("$") or "." in field:
+        raise ValueError(f"Invalid field name: {field}")
+
+    return field
+
+
+def check_match(match) -> None:
+    """
+    Check that a match doesn't use any of the forbidden operators.
+    :param match: The match query or any part of it.
+    :return: None
+    """
+
+    if isinstance(match, dict):
+        for key, value in match.items():
+            if key in FORBIDDEN_MATCH_OPERATORS:
+                raise ValueError(f"The {key} operator is not allowed.")
+            check_match(value)
+    elif isinstance(match, list):
+        for value in match:
+            check_match(value)
+
+    return
+
+
+def validate_aggregation_spec(spec: dict) -> dict:
+    """
+    Validate an aggregation spec and fill in the defaults. The spec looks like:
+
+    {
+        "doc_id": "0000-1111-2222-3333-4444",         (or a list of doc_ids)
+        "match": {"MIN": {"$gte": 100}},               (optional)
+        "group_by": "TEAM_ID",                         (optional, a field or a list of fields)
+        "metrics": [{"op": "avg", "field": "NET_RATING", "as": "avg_net_rating"},
+                    {"op": "percentile", "field": "NET_RATING", "p": 0.9}],   (optional)
+        "top_k": {"field": "NET_RATING", "k": 5, "order": "DESCENDING", "fields": ["GROUP_NAME"]},  (optional)
+        "order_by": "avg_net_rating", "order": "DESCENDING", "limit": 10       (optional, for groups)
+    }
+
+    :param spec: The spec.
+    :return: The validated spec.
+    """
+
+    if not isinstance(spec, dict):
+        raise ValueError("The spec must be a JSON object.")
+
+    doc_ids = spec.get("doc_id")
+    if isinstance(doc_ids, str):
+        doc_ids = [doc_ids]
+    if not doc_ids or not isinstance(doc_ids, list) or not all(isinstance(doc_id, str) for doc_id in doc_ids):
+        raise ValueError("The spec must include a doc_id or a list of doc_ids.")
+
+    match = spec.get("match") or {}
+    if not isinstance(match, dict):
+        raise ValueError("match must be a query object.")
+    check_match(match)
+
+    group_by = spec.get("group_by") or []
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    group_by = [check_field_name(field) for field in group_by]
+
+    metrics = []
+    for metric in spec.get("metrics") or []:
+        op = metric.get("op")
+        if op not in AGGREGATION_OPS:
+            raise ValueError(f"Unknown metric op: {op}. Use one of {list(AGGREGATION_OPS.keys())}.")
+        field = check_field_name(metric["field"]) if op != "count" else metric.get("field")
+        p = metric.get("p", 0.5)
+        if op == "percentile" and not (isinstance(p, (int, float)) and 0 < p <= 1):
+            raise ValueError("p must be between 0 and 1 for percentile metrics.")
+        default_name = "count" if op == "count" else f"{op}_{field}"
+        metrics.append({"op": op, "field": field, "p": p, "as": check_field_name(metric.get("as", default_name))})
+
+    top_k = spec.get("top_k")
+    if top_k:
+        k = int(top_k.get("k", 5))
+        if not 0 < k <= MAX_AGGREGATION_TOP_K:
+            raise ValueError(f"k must be between 1 and {MAX_AGGREGATION_TOP_K}.")
+        top_field = check_field_name(top_k.get("field"))
+        top_fields = top_k.get("fields") or IDENTITY_FIELDS + group_by + [top_field]
+        top_k = {
+            "field": top_field,
+            "k": k,
+            "order": DESCENDING if top_k.get("order", "DESCENDING") == "DESCENDING" else ASCENDING,
+            "fields": list(dict.fromkeys(check_field_name(field) for field in top_fields))
+        }
+
+    if not metrics and not top_k:
+        raise ValueError("The spec must include metrics, top_k or both.")
+
+    limit = int(spec.get("limit", 30))
+    if not 0 < limit <= MAX_AGGREGATION_GROUPS:
+        raise ValueError(f"limit must be between 1 and {MAX_AGGREGATION_GROUPS}.")
+
+    order_by = spec.get("order_by")
+    if order_by and order_by not in [metric["as"] for metric in metrics] + ["count"]:
+        raise ValueError("order_by must be the name of one of the metrics or count.")
+
+    return {
+        "doc_ids": doc_ids,
+        "match": match,
+        "group_by": group_by,
+        "metrics": metrics,
+        "top_k": top_k,
+        "order_by": order_by,
+        "order": DESCENDING if spec.get("order", "DESCENDING") == "DESCENDING" else ASCENDING,
+        "limit": limit
+    }
+
+
+def aggregation_match(spec: dict) -> dict:
+    """
+    Build the match query for a validated spec.
+    :param spec: The validated spec.
+    :return: The match query including the doc_ids.
+    """
+
+    doc_ids = spec["doc_ids"]
+    doc_id_query = doc_ids[0] if len(doc_ids) == 1 else {"$in": doc_ids}
+
+    return {**spec["match"], "doc_id": doc_id_query}
+
+
+def compile_aggregation(spec: dict) -> list:
+    """
+    Compile a validated spec into a Mongo aggregation pipeline. Needs MongoDB 5.2+ for top_k with group_by and 7.0+ for
+    percentiles. The results match the columnar engine's: missing fields are null, rows without a group field are
+    grouped under null and nulls sort as the lowest. Only percentiles can differ a little since Mongo estimates them.
+    :param spec: The validated spec.
+    :return: The pipeline.
+    """
+
+    accumulators = {"count": {"$sum": 1}}
+    for metric in spec["metrics"]:
+        if metric["op"] == "count":
+            accumulators[metric["as"]] = {"$sum": 1}
+        elif metric["op"] == "percentile":
+            accumulators[metric["as"]] = {
+                "$percentile": {"input": f"${metric['field']}", "p": [metric["p"]], "method": "approximate"}
+            }
+        else:
+            accumulators[metric["as"]] = {AGGREGATION_OPS[metric["op"]]: f"${metric['field']}"}
+
+    top_k = spec["top_k"]
+    pipeline = [{"$match": aggregation_match(spec)}]
+
+    if spec["group_by"]:
+        # $ifNull puts the rows that don't have a group field in the same group as the rows where it is null
+        group_stage = {
+            "_id": {field: {"$ifNull": [f"${field}", None]} for field in spec["group_by"]},
+            **accumulators
+        }
+        if top_k:
+            group_stage["top"] = {
+                "$topN": {
+                    "n": top_k["k"],
+                    "sortBy": {top_k["field"]: top_k["order"]},
+                    "output": {field: {"$ifNull": [f"${field}", None]} for field in top_k["fields"]}
+                }
+            }
+        pipeline.append({"$group": group_stage})
+
+        sort_field = spec["order_by"] or (spec["metrics"][0]["as"] if spec["metrics"] else "count")
+        pipeline.append({"$sort": {sort_field: spec["order"]}})
+        pipeline.append({"$limit": spec["limit"]})
+        return pipeline
+
+    # Without a group the summary and the top rows are computed side by side
+    facets = {"summary": [{"$group": {"_id": None, **accumulators}}]}
+    if top_k:
+        facets["top"] = [
+            {"$sort": {top_k["field"]: top_k["order"]}},
+            {"$limit": top_k["k"]},
+            {"$project": {"_id": 0, **{field: {"$ifNull": [f"${field}", None]} for field in top_k["fields"]}}}
+        ]
+    pipeline.append({"$facet": facets})
+
+    return pipeline
+
+
+def round_values(value, precision: int = LOOKUP_FLOAT_PRECISION):
+    """
+    Round every float in a nested result and turn NaN into None.
+    :param value: The result or any part of it.
+    :param precision: The number of decimal places to round floats to.
+    :return: The rounded result.
+    """
+
+    if isinstance(value, dict):
+        return {key: round_values(item, precision) for key, item in value.items()}
+    if isinstance(value, list):
+        return [round_values(item, precision) for item in value]
+
+    return compact_value(value, precision)
+
+
+def shape_mongo_aggregation(spec: dict, results: list) -> dict:
+    """
+    Turn the output of the Mongo pipeline into the same shape the columnar engine returns.
+    :param spec: The validated spec.
+    :param results: The documents from the pipeline.
+    :return: The reduced result.
+    """
+
+    percentile_names = [metric["as"] for metric in spec["metrics"] if metric["op"] == "percentile"]
+
+    def unwrap(summary: dict) -> dict:
+        # $percentile returns a list with one value per p
+        for name in percentile_names:
+            if isinstance(summary.get(name), list):
+                summary[name] = summary[name][0] if summary[name] else None
+        return summary
+
+    if spec["group_by"]:
+        groups = []
+        for result in results:
+            group = {**result.pop("_id"), **unwrap(result)}
+            groups.append(group)
+        return {"groups": groups}
+
+    facets = results[0] if results else {}
+    # $group gives no summary when nothing matched. Fill in the values the columnar engine gives for no rows.
+    empty_summary = {"count": 0, **{
+        metric["as"]: 0 if metric["op"] in ("count", "sum") else None for metric in spec["metrics"]
+    }}
+    summary = facets.get("summary") or [empty_summary]
+    summary = unwrap(summary[0])
+    summary.pop("_id", None)
+    shaped = {"count": summary.pop("count", 0), "metrics": summary}
+    if spec["top_k"]:
+        shaped["top"] = facets.get("top", [])
+    return shaped
+
+
+@traced("db.aggregate_facts")
+def aggregate_facts(spec: dict) -> str:
+    """
+    Run an aggregation over one or more snapshots in swarm_facts. The columnar engine is used when it is on and can
+    handle the spec, otherwise the spec is compiled into a Mongo aggregation pipeline. Only the reduced result is
+    returned.
+    :param spec: The aggregation spec. See validate_aggregation_spec.
+    :return: The result as compact JSON or an error message.
+    """
+
+    try:
+        spec = validate_aggregation_spec(spec)
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        return f"Invalid aggregation spec. Error: {e}"
+
+    result = None
+    if columnar_engine:
+        result = columnar_engine.aggregate(spec, aggregation_match(spec))
+        if result is not None:
+            logging.info("Aggregated facts with the columnar engine.")
+
+    if result is None:
+        try:
+            results = list(DB['swarm_facts'].aggregate(compile_aggregation(spec)))
+            result = shape_mongo_aggregation(spec, results)
+            logging.info("Aggregated facts.")
+        except Exception as e:
+            logging.error(f"Failed to aggregate facts. Error: {e}")
+            return f"Failed to aggregate facts. Error: {e}"
+
+    return json.dumps(round_values(result), separators=(',', ':'), default=str)
 
 
 def generic_create(collection: str, content: dict | list) -> bool:
@@ -176,6 +651,226 @@ def generic_create(collection: str, content: dict | list) -> bool:
             return False
 
 
+def snapshot_exists(doc_id: str) -> bool:
+    """
+    Check if a snapshot has already been added to swarm_facts.
+    :param doc_id: The content-addressed ID of the snapshot.
+    :return: True if at least one row of the snapshot is in the collection.
+    """
+
+    coll = DB['swarm_facts']
+
+    try:
+        return coll.find_one({"doc_id": doc_id}, {"_id": 1}) is not None
+    except Exception as e:
+        logging.error(f"Failed to check for snapshot {doc_id}. Error: {e}")
+        return False
+
+
+def touch_snapshot(doc_id: str) -> None:
+    """
+    Refresh the createdAt of a reused snapshot so the TTL index doesn't remove it while it is still in use. Only rows
+    that are more than half way to expiring are updated so most reuses don't write anything.
+    :param doc_id: The content-addressed ID of the snapshot.
+    :return: None
+    """
+
+    coll = DB['swarm_facts']
+
+    current_time = datetime.utcnow()
+    refresh_before = current_time - timedelta(days=FACTS_RETENTION_DAYS / 2)
+
+    try:
+        coll.update_many(
+            {"doc_id": doc_id, "createdAt": {"$lt": refresh_before}},
+            {"$set": {"createdAt": current_time}}
+        )
+    except Exception as e:
+        logging.error(f"Failed to refresh snapshot {doc_id}. Error: {e}")
+
+    return
+
+
+def mark_snapshot_immutable(doc_id: str) -> None:
+    """
+    Mark the rows of a snapshot as immutable so the TTL index never removes them. This is used for finished seasons.
+    :param doc_id: The content-addressed ID of the snapshot.
+    :return: None
+    """
+
+    coll = DB['swarm_facts']
+
+    try:
+        coll.update_many({"doc_id": doc_id, "immutable": {"$ne": True}}, {"$set": {"immutable": True}})
+    except Exception as e:
+        logging.error(f"Failed to mark snapshot {doc_id} as immutable. Error: {e}")
+
+    return
+
+
+def find_season_partition(partition_key: str) -> dict | None:
+    """
+    Get a partition from the season store. The season store records which snapshot holds the data for an endpoint,
+    season and set of params.
+    :param partition_key: The key of the partition.
+    :return: The partition or None if it isn't in the store.
+    """
+
+    coll = DB['swarm_seasons']
+
+    try:
+        return coll.find_one({"_id": partition_key})
+    except Exception as e:
+        logging.error(f"Failed to get season partition. Error: {e}")
+        return None
+
+
+def save_season_partition(partition: dict) -> bool:
+    """
+    Add or replace a partition in the season store.
+    :param partition: The partition. Its _id is the partition key.
+    :return: True if the partition was saved.
+    """
+
+    coll = DB['swarm_seasons']
+
+    try:
+        coll.replace_one({"_id": partition["_id"]}, partition, upsert=True)
+        logging.info(f"Saved {partition['endpoint']} {partition['season']} to the season store.")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to save season partition. Error: {e}")
+        return False
+
+
+def find_assistant(definition_hash: str) -> dict | None:
+    """
+    Get an assistant from the assistant registry. The registry records the OpenAI assistant that was created for each
+    agent definition so agents can reuse it instead of creating a new one.
+    :param definition_hash: The hash of the agent definition.
+    :return: The registry entry or None if there is no assistant for the definition.
+    """
+
+    coll = DB['swarm_assistants']
+
+    try:
+        return coll.find_one_and_update(
+            {"_id": definition_hash},
+            {"$set": {"lastUsedAt": datetime.utcnow()}}
+        )
+    except Exception as e:
+        logging.error(f"Failed to get assistant from the registry. Error: {e}")
+        return None
+
+
+def register_assistant(entry: dict, replace: bool = False) -> dict:
+    """
+    Add an assistant to the assistant registry. If another worker registered an assistant for the same definition first
+    then its entry is kept and returned.
+    :param entry: The registry entry. Its _id is the definition hash.
+    :param replace: Replace the existing entry, e.g. when its assistant was deleted on OpenAI.
+    :return: The entry that is in the registry.
+    """
+
+    coll = DB['swarm_assistants']
+
+    try:
+        if replace:
+            coll.replace_one({"_id": entry["_id"]}, entry, upsert=True)
+        else:
+            coll.insert_one(entry)
+        logging.info(f"Registered assistant {entry['assistant_id']} for {entry['name']}.")
+        return entry
+    except DuplicateKeyError:
+        existing_entry = coll.find_one({"_id": entry["_id"]})
+        return existing_entry if existing_entry else entry
+    except Exception as e:
+        logging.error(f"Failed to register assistant. Error: {e}")
+        return entry
+
+
+def save_archived_output(entry: dict) -> bool:
+    """
+    Archive a piece of an agent's thread that was compacted out of it.
+    :param entry: The archive entry. Its _id is the ref given to the agent.
+    :return: True if the entry was saved.
+    """
+
+    coll = DB['swarm_archived_outputs']
+
+    try:
+        coll.insert_one(entry)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to archive compacted output. Error: {e}")
+        return False
+
+
+def find_archived_output(ref: str) -> dict | None:
+    """
+    Get a compacted piece of an agent's thread.
+    :param ref: The ref given to the agent.
+    :return: The archive entry or None if there isn't one.
+    """
+
+    coll = DB['swarm_archived_outputs']
+
+    try:
+        return coll.find_one({"_id": ref})
+    except Exception as e:
+        logging.error(f"Failed to get compacted output {ref}. Error: {e}")
+        return None
+
+
+def count_facts(query: dict) -> int:
+    """
+    Count the rows in swarm_facts that match a query.
+    :param query: The query to count.
+    :return: The number of matching rows or 0 if the count fails.
+    """
+
+    coll = DB['swarm_facts']
+
+    try:
+        return coll.count_documents(query)
+    except Exception as e:
+        logging.error(f"Failed to count facts. Error: {e}")
+        return 0
+
+
+@traced("db.create_snapshot")
+def create_snapshot(doc_id: str, data_list: list) -> bool:
+    """
+    Insert the rows of a snapshot into swarm_facts. Each row gets a deterministic _id made from the doc_id and its
+    position so that two workers inserting the same snapshot at the same time don't create duplicate rows.
+    :param doc_id: The content-addressed ID of the snapshot.
+    :param data_list: The rows of the snapshot.
+    :return: True if the snapshot is in the collection after the call.
+    """
+
+    coll = DB['swarm_facts']
+    get_current_span().set("rows", len(data_list))
+
+    for row_number, item in enumerate(data_list):
+        item['_id'] = f"{doc_id}:{row_number}"
+
+    try:
+        coll.insert_many(data_list, ordered=False)
+        logging.info(f"Created snapshot {doc_id} in swarm_facts.")
+        return True
+    except BulkWriteError as e:
+        # Duplicate key errors mean another worker already inserted those rows which is fine
+        other_errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+        if other_errors:
+            logging.error(f"Failed to create snapshot {doc_id}. Error: {other_errors[0]}")
+            return False
+        logging.info(f"Snapshot {doc_id} was already in swarm_facts.")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to create snapshot {doc_id}. Error: {e}")
+        return False
+
+
 def generic_update(collection: str, query: dict, content: dict | list) -> bool:
     """
     Update a document in the database.
@@ -1,8 +1,12 @@
-from settings import logging, RMQ_URL, AGENT_QUEUE
-from agents.nba_analyst import nba_analyst
+from settings import logging, RMQ_URL, AGENT_QUEUE, AGENT_RUNTIME, AGENT_MAX_CONVERSATIONS
+from agents.nba_analyst import nba_analyst, nba_analyst_async
 from db_tools import create_convo_doc
+from db_indexes import ensure_indexes
+from agents.prompt_registry import prompt_registry
+from agents.async_agents import get_agent_loop
 
 from pika import BlockingConnection, URLParameters
+import asyncio
 import json
 import uuid
 
@@ -38,5 +42,65 @@ def listen_on_queue():
     channel.start_consuming()
 
 
+async def handle_message(body: bytes) -> str:
+    """
+    Handle one message from the agent's queue on the event loop.
+    :param body: The message body.
+    :return: The analysis.
+    """
+
+    body = json.loads(body)
+
+    # Create UUID for the main thread
+    main_thread_id = str(uuid.uuid4())
+
+    # Create the convo document in the DB
+    await asyncio.to_thread(create_convo_doc, main_thread_id)
+
+    # Call the nba_analyst function
+    return await nba_analyst_async(main_thread_id, body['message'])
+
+
+def listen_on_queue_async():
+    """
+    Listen on the agent's queue and handle up to AGENT_MAX_CONVERSATIONS messages at the same time. The conversations run
+    on the agent loop in a background thread. pika stays on this thread, so messages are acked from here once their
+    conversation is done, and the prefetch count is what bounds the conversations in flight.
+    """
+
+    loop = get_agent_loop()
+
+    parameters = URLParameters(url=RMQ_URL)
+    connection = BlockingConnection(parameters)
+    channel = connection.channel()
+    channel.basic_qos(prefetch_count=AGENT_MAX_CONVERSATIONS)
+
+    def callback(ch, method, properties, body):
+        logging.info(f"Received message: {body}")
+        future = asyncio.run_coroutine_threadsafe(handle_message(body), loop)
+
+        def on_done(done_future):
+            if done_future.exception():
+                logging.error(f"Conversation failed. Error: {done_future.exception()}")
+            # pika isn't thread-safe so the ack is handed back to the connection's thread
+            connection.add_callback_threadsafe(lambda: ch.basic_ack(delivery_tag=method.delivery_tag))
+
+        future.add_done_callback(on_done)
+
+    channel.queue_declare(queue=AGENT_QUEUE)
+    channel.basic_consume(queue=AGENT_QUEUE,
+                          on_message_callback=callback,
+                          auto_ack=False)
+
+    logging.info(f"Listening on queue: {AGENT_QUEUE} with up to {AGENT_MAX_CONVERSATIONS} conversations at a time.")
+    channel.start_consuming()
+
+
 if __name__ == '__main__':
-    listen_on_queue()
+    ensure_indexes()
+    prompt_registry.load()
+    prompt_registry.start_refresh()
+    if AGENT_RUNTIME == "async":
+        listen_on_queue_async()
+    else:
+        listen_on_queue()
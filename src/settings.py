@@ -4,6 +4,7 @@ file does not exist then we load the environment variables from the system envir
 """
 
 import os
+import json
 from dotenv import load_dotenv
 import logging
 import openai
@@ -40,6 +41,120 @@ SYS_MODE = os.getenv('SYS_MODE')
 AGENT_QUEUE = os.getenv('AGENT_QUEUE')
 RMQ_URL = os.getenv('RMQ_URL')
 
+# NBA API response cache. Responses for the current season expire quickly since game-day data changes. Finished
+# seasons don't change so they are cached for much longer. Set NBA_CACHE_SHARED to "true" to share the cache across
+# workers through Mongo.
+NBA_CACHE_TTL_LIVE = int(os.getenv('NBA_CACHE_TTL_LIVE', 900))
+NBA_CACHE_TTL_FINISHED = int(os.getenv('NBA_CACHE_TTL_FINISHED', 60 * 60 * 24 * 30))
+NBA_CACHE_MAX_ENTRIES = int(os.getenv('NBA_CACHE_MAX_ENTRIES', 256))
+NBA_CACHE_SHARED = os.getenv('NBA_CACHE_SHARED', 'false').lower() == 'true'
+
+# Exact-match cache for one off chat completions, keyed on the model, the system instructions and the normalized prompt.
+# The in-process tier holds LLM_CACHE_MAX_ENTRIES replies and the shared tier in Mongo is used when LLM_CACHE_SHARED is
+# "true". Replies expire after LLM_CACHE_TTL seconds.
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', 60 * 60 * 24))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', 512))
+LLM_CACHE_SHARED = os.getenv('LLM_CACHE_SHARED', 'true').lower() == 'true'
+
+# Facts in swarm_facts are removed this many days after they were added. Snapshots that are reused get their createdAt
+# refreshed so they stay around while they are still being used. FACTS_SORT_INDEX_FIELDS are the stats data_lookup
+# commonly sorts on and each gets a compound index with doc_id. Leave it empty for no sort indexes.
+FACTS_RETENTION_DAYS = int(os.getenv('FACTS_RETENTION_DAYS', 7))
+FACTS_SORT_INDEX_FIELDS = [
+    field.strip() for field in os.getenv('FACTS_SORT_INDEX_FIELDS', 'PLUS_MINUS,NET_RATING,PTS,MIN').split(',')
+    if field.strip()
+]
+
+# Shared HTTP transport for the NBA API. NBA_HTTP_MODE is "live", "record" or "replay". Record saves every response
+# to NBA_HTTP_RECORD_DIR and replay serves them from there without touching the network.
+NBA_HTTP_MODE = os.getenv('NBA_HTTP_MODE', 'live')
+NBA_HTTP_RECORD_DIR = os.getenv('NBA_HTTP_RECORD_DIR', '../nba_api_recordings')
+NBA_HTTP_POOL_SIZE = int(os.getenv('NBA_HTTP_POOL_SIZE', 10))
+NBA_RATE_LIMIT = float(os.getenv('NBA_RATE_LIMIT', 2))
+NBA_RATE_BURST = int(os.getenv('NBA_RATE_BURST', 4))
+NBA_MAX_RETRIES = int(os.getenv('NBA_MAX_RETRIES', 3))
+NBA_BACKOFF_BASE = float(os.getenv('NBA_BACKOFF_BASE', 1))
+NBA_BACKOFF_MAX = float(os.getenv('NBA_BACKOFF_MAX', 30))
+
+# Shared OpenAI client. Every agent in the process uses one client with OPENAI_POOL_SIZE pooled connections that are
+# kept alive for OPENAI_KEEPALIVE seconds. Timeouts are in seconds and OPENAI_MAX_RETRIES is the SDK retry count.
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', 20))
+OPENAI_KEEPALIVE = float(os.getenv('OPENAI_KEEPALIVE', 60))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 120))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 10))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 2))
+
+# OPENAI_MODE is "live" or "fake". Fake runs the agents against the local stand-in in agents/fake_openai.py, scripted by
+# the JSON file at OPENAI_FAKE_SCRIPT or replaying the swarm_convos conversation with the id OPENAI_FAKE_REPLAY.
+OPENAI_MODE = os.getenv('OPENAI_MODE', 'live')
+OPENAI_FAKE_SCRIPT = os.getenv('OPENAI_FAKE_SCRIPT')
+OPENAI_FAKE_REPLAY = os.getenv('OPENAI_FAKE_REPLAY')
+
+# Add derived metrics (TS_PCT, PTS_PER_100, league percentiles, ...) to every snapshot when it is ingested
+DERIVED_METRICS = os.getenv('DERIVED_METRICS', 'true').lower() == 'true'
+
+# In-memory columnar query engine for data_lookup. Each snapshot is kept as a pandas frame up to the memory budget.
+COLUMNAR_ENGINE = os.getenv('COLUMNAR_ENGINE', 'false').lower() == 'true'
+COLUMNAR_ENGINE_MAX_MB = int(os.getenv('COLUMNAR_ENGINE_MAX_MB', 256))
+
+# The default number of tool calls an agent runs at the same time. Agents can override this with max_tool_workers.
+AGENT_TOOL_WORKERS = int(os.getenv('AGENT_TOOL_WORKERS', 4))
+
+# The agent runtime of the worker. "sync" handles one conversation at a time. "async" interleaves up to
+# AGENT_MAX_CONVERSATIONS conversations on one event loop and runs the blocking tool functions on a pool of
+# AGENT_TOOL_EXECUTOR_WORKERS threads.
+AGENT_RUNTIME = os.getenv('AGENT_RUNTIME', 'sync')
+AGENT_MAX_CONVERSATIONS = int(os.getenv('AGENT_MAX_CONVERSATIONS', 20))
+AGENT_TOOL_EXECUTOR_WORKERS = int(os.getenv('AGENT_TOOL_EXECUTOR_WORKERS', 16))
+
+# The most NBA Data Guys the analyst queries and fetches data from at the same time
+ANALYST_FAN_OUT_WORKERS = int(os.getenv('ANALYST_FAN_OUT_WORKERS', 4))
+
+# How the agents wait on a run. Runs are streamed when AGENT_RUN_STREAMING is "true". Otherwise, or if the stream fails,
+# the run is polled every RUN_POLL_INITIAL seconds, backing off by RUN_POLL_BACKOFF up to RUN_POLL_MAX seconds.
+AGENT_RUN_STREAMING = os.getenv('AGENT_RUN_STREAMING', 'true').lower() == 'true'
+RUN_POLL_INITIAL = float(os.getenv('RUN_POLL_INITIAL', 0.2))
+RUN_POLL_BACKOFF = float(os.getenv('RUN_POLL_BACKOFF', 1.5))
+RUN_POLL_MAX = float(os.getenv('RUN_POLL_MAX', 3))
+
+# Thread compaction. Once the tokens an agent has put in its thread (estimated at 4 bytes per token) would go over
+# AGENT_THREAD_TOKEN_BUDGET, tool outputs and messages of at least COMPACT_MIN_TOKENS are archived for
+# COMPACT_ARCHIVE_DAYS days and replaced by a digest of at most COMPACT_DIGEST_TOKENS. 0 turns compaction off.
+AGENT_THREAD_TOKEN_BUDGET = int(os.getenv('AGENT_THREAD_TOKEN_BUDGET', 0))
+COMPACT_MIN_TOKENS = int(os.getenv('COMPACT_MIN_TOKENS', 1000))
+COMPACT_DIGEST_TOKENS = int(os.getenv('COMPACT_DIGEST_TOKENS', 200))
+COMPACT_ARCHIVE_DAYS = int(os.getenv('COMPACT_ARCHIVE_DAYS', 7))
+
+# Output budget for one page of data_lookup. Floats are rounded to LOOKUP_FLOAT_PRECISION decimal places and rows stop
+# being added once LOOKUP_MAX_ROWS, LOOKUP_MAX_BYTES or LOOKUP_MAX_TOKENS (estimated at 4 bytes per token, 0 is no
+# token budget) is reached. The rest of the rows are available through the next_cursor of the page.
+LOOKUP_FLOAT_PRECISION = int(os.getenv('LOOKUP_FLOAT_PRECISION', 3))
+LOOKUP_MAX_ROWS = int(os.getenv('LOOKUP_MAX_ROWS', 200))
+LOOKUP_MAX_BYTES = int(os.getenv('LOOKUP_MAX_BYTES', 20000))
+LOOKUP_MAX_TOKENS = int(os.getenv('LOOKUP_MAX_TOKENS', 0))
+
+# Conversation tracing. TRACE_EXPORT is "none" or a comma separated list of "jsonl" (append the spans to TRACE_FILE)
+# and "otlp" (post them to the OTLP/HTTP collector at TRACE_OTLP_ENDPOINT).
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', 'none').lower()
+TRACE_FILE = os.getenv('TRACE_FILE', '../traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'nbagpt')
+
+# LangChain Hub prompt templates. They are loaded at startup from the bundle at PROMPT_BUNDLE_PATH and, when
+# PROMPT_SOURCE is "hub", pulled from the hub and refreshed every PROMPT_REFRESH_MINUTES (0 is never). PROMPT_SOURCE
+# "bundle" never touches the hub. PROMPT_VERSIONS pins templates to a hub commit, e.g.
+# '{"oai_nba_analyst_eval": "1a2b3c"}'.
+PROMPT_SOURCE = os.getenv('PROMPT_SOURCE', 'hub')
+PROMPT_BUNDLE_PATH = os.getenv('PROMPT_BUNDLE_PATH', '../prompt_bundle.json')
+PROMPT_REFRESH_MINUTES = float(os.getenv('PROMPT_REFRESH_MINUTES', 60))
+PROMPT_VERSIONS = json.loads(os.getenv('PROMPT_VERSIONS', '{}'))
+
+# Season warm-up job. WARM_UP_SPLITS is a JSON list of extra kwargs to prefetch each tool with, e.g.
+# '[{}, {"season_type_all_star": "Playoffs"}]'.
+WARM_UP_INTERVAL_HOURS = float(os.getenv('WARM_UP_INTERVAL_HOURS', 24))
+WARM_UP_SPLITS = json.loads(os.getenv('WARM_UP_SPLITS', '[{}]'))
+
 # Set the OpenAI API key
 openai.api_key = OPENAI_API_KEY
 
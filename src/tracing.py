@@ -0,0 +1,468 @@
+"""
+Span based tracing for the analyst pipeline. Every conversation is a trace keyed by its main_thread_id and every stage
+of it (the analyst stages, agent runs, tool calls, NBA API fetches and DB calls) is a span with its wall time and
+attributes like token usage, payload bytes and retries. Finished spans are exported in the background to a JSONL file,
+an OTLP/HTTP collector or both (TRACE_EXPORT).
+
+The current conversation and span are kept in context variables so they follow asyncio tasks and asyncio.to_thread.
+Plain executors don't copy the context so wrap the function with `in_context` before handing it to one.
+
+Run from the src directory to print the p50/p95 of every stage in the trace file:
+
+    python tracing.py [--file ../traces.jsonl] [--trace <main_thread_id>]
+"""
+
+from settings import logging, TRACE_EXPORT, TRACE_FILE, TRACE_OTLP_ENDPOINT, TRACE_SERVICE_NAME
+
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from collections import defaultdict
+import functools
+import threading
+import argparse
+import hashlib
+import atexit
+import queue
+import math
+import json
+import time
+import uuid
+import os
+
+import requests
+
+# The exporters that are on. Tracing is off when there are none.
+TRACE_EXPORTERS = [exporter.strip() for exporter in TRACE_EXPORT.split(",") if exporter.strip() not in ("", "none")]
+TRACING_ENABLED = bool(TRACE_EXPORTERS)
+
+# The most spans sent to the exporters at once
+EXPORT_BATCH_SIZE = 200
+
+# Span attributes that are token counts. The summary adds them up per stage.
+TOKEN_ATTRIBUTES = ("prompt_tokens", "completion_tokens", "total_tokens")
+
+# The conversation and the span the code is running in
+current_trace_id = ContextVar("current_trace_id", default=None)
+current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed stage of a conversation. Attributes can be set or added to while the span is open, from any thread.
+    """
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = os.urandom(8).hex()
+        self.attributes = dict(attributes)
+        self.error = None
+        self.start_time = time.time()
+        self.start_counter = time.perf_counter()
+        self.duration = None
+        self.lock = threading.Lock()
+
+    def set(self, key: str, value) -> None:
+        """
+        Set an attribute.
+        :param key: The attribute.
+        :param value: The value.
+        :return: None
+        """
+
+        with self.lock:
+            self.attributes[key] = value
+
+        return
+
+    def add(self, key: str, amount: int | float = 1) -> None:
+        """
+        Add to a numeric attribute, starting from 0.
+        :param key: The attribute.
+        :param amount: The amount to add.
+        :return: None
+        """
+
+        with self.lock:
+            self.attributes[key] = self.attributes.get(key, 0) + amount
+
+        return
+
+    def end(self) -> None:
+        self.duration = time.perf_counter() - self.start_counter
+
+    def to_record(self) -> dict:
+        """
+        Get the span as a JSONL record.
+        :return: The record.
+        """
+
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+
+class NoopSpan:
+    """
+    Stands in for a span when tracing is off or the code isn't running in a conversation.
+    """
+    def set(self, key: str, value) -> None:
+        return
+
+    def add(self, key: str, amount: int | float = 1) -> None:
+        return
+
+
+NOOP_SPAN = NoopSpan()
+
+
+@contextmanager
+def trace_conversation(main_thread_id: str, **attributes):
+    """
+    Trace a conversation. Every span opened inside belongs to its trace.
+    :param main_thread_id: The main thread ID of the conversation.
+    :param attributes: Attributes of the root span.
+    :return: The root span.
+    """
+
+    if not TRACING_ENABLED:
+        yield NOOP_SPAN
+        return
+
+    token = current_trace_id.set(main_thread_id)
+    try:
+        with span("conversation", **attributes) as root_span:
+            yield root_span
+    finally:
+        current_trace_id.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time a stage of the current conversation. Spans opened inside it are its children. An exception marks the span as
+    failed and is raised again.
+    :param name: The name of the stage. The summary groups spans by name.
+    :param attributes: Attributes to start the span with.
+    :return: The span.
+    """
+
+    trace_id = current_trace_id.get()
+    if not TRACING_ENABLED or trace_id is None:
+        yield NOOP_SPAN
+        return
+
+    parent = current_span.get()
+    new_span = Span(name, trace_id, parent.span_id if parent else None, attributes)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        new_span.end()
+        exporter.submit(new_span)
+
+
+def traced(name: str):
+    """
+    Decorate a blocking function so every call is a span. The size of a string result is recorded as payload_bytes.
+    :param name: The name of the stage.
+    :return: The decorator.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name) as call_span:
+                result = func(*args, **kwargs)
+                if isinstance(result, str):
+                    call_span.set("payload_bytes", len(result.encode("utf-8")))
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def get_current_span() -> Span | NoopSpan:
+    """
+    Get the span the code is running in.
+    :return: The span or a no-op span if there isn't one.
+    """
+
+    open_span = current_span.get()
+
+    return open_span if open_span is not None else NOOP_SPAN
+
+
+def record_usage(usage, open_span: Span | NoopSpan = None) -> None:
+    """
+    Add the token usage of a run or a chat completion to a span.
+    :param usage: The usage object of the run or completion. Runs that aren't finished have none.
+    :param open_span: The span. The current span if not given.
+    :return: None
+    """
+
+    if usage is None:
+        return
+
+    open_span = open_span if open_span is not None else get_current_span()
+    for attribute in TOKEN_ATTRIBUTES:
+        tokens = getattr(usage, attribute, None)
+        if tokens:
+            open_span.add(attribute, tokens)
+
+    return
+
+
+def in_context(func):
+    """
+    Wrap a function so it runs in the caller's tracing context on another thread. Use it for executors that don't copy
+    the context themselves (ThreadPoolExecutor, loop.run_in_executor).
+    :param func: The function.
+    :return: The wrapped function.
+    """
+
+    context = copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time so every call gets its own copy
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def otlp_value(value) -> dict:
+    """
+    Convert an attribute value to an OTLP AnyValue.
+    :param value: The value.
+    :return: The AnyValue.
+    """
+
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+
+    return {"stringValue": value if isinstance(value, str) else json.dumps(value, default=str)}
+
+
+def otlp_trace_id(trace_id: str) -> str:
+    """
+    Convert a main_thread_id to a 16 byte OTLP trace ID. The main thread IDs are UUIDs so they map directly.
+    :param trace_id: The main thread ID.
+    :return: The trace ID as hex.
+    """
+
+    try:
+        return uuid.UUID(trace_id).hex
+    except ValueError:
+        return hashlib.sha256(trace_id.encode("utf-8")).hexdigest()[:32]
+
+
+def otlp_payload(records: list) -> dict:
+    """
+    Build an OTLP/HTTP JSON export request from span records.
+    :param records: The span records.
+    :return: The request body.
+    """
+
+    spans = []
+    for record in records:
+        start_nanos = int(record["start"] * 1e9)
+        otlp_span = {
+            "traceId": otlp_trace_id(record["trace_id"]),
+            "spanId": record["span_id"],
+            "name": record["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(start_nanos),
+            "endTimeUnixNano": str(start_nanos + int(record["duration_ms"] * 1e6)),
+            "attributes": [
+                {"key": key, "value": otlp_value(value)}
+                for key, value in {**record["attributes"], "main_thread_id": record["trace_id"]}.items()
+            ],
+            "status": {"code": 2, "message": record["error"]} if record["error"] else {"code": 1}
+        }
+        if record["parent_id"]:
+            otlp_span["parentSpanId"] = record["parent_id"]
+        spans.append(otlp_span)
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "nbagpt.tracing"}, "spans": spans}]
+            }
+        ]
+    }
+
+
+class SpanExporter:
+    """
+    Exports finished spans on a background thread so the conversations never wait on the file or the collector.
+    """
+    def __init__(self, exporters: list, trace_file: str, otlp_endpoint: str):
+        self.exporters = exporters
+        self.trace_file = trace_file
+        self.otlp_endpoint = otlp_endpoint
+        self.spans = queue.SimpleQueue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        self.session = requests.Session() if "otlp" in exporters else None
+
+    def submit(self, finished_span: Span) -> None:
+        """
+        Queue a finished span for export.
+        :param finished_span: The span.
+        :return: None
+        """
+
+        if self.thread is None:
+            with self.thread_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="span-exporter", daemon=True)
+                    self.thread.start()
+                    atexit.register(self.close)
+
+        self.spans.put(finished_span.to_record())
+
+        return
+
+    def run(self) -> None:
+        """
+        Export the queued spans in batches until the exporter is closed.
+        :return: None
+        """
+
+        while True:
+            batch = [self.spans.get()]
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self.spans.get_nowait())
+                except queue.Empty:
+                    break
+
+            closing = None in batch
+            records = [record for record in batch if record is not None]
+            if records:
+                self.export(records)
+            if closing:
+                return
+
+    def export(self, records: list) -> None:
+        """
+        Send a batch of span records to every exporter. Export failures are logged and the spans are dropped.
+        :param records: The span records.
+        :return: None
+        """
+
+        if "jsonl" in self.exporters:
+            try:
+                with open(self.trace_file, "a") as trace_file:
+                    trace_file.writelines(json.dumps(record, default=str) + "\n" for record in records)
+            except OSError as e:
+                logging.warning(f"Failed to write {len(records)} spans to {self.trace_file}. Error: {e}")
+
+        if "otlp" in self.exporters:
+            try:
+                response = self.session.post(self.otlp_endpoint, json=otlp_payload(records), timeout=5)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                logging.warning(f"Failed to send {len(records)} spans to {self.otlp_endpoint}. Error: {e}")
+
+        return
+
+    def close(self) -> None:
+        """
+        Export the spans that are still queued and stop the exporter thread.
+        :return: None
+        """
+
+        if self.thread is None:
+            return
+
+        self.spans.put(None)
+        self.thread.join(timeout=10)
+
+        return
+
+
+exporter = SpanExporter(TRACE_EXPORTERS, TRACE_FILE, TRACE_OTLP_ENDPOINT)
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Get a percentile with the nearest rank method.
+    :param values: The values, sorted.
+    :param fraction: The percentile as a fraction, e.g. 0.95.
+    :return: The percentile.
+    """
+
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize_traces(trace_file: str, trace_id: str = None) -> list:
+    """
+    Summarize the spans in a trace file by stage.
+    :param trace_file: The JSONL trace file.
+    :param trace_id: Only summarize this conversation if given.
+    :return: A row for every stage with its count, p50, p95 and total in ms and its total tokens, slowest total first.
+    """
+
+    durations = defaultdict(list)
+    tokens = defaultdict(lambda: defaultdict(int))
+    errors = defaultdict(int)
+
+    with open(trace_file, "r") as spans_file:
+        for line in spans_file:
+            record = json.loads(line)
+            if trace_id and record["trace_id"] != trace_id:
+                continue
+            durations[record["name"]].append(record["duration_ms"])
+            errors[record["name"]] += record["status"] == "error"
+            for attribute in TOKEN_ATTRIBUTES:
+                tokens[record["name"]][attribute] += record["attributes"].get(attribute, 0)
+
+    summary = []
+    for name, stage_durations in durations.items():
+        stage_durations.sort()
+        summary.append(
+            {
+                "stage": name,
+                "count": len(stage_durations),
+                "errors": errors[name],
+                "p50_ms": round(percentile(stage_durations, 0.5), 1),
+                "p95_ms": round(percentile(stage_durations, 0.95), 1),
+                "total_ms": round(sum(stage_durations), 1),
+                "total_tokens": tokens[name]["total_tokens"]
+            }
+        )
+
+    return sorted(summary, key=lambda row: row["total_ms"], reverse=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print the p50/p95 of every stage in a trace file.")
+    parser.add_argument("--file", default=TRACE_FILE, help="The JSONL trace file.")
+    parser.add_argument("--trace", help="Only summarize the conversation with this main_thread_id.")
+    args = parser.parse_args()
+
+    for row in summarize_traces(args.file, args.trace):
+        logging.info(
+            f"{row['stage']}: {row['count']} spans ({row['errors']} failed), p50 {row['p50_ms']}ms, "
+            f"p95 {row['p95_ms']}ms, total {row['total_ms']}ms, {row['total_tokens']} tokens"
+        )
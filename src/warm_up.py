@@ -0,0 +1,123 @@
+"""
+Season warm-up job. This prefetches every NBA API tool for the current season (and any configured splits) into the
+shared response cache, the season store and swarm_facts so that the first user question after a restart doesn't pay the full
+stats.nba.com latency. Workers read the warm data when NBA_CACHE_SHARED is "true".
+
+Run it once with `python warm_up.py --once` or leave it running to refresh on a schedule.
+"""
+
+from settings import logging, WARM_UP_INTERVAL_HOURS, WARM_UP_SPLITS
+from agent_tools import nba_api_tools
+from db_tools import count_facts
+from db_indexes import ensure_indexes
+
+import argparse
+import inspect
+import time
+import re
+
+
+def accepts_kwargs(tool) -> bool:
+    """
+    Check if a tool takes endpoint kwargs. Tools that don't are only prefetched once.
+    :param tool: The tool function.
+    :return: True if the tool has a **kwargs parameter.
+    """
+
+    parameters = inspect.signature(tool).parameters.values()
+    return any(parameter.kind == inspect.Parameter.VAR_KEYWORD for parameter in parameters)
+
+
+def warm_up_tool(tool_name: str, tool, split: dict) -> dict:
+    """
+    Prefetch one tool for one split and measure the cost.
+    :param tool_name: The name of the tool in the function map.
+    :param tool: The tool function.
+    :param split: The kwargs to call the tool with.
+    :return: The report entry for this tool and split.
+    """
+
+    start_time = time.perf_counter()
+    try:
+        msg = tool(**split)
+    except Exception as e:
+        logging.error(f"Warm up of {tool_name} failed. Error: {e}")
+        msg = ""
+    fetch_time = time.perf_counter() - start_time
+
+    # The tools return a message for the agent so pull the doc_id out of it to count the rows that were stored
+    doc_ids = re.findall(r"doc_id: ([0-9a-f-]{36})", msg)
+    rows = sum(count_facts({"doc_id": doc_id}) for doc_id in doc_ids)
+
+    return {
+        "tool": tool_name,
+        "split": split,
+        "seconds": round(fetch_time, 2),
+        "rows": rows,
+        "doc_ids": doc_ids,
+        "status": "ok" if doc_ids else "failed"
+    }
+
+
+def warm_up_season() -> list:
+    """
+    Prefetch every endpoint tool in the NBA API function map for the current season and the configured splits.
+    :return: A report entry for each tool and split.
+    """
+
+    logging.info(f"Warming up season {nba_api_tools.SEASON}.")
+
+    report = []
+    for tool_name, tool in nba_api_tools.function_map.items():
+        # Only the get_* tools fetch from an endpoint. The rest work on data that is already stored.
+        if not tool_name.startswith("get_"):
+            continue
+
+        splits = WARM_UP_SPLITS if accepts_kwargs(tool) else [{}]
+        for split in splits:
+            entry = warm_up_tool(tool_name, tool, split)
+            logging.info(
+                f"Warmed {entry['tool']} {entry['split']}: {entry['rows']} rows in {entry['seconds']}s "
+                f"({entry['status']})"
+            )
+            report.append(entry)
+
+    total_time = sum(entry["seconds"] for entry in report)
+    total_rows = sum(entry["rows"] for entry in report)
+    logging.info(f"Warm up finished: {len(report)} fetches, {total_rows} rows in {round(total_time, 2)}s.")
+    logging.info(f"Response cache stats: {nba_api_tools.response_cache.stats()}")
+
+    return report
+
+
+def run_schedule(interval_hours: float) -> None:
+    """
+    Warm up the season and then again every interval.
+    :param interval_hours: The hours between warm ups.
+    :return: None
+    """
+
+    while True:
+        warm_up_season()
+        logging.info(f"Next warm up in {interval_hours} hours.")
+        time.sleep(interval_hours * 60 * 60)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Prefetch the NBA API tools for the current season.")
+    parser.add_argument("--once", action="store_true", help="Warm up once and exit.")
+    args = parser.parse_args()
+
+    # Always fetch fresh data, write it to the shared tier so the workers can read it and keep it until the next
+    # scheduled warm up has had time to finish.
+    nba_api_tools.response_cache.collection = "swarm_api_cache"
+    nba_api_tools.response_cache.refresh_only = True
+    nba_api_tools.response_cache.min_ttl = int(WARM_UP_INTERVAL_HOURS * 60 * 60 * 1.5)
+    nba_api_tools.refresh_live_partitions = True
+
+    ensure_indexes()
+
+    if args.once:
+        warm_up_season()
+    else:
+        run_schedule(WARM_UP_INTERVAL_HOURS)
@@ -0,0 +1,11 @@
+"""
+The code runs from the src directory with absolute imports so the tests put it on the path the same way.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# Keep the tests from writing convos to the DB
+os.environ.setdefault("SYS_MODE", "testing")
@@ -0,0 +1,43 @@
+from agents.async_agents import AsyncAgent
+
+from types import SimpleNamespace
+import threading
+import asyncio
+import json
+import time
+
+
+def tool_call(call_id: str, seconds: float) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=call_id,
+        type="function",
+        function=SimpleNamespace(name="slow_tool", arguments=json.dumps({"seconds": seconds}))
+    )
+
+
+def test_tool_outputs_keep_the_call_order_and_the_worker_limit():
+    lock = threading.Lock()
+    running = {"now": 0, "most": 0}
+
+    def slow_tool(seconds: float) -> str:
+        with lock:
+            running["now"] += 1
+            running["most"] = max(running["most"], running["now"])
+        time.sleep(seconds)
+        with lock:
+            running["now"] -= 1
+
+        return f"slept {seconds}"
+
+    agent = AsyncAgent("tester", "instructions", "model", [], "main_thread", function_map={"slow_tool": slow_tool},
+                       max_tool_workers=2)
+    # The first calls take the longest so they finish last
+    sleeps = [0.3, 0.2, 0.1, 0.05, 0.0]
+    calls = [tool_call(f"call_{index}", seconds) for index, seconds in enumerate(sleeps)]
+
+    tools_output = asyncio.run(agent.run_tools(calls))
+
+    assert [tool_output["tool_call_id"] for tool_output in tools_output] == [call.id for call in calls]
+    assert [tool_output["output"] for tool_output in tools_output] == [f"slept {seconds}" for seconds in sleeps]
+    assert running["most"] == 2
+    assert len(agent.tool_timings) == len(calls)
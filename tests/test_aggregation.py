@@ -0,0 +1,136 @@
+"""
+The columnar engine and the Mongo pipeline answer the same aggregation specs, so they are checked on the same
+fixtures. The Mongo side only runs when MONGO_TEST_URL points at a MongoDB 7.0+ server. Its database is dropped.
+"""
+
+from columnar_engine import ColumnarEngine
+from db_tools import validate_aggregation_spec, aggregation_match, compile_aggregation, shape_mongo_aggregation, \
+    round_values
+
+from pymongo import ASCENDING, DESCENDING
+from datetime import datetime, timedelta
+import pandas as pd
+import pytest
+import os
+
+DOC_ID = "00000000-0000-0000-0000-000000000013"
+
+# C has a null TEAM and D has no TEAM at all. E has a null PTS and F has no PTS at all.
+FACTS = [
+    {"doc_id": DOC_ID, "PLAYER_NAME": "A", "TEAM": "BOS", "PTS": 30.0},
+    {"doc_id": DOC_ID, "PLAYER_NAME": "B", "TEAM": "BOS", "PTS": 20.0},
+    {"doc_id": DOC_ID, "PLAYER_NAME": "C", "TEAM": None, "PTS": 10.0},
+    {"doc_id": DOC_ID, "PLAYER_NAME": "D", "PTS": 25.0},
+    {"doc_id": DOC_ID, "PLAYER_NAME": "E", "TEAM": "NYK", "PTS": None},
+    {"doc_id": DOC_ID, "PLAYER_NAME": "F", "TEAM": "NYK"}
+]
+
+# Percentiles are left out since Mongo only estimates them
+SHARED_SPECS = [
+    {"doc_id": DOC_ID, "group_by": "TEAM", "metrics": [{"op": "avg", "field": "PTS", "as": "avg_pts"}],
+     "order": "ASCENDING"},
+    {"doc_id": DOC_ID, "group_by": "TEAM", "metrics": [{"op": "avg", "field": "PTS", "as": "avg_pts"}],
+     "order": "DESCENDING"},
+    {"doc_id": DOC_ID, "group_by": "CONFERENCE", "metrics": [{"op": "sum", "field": "PTS", "as": "total_pts"}]},
+    {"doc_id": DOC_ID, "metrics": [{"op": "sum", "field": "PTS", "as": "total_pts"}],
+     "top_k": {"field": "PTS", "k": 2, "fields": ["PLAYER_NAME", "PTS"]}},
+    {"doc_id": DOC_ID, "match": {"PTS": {"$gt": 100}},
+     "metrics": [{"op": "avg", "field": "PTS", "as": "avg_pts"}, {"op": "sum", "field": "PTS", "as": "total_pts"}]}
+]
+
+
+def columnar_aggregate(spec: dict) -> dict:
+    engine = ColumnarEngine(max_bytes=10_000_000)
+    engine.put_frame(DOC_ID, pd.DataFrame(FACTS))
+    spec = validate_aggregation_spec(spec)
+
+    return round_values(engine.aggregate(spec, aggregation_match(spec)))
+
+
+def test_groups_without_a_value_sort_as_the_lowest():
+    ascending = columnar_aggregate(SHARED_SPECS[0])["groups"]
+    descending = columnar_aggregate(SHARED_SPECS[1])["groups"]
+
+    assert [(group["TEAM"], group["avg_pts"]) for group in ascending] == [("NYK", None), (None, 17.5), ("BOS", 25.0)]
+    assert [(group["TEAM"], group["avg_pts"]) for group in descending] == [("BOS", 25.0), (None, 17.5), ("NYK", None)]
+
+
+def test_rows_without_the_group_field_are_grouped_under_none():
+    groups = columnar_aggregate(SHARED_SPECS[2])["groups"]
+
+    assert groups == [{"CONFERENCE": None, "count": 6, "total_pts": 85.0}]
+
+
+def test_top_rows_put_missing_values_first_when_ascending():
+    spec = {"doc_id": DOC_ID, "top_k": {"field": "PTS", "k": 3, "order": "ASCENDING", "fields": ["PLAYER_NAME", "PTS"]}}
+
+    top = columnar_aggregate(spec)["top"]
+
+    assert top == [
+        {"PLAYER_NAME": "E", "PTS": None},
+        {"PLAYER_NAME": "F", "PTS": None},
+        {"PLAYER_NAME": "C", "PTS": 10.0}
+    ]
+
+
+def test_every_sort_key_places_its_own_missing_values():
+    engine = ColumnarEngine(max_bytes=10_000_000)
+    engine.put_frame(DOC_ID, pd.DataFrame([
+        {"doc_id": DOC_ID, "PLAYER_NAME": "A", "TEAM": "BOS", "PTS": 10.0},
+        {"doc_id": DOC_ID, "PLAYER_NAME": "B", "TEAM": "BOS", "PTS": None},
+        {"doc_id": DOC_ID, "PLAYER_NAME": "C", "TEAM": None, "PTS": 5.0}
+    ]))
+
+    rows = engine.find({"doc_id": DOC_ID}, [("TEAM", DESCENDING), ("PTS", ASCENDING)], None, ["PLAYER_NAME"])
+
+    # The missing team goes last but the missing points still come first within BOS
+    assert [row["PLAYER_NAME"] for row in rows] == ["B", "A", "C"]
+
+
+def test_frames_are_dropped_once_their_snapshot_can_expire():
+    engine = ColumnarEngine(max_bytes=10_000_000)
+    engine.load_frame = lambda doc_id: pd.DataFrame()
+    engine.put_frame(DOC_ID, pd.DataFrame([
+        {"doc_id": DOC_ID, "PLAYER_NAME": "A", "createdAt": datetime.utcnow() - timedelta(days=1)}
+    ]))
+    engine.put_frame("expired", pd.DataFrame([
+        {"doc_id": "expired", "PLAYER_NAME": "B", "createdAt": datetime.utcnow() - timedelta(days=365)}
+    ]))
+
+    assert [row["PLAYER_NAME"] for row in engine.find({"doc_id": DOC_ID}, [], None)] == ["A"]
+    # The TTL index removed the rows so loading the snapshot again finds nothing
+    assert engine.find({"doc_id": "expired"}, [], None) == []
+    assert list(engine.frames) == [DOC_ID]
+
+
+def test_percentile_is_the_discrete_percentile():
+    spec = {"doc_id": DOC_ID, "metrics": [{"op": "percentile", "field": "PTS", "p": 0.5, "as": "p50"},
+                                          {"op": "percentile", "field": "PTS", "p": 0.9, "as": "p90"}]}
+
+    metrics = columnar_aggregate(spec)["metrics"]
+
+    assert metrics == {"p50": 20.0, "p90": 30.0}
+
+
+def test_nothing_matched_looks_the_same_from_both_backends():
+    spec = SHARED_SPECS[4]
+
+    assert columnar_aggregate(spec) == round_values(shape_mongo_aggregation(validate_aggregation_spec(spec), []))
+
+
+@pytest.mark.skipif(not os.getenv("MONGO_TEST_URL"), reason="MONGO_TEST_URL is not set.")
+@pytest.mark.parametrize("spec", SHARED_SPECS)
+def test_columnar_engine_matches_mongo(spec):
+    from pymongo import MongoClient
+
+    client = MongoClient(os.getenv("MONGO_TEST_URL"))
+    database = client["swarm_aggregation_test"]
+    try:
+        database["swarm_facts"].insert_many([dict(fact) for fact in FACTS])
+        validated = validate_aggregation_spec(spec)
+        results = list(database["swarm_facts"].aggregate(compile_aggregation(validated)))
+
+        assert round_values(shape_mongo_aggregation(validated, results)) == columnar_aggregate(spec)
+    finally:
+        client.drop_database("swarm_aggregation_test")
+        client.close()
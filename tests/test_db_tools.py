@@ -0,0 +1,34 @@
+import json
+
+from db_tools import format_rows
+
+
+def test_format_rows_keeps_keys_missing_from_the_first_row():
+    rows = [
+        {"PLAYER": "Tatum", "PTS": 26.9},
+        {"PLAYER": "Brown", "AST": 3.6},
+        {"PTS": 20.8, "PLAYER": "White", "STL": 1.0}
+    ]
+
+    result = json.loads(format_rows(iter(rows)))
+
+    assert result["columns"] == ["PLAYER", "PTS", "AST", "STL"]
+    assert result["rows"] == [
+        ["Tatum", 26.9, None, None],
+        ["Brown", None, 3.6, None],
+        ["White", 20.8, None, 1.0]
+    ]
+    assert result["returned"] == 3
+
+
+def test_format_rows_leaves_out_the_columns_of_rows_past_the_budget():
+    rows = [
+        {"PLAYER": "Tatum", "PTS": 26.9},
+        {"PLAYER": "Brown", "AST": 3.6}
+    ]
+
+    result = json.loads(format_rows(iter(rows), max_rows=1))
+
+    assert result["columns"] == ["PLAYER", "PTS"]
+    assert result["rows"] == [["Tatum", 26.9]]
+    assert result["truncated"] is True
@@ -0,0 +1,37 @@
+from agent_tools.name_resolver import NameIndex, add_player_rows
+
+
+def test_prefix_matches_are_only_the_names_that_start_with_the_query():
+    index = NameIndex()
+    for player_id, name in enumerate(["LeBron James", "Bronny James", "Jaylen Brown", "Jayson Tatum"]):
+        index.add(kind="player", entry_id=player_id, name=name, aliases=[name.split(" ")[-1]])
+
+    assert index.prefix_matches("jay") == ["jaylen brown", "jayson tatum"]
+    assert index.prefix_matches("z") == []
+    assert [result["name"] for result in index.resolve("bro")] == ["Bronny James", "Jaylen Brown"]
+
+
+def test_only_the_current_season_marks_players_active():
+    index = NameIndex()
+    add_player_rows(index, [{"PLAYER_ID": 1, "PLAYER_NAME": "Retired Guard", "TEAM_ID": 10}], is_current_season=False)
+    add_player_rows(index, [{"PLAYER_ID": 2, "PLAYER_NAME": "Current Forward", "TEAM_ID": 20}], is_current_season=True)
+    # An older season doesn't overwrite the current team
+    add_player_rows(index, [{"PLAYER_ID": 2, "PLAYER_NAME": "Current Forward", "TEAM_ID": 30}], is_current_season=False)
+
+    assert index.resolve("Retired Guard")[0]["is_active"] is False
+    current_forward = index.resolve("Current Forward")[0]
+    assert current_forward["is_active"] is True
+    assert current_forward["team_id"] == 20
+
+
+def test_an_updated_entry_loses_its_old_names():
+    index = NameIndex()
+    index.add(kind="team", entry_id=1, name="Seattle SuperSonics", aliases=["Sonics", "SEA"])
+    index.add(kind="team", entry_id=2, name="Sacramento Kings", aliases=["SAC"])
+    index.add(kind="team", entry_id=1, name="Oklahoma City Thunder", aliases=["Thunder", "OKC", "SEA"])
+
+    assert index.resolve("Sonics") == []
+    assert "sonics" not in index.sorted_names
+    assert index.resolve("Thunder")[0]["name"] == "Oklahoma City Thunder"
+    assert index.resolve("SEA")[0]["name"] == "Oklahoma City Thunder"
+    assert index.prefix_matches("s") == ["sac", "sacramento kings", "sea"]
@@ -0,0 +1,23 @@
+from agents.openai_client import PooledTransport
+
+import httpx
+import pytest
+
+
+def send_without_network(self, request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, stream=httpx.ByteStream(b"{}"), request=request)
+
+
+def test_pool_of_one_times_out_instead_of_deadlocking(monkeypatch):
+    monkeypatch.setattr(httpx.HTTPTransport, "handle_request", send_without_network)
+    transport = PooledTransport(pool_size=1, keepalive=5)
+    client = httpx.Client(transport=transport, timeout=httpx.Timeout(5, pool=0.1))
+
+    # An open stream holds the only slot, like a streamed run does
+    with client.stream("GET", "https://api.openai.com/v1/threads/thread_1/runs"):
+        with pytest.raises(httpx.PoolTimeout):
+            client.get("https://api.openai.com/v1/threads/thread_1/messages")
+
+    # The slot is given back once the stream is closed
+    assert client.get("https://api.openai.com/v1/threads/thread_1/messages").status_code == 200
+    assert transport.stats()["in_use"] == 0